@@ -1,4 +1,5 @@
 import io
+import logging
 import os
 import json
 import base64
@@ -7,6 +8,13 @@ import google.generativeai as genai
 from PIL import Image
 import fitz # PyMuPDF
 from openpyxl import Workbook
+from metrics import stage_timer, count_rows
+from structured_logging import warn_row, bind_log_context
+from job_pool import run_job
+from memory_profiling import memory_tracked
+from tracing import traced, current_span, start_span
+
+logger = logging.getLogger(__name__)
 
 # Cấu hình Gemini API Key
 # KHÔNG NÊN HARDCODE API KEY TRONG MÔI TRƯỜNG SẢN XUẤT!
@@ -15,7 +23,7 @@ api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
     # Đây là fallback cho môi trường dev cục bộ nếu bạn chưa đặt biến môi trường
     # Trong môi trường Render, biến môi trường sẽ được tự động cung cấp.
-    print("Cảnh báo: Không tìm thấy GEMINI_API_KEY trong biến môi trường. Vui lòng đặt biến này.")
+    logger.warning("Không tìm thấy GEMINI_API_KEY trong biến môi trường. Vui lòng đặt biến này.")
     # Bạn có thể tạm thời đặt API key của mình vào đây nếu muốn thử nghiệm cục bộ
     # api_key = "ĐIỀN API VÀ ĐÂY" # <--- API KEY CỦA BẠN ĐÃ ĐƯỢC TÍCH HỢP CỨNG Ở ĐÂY
                                                       # NHỚ XÓA TRƯỚC KHI TRIỂN KHAI LÊN RENDER!
@@ -26,26 +34,35 @@ if api_key:
     gemini_model = genai.GenerativeModel('gemini-1.5-flash')
 else:
     gemini_model = None
-    print("Gemini API không được cấu hình. Chức năng Thẻ kho sẽ không hoạt động.")
+    logger.warning("Gemini API không được cấu hình. Chức năng Thẻ kho sẽ không hoạt động.")
 
 
-def _convert_pdf_to_images(pdf_bytes):
+def _render_pdf_pages(pdf_bytes):
     """
-    Chuyển đổi mỗi trang của file PDF thành một đối tượng PIL Image.
+    Render mỗi trang của file PDF thành ảnh PNG (bytes). Chạy trong tiến trình xử lý riêng (job_pool):
+    PDF lỗi làm PyMuPDF treo/đổ vỡ không ảnh hưởng worker web, bộ nhớ render được trả lại khi xong.
     """
-    images = []
+    pages = []
     try:
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
         for page_num in range(len(doc)):
             page = doc.load_page(page_num)
             # Render trang thành pixel map (PNG format)
             pix = page.get_pixmap()
-            img_bytes = pix.tobytes("png")
-            # Chuyển đổi bytes thành PIL Image
-            images.append(Image.open(io.BytesIO(img_bytes)))
+            pages.append(pix.tobytes("png"))
         doc.close()
     except Exception as e:
         raise ValueError(f"Lỗi khi chuyển đổi PDF sang ảnh: {e}")
+    return pages
+
+
+@traced('stock_card.convert_pdf_to_images')
+def _convert_pdf_to_images(pdf_bytes):
+    """
+    Chuyển đổi mỗi trang của file PDF thành một đối tượng PIL Image.
+    """
+    images = [Image.open(io.BytesIO(png_bytes)) for png_bytes in run_job('pdf_render', files={'pdf_bytes': pdf_bytes})]
+    current_span().set_attributes(pdf_bytes=len(pdf_bytes), pages=len(images))
     return images
 
 def _extract_data_from_image_with_gemini(image_content):
@@ -82,7 +99,9 @@ def _extract_data_from_image_with_gemini(image_content):
     try:
         # Gửi prompt và hình ảnh tới Gemini
         # Gemini API expects image as PIL.Image.Image or raw bytes for multimodal input
-        response = gemini_model.generate_content([prompt_text, image_content])
+        with start_span('stock_card.gemini_generate_content', model=gemini_model.model_name) as span:
+            response = gemini_model.generate_content([prompt_text, image_content])
+            span.set_attribute('response_chars', len(response.text or ''))
         
         # Xử lý phản hồi từ Gemini
         # Đôi khi Gemini có thể thêm các ký tự markdown như ```json hoặc ```
@@ -96,8 +115,7 @@ def _extract_data_from_image_with_gemini(image_content):
         return extracted_data
     except json.JSONDecodeError as e:
         # LOG RA PHẢN HỒI GỐC TỪ GEMINI KHI CÓ LỖI JSON
-        print(f"Lỗi JSONDecodeError: {e}")
-        print(f"Phản hồi thô từ Gemini: \n{response.text}")
+        logger.error("Gemini trả về JSON không hợp lệ: %s", e, extra={'gemini_response': response.text})
         raise ValueError(f"Gemini trả về định dạng không hợp lệ. Chi tiết: {e}")
     except Exception as e:
         raise ValueError(f"Lỗi khi gọi Gemini API hoặc xử lý phản hồi: {e}")
@@ -177,7 +195,8 @@ def _validate_and_normalize_data(data, filename=""):
                         pass 
                     data[field] = float(s_value)
             except (ValueError, TypeError):
-                print(f"Cảnh báo: File '{filename}', trường '{field}' có giá trị '{value}' không phải là số hợp lệ. Đặt về null.")
+                warn_row(logger, 'stock_card.invalid_number', "File '%s', trường '%s' có giá trị '%s' không phải là số hợp lệ. Đặt về null.",
+                         filename, field, value)
                 data[field] = None # Đặt là None nếu không phải số
 
     return data
@@ -236,15 +255,18 @@ def _create_excel_buffer(extracted_records):
     output_buffer.seek(0)
     return output_buffer
 
+@memory_tracked('stock_card')
 def process_stock_card_data(uploaded_files, selected_chxd):
     """
     Hàm điều phối chính để xử lý nhiều file ảnh/PDF và tạo Excel.
     """
+    bind_log_context(store=selected_chxd, report_type='stock_card')
     all_extracted_data = []
     processing_errors = [] # Danh sách để lưu trữ các lỗi cụ thể
 
     for file in uploaded_files:
-        file_content_bytes = file.read()
+        with stage_timer('stock_card', 'upload_read'):
+            file_content_bytes = file.read()
         file_mimetype = file.mimetype
         filename = file.filename # Lấy tên file để đưa vào thông báo lỗi
 
@@ -253,7 +275,8 @@ def process_stock_card_data(uploaded_files, selected_chxd):
             images_to_process.append(Image.open(io.BytesIO(file_content_bytes)))
         elif file_mimetype == 'application/pdf':
             try:
-                images_to_process.extend(_convert_pdf_to_images(file_content_bytes))
+                with stage_timer('stock_card', 'pdf_render'):
+                    images_to_process.extend(_convert_pdf_to_images(file_content_bytes))
             except ValueError as ve:
                 processing_errors.append(f"File '{filename}': {ve}")
                 continue
@@ -269,12 +292,14 @@ def process_stock_card_data(uploaded_files, selected_chxd):
             try:
                 # Thêm chỉ số trang nếu là PDF
                 current_filename_info = f"{filename} (Trang {i+1})" if file_mimetype == 'application/pdf' else filename
-                extracted_record = _extract_data_from_image_with_gemini(img)
+                with stage_timer('stock_card', 'gemini_call'):
+                    extracted_record = _extract_data_from_image_with_gemini(img)
                 
                 # Thêm CHXD đã chọn vào dữ liệu trích xuất
                 extracted_record['ten_chxd'] = selected_chxd
                 
-                validated_data = _validate_and_normalize_data(extracted_record, filename=current_filename_info)
+                with stage_timer('stock_card', 'validation'):
+                    validated_data = _validate_and_normalize_data(extracted_record, filename=current_filename_info)
                 all_extracted_data.append(validated_data)
             except ValueError as ve:
                 # Nếu có lỗi validation hoặc trích xuất, thông báo nhưng không dừng toàn bộ quá trình
@@ -296,5 +321,7 @@ def process_stock_card_data(uploaded_files, selected_chxd):
     # Chuyển đổi 'so' thành chuỗi để sắp xếp đúng cho cả số và ký tự
     all_extracted_data.sort(key=lambda x: (x.get('ngay_thang_dt', datetime.min), str(x.get('so', ''))))
 
-    return _create_excel_buffer(all_extracted_data)
+    count_rows('stock_card', 'output', len(all_extracted_data))
+    with stage_timer('stock_card', 'excel_build'):
+        return _create_excel_buffer(all_extracted_data)
 
@@ -1,21 +1,38 @@
 import base64
 import io
+import logging
 import os
-import uuid
 import zipfile
 import re
-import tempfile  # <-- THÊM: Thư viện quản lý thư mục tạm thông minh đa nền tảng
+import time
+from functools import wraps
 from datetime import datetime
 from collections import defaultdict
-from flask import Flask, flash, redirect, render_template, request, send_file, url_for, get_flashed_messages, jsonify, session
+from flask import Flask, flash, redirect, render_template, request, send_file, url_for, get_flashed_messages, jsonify, session, g, make_response, has_request_context
 from openpyxl import load_workbook
-import pandas as pd
+from structured_logging import configure_logging, begin_log_context, end_log_context, request_stats, current_request_id
+
+# Cài đặt log có cấu trúc trước khi import các handler (một số handler ghi log ngay khi được import)
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # --- CÁC IMPORT CHO CÁC HANDLER ---
 from detector import detect_report_type
-from hddt_handler import process_hddt_report
-from pos_handler import process_pos_report
-from doisoat_handler import perform_reconciliation, _load_discount_data, _generate_discount_report_excel
+from doisoat_handler import perform_reconciliation, perform_range_reconciliation, perform_incremental_reconciliation, perform_three_way_reconciliation, _load_discount_data, _generate_discount_report_excel
+from TheKho_handler import process_stock_card_data
+from artifact_manager import artifact_manager
+from report_naming import _extract_report_date_for_filename, _make_base_filename
+from batch_handler import process_batch, detect_store_for_file
+from memory_monitor import memory_report
+from reconciliation_store import reconciliation_store
+from reconciliation_history import reconciliation_history, quarter_range
+from reconcile_incremental import incremental_reconciler
+from profiling import request_profiler
+from tracing import open_span, close_span
+from capture import capture_manager
+from job_pool import run_job
+from memory_watchdog import memory_watchdog
+from metrics import registry, Counter, Gauge, StageTimer, REQUEST_DURATION, REQUESTS_TOTAL, REQUESTS_IN_FLIGHT
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a_very_strong_and_unified_secret_key')
@@ -49,100 +66,6 @@ def format_currency_filter(value):
     except (ValueError, TypeError):
         return "0"
 
-def _sanitize_filename_piece(s: str) -> str:
-    """Làm sạch chuỗi để đưa vào tên file an toàn."""
-    if not s:
-        return "Untitled"
-    s = s.strip()
-    return re.sub(r'[\\/:*?"<>|\r\n]+', '_', s)
-
-def _parse_date_like_hddt(cell_val):
-    """Phân tích ngày tháng từ bảng kê hóa đơn HDDT."""
-    if cell_val is None:
-        return None
-    if isinstance(cell_val, datetime):
-        return cell_val.date()
-    if isinstance(cell_val, (int, float)):
-        try:
-            return pd.to_datetime(float(cell_val), unit='D', origin='1899-12-30').date()
-        except Exception:
-            return None
-    if isinstance(cell_val, str):
-        date_str = cell_val.strip()
-        fmts = ['%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d', '%Y-%m-%d', '%d/%m/%y', '%d-%m-%y']
-        for fmt in fmts:
-            try:
-                return datetime.strptime(date_str, fmt).date()
-            except ValueError:
-                continue
-    return None
-
-def _parse_date_like_pos(cell_val):
-    """Phân tích ngày tháng từ bảng kê hóa đơn POS."""
-    if cell_val is None:
-        return None
-    if isinstance(cell_val, datetime):
-        return cell_val.date()
-    if isinstance(cell_val, (int, float)):
-        try:
-            return pd.to_datetime(float(cell_val), unit='D', origin='1899-12-30').date()
-        except Exception:
-            return None
-    if isinstance(cell_val, str):
-        date_str = cell_val.strip()
-        fmts = [
-            '%Y-%m-%d %H:%M:%S', '%Y-%m-%d',
-            '%d-%m-%Y %H:%M:%S', '%d-%m-%Y',
-            '%d/%m/%Y %H:%M:%S', '%d/%m/%Y'
-        ]
-        for fmt in fmts:
-            try:
-                return datetime.strptime(date_str, fmt).date()
-            except ValueError:
-                continue
-    return None
-
-def _extract_report_date_for_filename(file_bytes: bytes, report_type: str, confirmed_date_str: str | None) -> datetime.date:
-    """Xác định ngày báo cáo để phục vụ đặt tên tệp tin đầu ra."""
-    try:
-        if report_type == 'HDDT':
-            if confirmed_date_str:
-                try:
-                    return datetime.strptime(confirmed_date_str, '%Y-%m-%d').date()
-                except Exception:
-                    pass
-            wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
-            ws = wb.active
-            unique_dates = set()
-            for row in ws.iter_rows(min_row=11, values_only=True):
-                qty = _to_float_app(row[9] if len(row) > 9 else None)
-                if qty > 0:
-                    dt = _parse_date_like_hddt(row[21] if len(row) > 21 else None)
-                    if dt:
-                        unique_dates.add(dt)
-            wb.close()
-            if unique_dates:
-                return min(unique_dates)
-        elif report_type == 'POS':
-            wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
-            ws = wb.active
-            unique_dates = set()
-            for row in ws.iter_rows(min_row=5, values_only=True):
-                dt = _parse_date_like_pos(row[3] if len(row) > 3 else None)
-                if dt:
-                    unique_dates.add(dt)
-            wb.close()
-            if unique_dates:
-                return min(unique_dates)
-    except Exception:
-        pass
-    return datetime.today().date()
-
-def _make_base_filename(store_name: str, file_date: datetime.date) -> str:
-    store = _sanitize_filename_piece(store_name)
-    date_part = f"{file_date.day:02d}.{file_date.month:02d}.{file_date.year}"
-    return f"{store}.{date_part}"
-
 def load_all_static_config_data():
     """Tải toàn bộ cấu hình từ các tệp Excel tĩnh một lần khi khởi tạo server."""
     static_data = {}
@@ -290,6 +213,8 @@ def load_all_static_config_data():
         return None, f"Lỗi nạp dữ liệu cấu hình: {e}"
 
 _global_static_config_data, _static_config_error = load_all_static_config_data()
+# Lịch sử đối soát mặc định nằm trong thư mục tạm: nhắc cấu hình ổ đĩa bền vững
+reconciliation_history.warn_if_ephemeral()
 
 def get_chxd_list():
     if _static_config_error:
@@ -303,6 +228,100 @@ def get_chxd_list():
     chxd_data.sort(key=lambda x: x['name'])
     return chxd_data
 
+def _find_chxd_symbol(chxd_name, chxd_list=None):
+    """Tra ký hiệu hóa đơn của CHXD theo tên."""
+    chxd_list = chxd_list if chxd_list is not None else get_chxd_list()
+    return next((x['symbol'] for x in chxd_list if x['name'] == chxd_name), None)
+
+def _capture_forced():
+    """Quản trị viên có thể yêu cầu lưu bảng kê của riêng request này bằng header X-Capture: 1."""
+    return has_request_context() and request.headers.get('X-Capture') == '1' and _is_admin_request()
+
+def _run_upsse_conversion(file_content, selected_chxd, price_periods, invoice_number, confirmed_date, chxd_list=None, report_type=None):
+    """
+    Nhận diện loại bảng kê (nếu chưa biết) và chuyển đổi sang UpSSE.
+    Trả về (kết quả của handler, loại bảng kê). Lỗi dữ liệu được báo bằng ValueError.
+    Tệp lỗi/chạy chậm được lưu (ẩn danh) cho replay.py theo cấu hình CAPTURE_MODE.
+    """
+    started = time.perf_counter()
+    params = {'selected_chxd': selected_chxd, 'price_periods': price_periods, 'invoice_number': invoice_number,
+              'confirmed_date': confirmed_date, 'report_type': report_type}
+    try:
+        result, report_type = _convert_upsse(file_content, selected_chxd, price_periods, invoice_number, confirmed_date,
+                                             chxd_list, report_type)
+    except Exception as e:
+        # Loại bảng kê (None = tự nhận diện khi lưu) quyết định cột nào cần ẩn danh
+        capture_manager.maybe_capture('upsse', {'file': (params['report_type'], file_content)}, params,
+                                      time.perf_counter() - started, e, _capture_forced())
+        raise
+    if not (isinstance(result, dict) and result.get('choice_needed')):
+        capture_manager.maybe_capture('upsse', {'file': (report_type, file_content)}, {**params, 'report_type': report_type},
+                                      time.perf_counter() - started, None, _capture_forced())
+    return result, report_type
+
+def _convert_upsse(file_content, selected_chxd, price_periods, invoice_number, confirmed_date, chxd_list=None, report_type=None):
+    if report_type is None:
+        report_type = detect_report_type(file_content)
+    selected_chxd_symbol = _find_chxd_symbol(selected_chxd, chxd_list)
+
+    if not selected_chxd_symbol:
+        raise ValueError(f"Không tìm thấy ký hiệu cho cửa hàng '{selected_chxd}'. Vui lòng kiểm tra Data_HDDT.xlsx.")
+
+    # Handler chạy trong tiến trình xử lý riêng (job_pool), tệp đầu vào/kết quả được truyền qua tệp tạm
+    if report_type == 'POS':
+        result = run_job(
+            'pos',
+            files={'file_content_bytes': file_content},
+            selected_chxd=selected_chxd,
+            price_periods=price_periods,
+            new_price_invoice_number=invoice_number,
+            static_data_pos=_global_static_config_data['pos_config'],
+            selected_chxd_symbol=selected_chxd_symbol
+        )
+    elif report_type == 'HDDT':
+        result = run_job(
+            'hddt',
+            files={'file_content_bytes': file_content},
+            selected_chxd=selected_chxd,
+            price_periods=price_periods,
+            new_price_invoice_number=invoice_number,
+            confirmed_date_str=confirmed_date,
+            static_data_hddt=_global_static_config_data['hddt_config'],
+            selected_chxd_symbol=selected_chxd_symbol
+        )
+    else:
+        raise ValueError("Không thể nhận diện tự động loại bảng kê. Vui lòng kiểm tra lại file của bạn.")
+    return result, report_type
+
+def _zip_two_period_result(result, base_filename):
+    """Đóng gói kết quả hai giai đoạn giá thành nội dung tệp zip."""
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        if result.get('old'):
+            result['old'].seek(0)
+            zipf.writestr(f'{base_filename}_GiaCu.xlsx', result['old'].read())
+        if result.get('new'):
+            result['new'].seek(0)
+            zipf.writestr(f'{base_filename}_GiaMoi.xlsx', result['new'].read())
+    return zip_buffer.getvalue()
+
+def _profile_if_requested(view):
+    """
+    Bật đo hiệu năng cho riêng một request khi quản trị viên gửi header X-Profile: 1 (hoặc ?profile=1).
+    Profile (.pstats và .folded) được lưu phía máy chủ, mã profile trả về qua header X-Profile-Id,
+    nhờ đó có thể chẩn đoán tệp chậm ngay trên production mà không phải sao chép dữ liệu khách hàng.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        wants_profile = (request.headers.get('X-Profile') or request.args.get('profile')) == '1'
+        if not wants_profile or not _is_admin_request():
+            return view(*args, **kwargs)
+        result, profile_id = request_profiler.run(view.__name__, view, *args, **kwargs)
+        response = make_response(result)
+        response.headers['X-Profile-Id'] = profile_id or 'busy'
+        return response
+    return wrapper
+
 @app.route('/', methods=['GET'])
 def index():
     """Hiển thị trang chính và khôi phục thông báo, dữ liệu đã lưu từ Session."""
@@ -316,10 +335,9 @@ def index():
     
     # Khôi phục tệp đang chờ nếu có
     pending_path = session.get('pending_file_path')
-    if pending_path and os.path.exists(pending_path):
+    if artifact_manager.exists(pending_path):
         try:
-            with open(pending_path, 'rb') as f:
-                file_bytes = f.read()
+            file_bytes = artifact_manager.read_bytes(pending_path)
             form_data["encoded_file"] = base64.b64encode(file_bytes).decode('utf-8')
         except Exception:
             pass
@@ -339,6 +357,7 @@ def index():
     )
 
 @app.route('/process', methods=['POST'])
+@_profile_if_requested
 def process():
     """Xử lý bảng kê và lưu tệp kết quả tạm thời vào thư mục OS temp, sau đó Redirect về trang chủ."""
     chxd_list = get_chxd_list()
@@ -352,11 +371,8 @@ def process():
 
     # Xóa tệp chờ cũ nếu có để tránh chiếm dụng dung lượng
     old_pending_path = session.pop('pending_file_path', None)
-    if old_pending_path and os.path.exists(old_pending_path):
-        try:
-            os.remove(old_pending_path)
-        except Exception:
-            pass
+    if old_pending_path:
+        artifact_manager.release(old_pending_path)
 
     try:
         if _static_config_error:
@@ -367,6 +383,7 @@ def process():
             session['upsse_form_data'] = form_data
             return redirect(url_for('index', active_tab='upsse'))
 
+        timer = StageTimer('upsse')
         file_content = None
         if form_data["encoded_file"]:
             file_content = base64.b64decode(form_data["encoded_file"])
@@ -376,41 +393,22 @@ def process():
             flash('Vui lòng tải lên file Bảng kê.', 'warning')
             session['upsse_form_data'] = form_data
             return redirect(url_for('index', active_tab='upsse'))
+        timer.mark('upload_read')
 
-        # Tự động nhận dạng tệp POS hay HDDT
-        report_type = detect_report_type(file_content)
-        selected_chxd_symbol = next((x['symbol'] for x in chxd_list if x['name'] == form_data["selected_chxd"]), None)
-
-        if not selected_chxd_symbol:
-            raise ValueError(f"Không tìm thấy ký hiệu cho cửa hàng '{form_data['selected_chxd']}'. Vui lòng kiểm tra Data_HDDT.xlsx.")
-
-        if report_type == 'POS':
-            result = process_pos_report(
-                file_content_bytes=file_content,
-                selected_chxd=form_data["selected_chxd"],
-                price_periods=form_data["price_periods"],
-                new_price_invoice_number=form_data["invoice_number"],
-                static_data_pos=_global_static_config_data['pos_config'],
-                selected_chxd_symbol=selected_chxd_symbol
-            )
-        elif report_type == 'HDDT':
-            result = process_hddt_report(
-                file_content_bytes=file_content,
-                selected_chxd=form_data["selected_chxd"],
-                price_periods=form_data["price_periods"],
-                new_price_invoice_number=form_data["invoice_number"],
-                confirmed_date_str=form_data["confirmed_date"],
-                static_data_hddt=_global_static_config_data['hddt_config'],
-                selected_chxd_symbol=selected_chxd_symbol
-            )
-        else:
-            raise ValueError("Không thể nhận diện tự động loại bảng kê. Vui lòng kiểm tra lại file của bạn.")
+        # Tự động nhận dạng tệp POS hay HDDT và chuyển đổi
+        result, report_type = _run_upsse_conversion(
+            file_content,
+            form_data["selected_chxd"],
+            form_data["price_periods"],
+            form_data["invoice_number"],
+            form_data["confirmed_date"],
+            chxd_list=chxd_list
+        )
+        timer.mark('convert')
 
-        # Nếu cần chọn ngày (đa ngày phát hiện trong tệp) - Sửa đổi đường dẫn lưu tạm thời tương thích đa hệ điều hành
+        # Nếu cần chọn ngày (đa ngày phát hiện trong tệp) - Lưu tạm qua artifact_manager để tự dọn khi hết hạn
         if isinstance(result, dict) and result.get('choice_needed'):
-            temp_pending_path = os.path.join(tempfile.gettempdir(), f"pending_{uuid.uuid4().hex}.dat")
-            with open(temp_pending_path, 'wb') as f:
-                f.write(file_content)
+            temp_pending_path = artifact_manager.write_bytes(file_content, 'pending', '.dat')
                 
             light_form_data = form_data.copy()
             light_form_data["encoded_file"] = "" # Xóa tệp nặng để tránh lưu quá dung lượng cookie session
@@ -423,33 +421,22 @@ def process():
 
         report_date = _extract_report_date_for_filename(file_content, report_type, form_data["confirmed_date"])
         base_filename = _make_base_filename(form_data["selected_chxd"], report_date)
+        timer.mark('report_date')
 
-        # Hai giai đoạn giá - Sửa đổi đường dẫn lưu tạm thời tương thích đa hệ điều hành
+        # Hai giai đoạn giá
         if isinstance(result, dict) and ('old' in result or 'new' in result):
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                if result.get('old'):
-                    result['old'].seek(0)
-                    zipf.writestr(f'{base_filename}_GiaCu.xlsx', result['old'].read())
-                if result.get('new'):
-                    result['new'].seek(0)
-                    zipf.writestr(f'{base_filename}_GiaMoi.xlsx', result['new'].read())
-            zip_buffer.seek(0)
-            
-            temp_zip_path = os.path.join(tempfile.gettempdir(), f"processed_{uuid.uuid4().hex}.zip")
-            with open(temp_zip_path, 'wb') as f:
-                f.write(zip_buffer.read())
+            temp_zip_path = artifact_manager.write_bytes(_zip_two_period_result(result, base_filename), 'processed', '.zip')
+            timer.mark('temp_write')
                 
             session['download_file'] = temp_zip_path
             session['download_name'] = 'UpSSE_2_giai_doan.zip'
             flash('Xử lý Đồng bộ SSE thành công!', 'success')
             return redirect(url_for('index', active_tab='upsse'))
 
-        # Một giai đoạn giá - Sửa đổi đường dẫn lưu tạm thời tương thích đa hệ điều hành
+        # Một giai đoạn giá
         elif isinstance(result, io.BytesIO):
-            temp_xlsx_path = os.path.join(tempfile.gettempdir(), f"processed_{uuid.uuid4().hex}.xlsx")
-            with open(temp_xlsx_path, 'wb') as f:
-                f.write(result.read())
+            temp_xlsx_path = artifact_manager.write_bytes(result.getvalue(), 'processed', '.xlsx')
+            timer.mark('temp_write')
                 
             session['download_file'] = temp_xlsx_path
             session['download_name'] = f'{base_filename}.xlsx'
@@ -472,13 +459,12 @@ def download():
     """Tải tệp tin kết quả về máy và dọn dẹp tệp tin tạm thời trên máy chủ."""
     file_path = session.get('download_file')
     download_name = session.get('download_name', 'export.xlsx')
-    if file_path and os.path.exists(file_path):
+    if artifact_manager.exists(file_path):
         try:
-            with open(file_path, 'rb') as f:
-                file_data = io.BytesIO(f.read())
-            os.remove(file_path)
+            file_data = io.BytesIO(artifact_manager.read_bytes(file_path))
         except Exception:
             file_data = None
+        artifact_manager.release(file_path)
             
         session.pop('download_file', None)
         session.pop('download_name', None)
@@ -492,7 +478,70 @@ def download():
             )
     return redirect(url_for('index'))
 
+@app.route('/process_batch', methods=['POST'])
+def process_batch_route():
+    """Xử lý hàng loạt bảng kê (tự nhận diện loại và CHXD), trả về một tệp zip kèm báo cáo trạng thái từng tệp."""
+    try:
+        if _static_config_error:
+            raise ValueError(_static_config_error)
+        uploaded_files = [f for f in request.files.getlist('files[]') if f.filename]
+        files = [(f.filename, f.read()) for f in uploaded_files]
+        period = request.form.get('period', '').strip() or None
+        zip_bytes, statuses = process_batch(files, _global_static_config_data, get_chxd_list(), period=period)
+        zip_path = artifact_manager.write_bytes(zip_bytes, 'processed', '.zip')
+        ok_count = sum(1 for st in statuses if st['status'] == 'OK')
+        response = send_file(zip_path, as_attachment=True, download_name='UpSSE_HangLoat.zip', mimetype='application/zip')
+        response.headers['X-Batch-Succeeded'] = str(ok_count)
+        response.headers['X-Batch-Failed'] = str(len(statuses) - ok_count)
+        return response
+    except ValueError as ve:
+        flash(str(ve).replace('\n', '<br>'), 'danger')
+    except Exception as e:
+        flash(f"Đã xảy ra lỗi không mong muốn: {e}", 'danger')
+    return redirect(url_for('index', active_tab='upsse'))
+
+def _run_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, selected_chxd_symbol, history_sink=None):
+    """Đối soát Log Bơm với Bảng kê HĐĐT; tệp lỗi/chạy chậm được lưu (ẩn danh) cho replay.py theo CAPTURE_MODE."""
+    discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
+    started = time.perf_counter()
+    error = None
+    try:
+        # Hai file được phân tích song song trong các tiến trình xử lý (job_pool), bước so khớp chạy tại đây
+        return perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, selected_chxd_symbol, discount_data,
+                                      history_sink=history_sink)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        capture_manager.maybe_capture(
+            'reconcile', {'log_bom': ('LOG_BOM', log_bom_bytes), 'hddt': ('RECONCILE_HDDT', hddt_bytes)},
+            {'selected_chxd': selected_chxd_name, 'selected_chxd_symbol': selected_chxd_symbol},
+            time.perf_counter() - started, error, _capture_forced())
+
+def _run_range_reconciliation(log_bom_files, hddt_files, selected_chxd_name, selected_chxd_symbol, history_sink=None):
+    """Đối soát nhiều ngày/cả tháng: nhiều file Log Bơm và nhiều file Bảng kê HĐĐT được đối soát như một tập dữ liệu."""
+    discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
+    return perform_range_reconciliation(log_bom_files, hddt_files, selected_chxd_name, selected_chxd_symbol, discount_data,
+                                        history_sink=history_sink)
+
+def _run_reconciliation_files(log_bom_files, hddt_files, selected_chxd_name, selected_chxd_symbol, history_sink=None):
+    """
+    Một cặp file: đối soát như trước (có thêm bảng theo ngày nếu Log Bơm có nhiều ngày, ví dụ file xuất cả tháng);
+    nhiều file ở bất kỳ bên nào: đối soát nhiều ngày.
+    """
+    if len(log_bom_files) == 1 and len(hddt_files) == 1:
+        return _run_reconciliation(log_bom_files[0], hddt_files[0], selected_chxd_name, selected_chxd_symbol, history_sink)
+    return _run_range_reconciliation(log_bom_files, hddt_files, selected_chxd_name, selected_chxd_symbol, history_sink)
+
+def _save_reconciliation(reconciliation_data, selected_chxd_name, invoice_rows):
+    """Lưu kết quả đối soát (tệp tạm theo mã cho các chức năng xuất) và ghi vào lịch sử đối soát, trả về mã."""
+    reconciliation_data['selected_chxd_name'] = selected_chxd_name
+    reconciliation_id = reconciliation_store.save(reconciliation_data)
+    reconciliation_history.record(reconciliation_id, selected_chxd_name, reconciliation_data, invoice_rows)
+    return reconciliation_id
+
 @app.route('/reconcile', methods=['POST'])
+@_profile_if_requested
 def reconcile():
     """Xử lý đối soát và chuyển về trang chính để cập nhật kết quả."""
     chxd_list_data = get_chxd_list()
@@ -501,21 +550,24 @@ def reconcile():
         if _static_config_error:
             raise ValueError(_static_config_error)
         selected_chxd_name = request.form.get('chxd')
-        file_log_bom = request.files.get('file_log_bom')
-        file_hddt = request.files.get('file_hddt')
+        # Có thể tải lên nhiều file mỗi loại (đối soát nhiều ngày/cả tháng)
+        files_log_bom = [f for f in request.files.getlist('file_log_bom') if f and f.filename]
+        files_hddt = [f for f in request.files.getlist('file_hddt') if f and f.filename]
 
-        if not selected_chxd_name or not file_log_bom or not file_hddt:
+        if not selected_chxd_name or not files_log_bom or not files_hddt:
             flash('Vui lòng chọn CHXD và tải đủ 2 tệp tin.', 'warning')
             return redirect(url_for('index', active_tab='doisoat'))
 
         selected_chxd_symbol = next((x['symbol'] for x in chxd_list_data if x['name'] == selected_chxd_name), None)
-        log_bom_bytes = file_log_bom.read()
-        hddt_bytes = file_hddt.read()
-        discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
+        log_bom_files = [f.read() for f in files_log_bom]
+        hddt_files = [f.read() for f in files_hddt]
 
-        reconciliation_data = perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, selected_chxd_symbol, discount_data)
+        invoice_rows = []
+        reconciliation_data = _run_reconciliation_files(log_bom_files, hddt_files, selected_chxd_name, selected_chxd_symbol,
+                                                        history_sink=invoice_rows.extend)
         if reconciliation_data:
-            reconciliation_data['selected_chxd_name'] = selected_chxd_name
+            # Lưu kết quả phía máy chủ để các chức năng xuất báo cáo chỉ cần gửi lại mã đối soát
+            reconciliation_data['reconciliation_id'] = _save_reconciliation(reconciliation_data, selected_chxd_name, invoice_rows)
             flash('Đối soát thành công!', 'success')
     except Exception as e:
         flash(f"Lỗi trong quá trình đối soát: {e}", 'danger')
@@ -523,19 +575,36 @@ def reconcile():
     session['upsse_form_data'] = {"active_tab": "doisoat"}
     return render_template('index.html', chxd_list=chxd_list_data, reconciliation_data=reconciliation_data, form_data={"active_tab": "doisoat"}, date_ambiguous=False)
 
+def _load_stored_reconciliation(reconciliation_id):
+    """Lấy kết quả đối soát đã lưu theo mã, báo lỗi nếu không còn (hết hạn hoặc mã sai)."""
+    reconciliation_data = reconciliation_store.get(reconciliation_id)
+    if reconciliation_data is None:
+        raise LookupError("Không tìm thấy kết quả đối soát (mã không đúng hoặc đã hết hạn). Vui lòng đối soát lại.")
+    return reconciliation_data
+
 @app.route('/generate_discount_report', methods=['POST'])
+@_profile_if_requested
 def generate_discount_report():
+    """Tạo báo cáo chiết khấu từ kết quả đối soát đã lưu (reconciliation_id) hoặc từ toàn bộ JSON gửi lên (cách cũ)."""
     try:
-        reconciliation_data_json = request.json
+        payload = request.get_json(silent=True) or {}
+        reconciliation_id = request.args.get('reconciliation_id') or payload.get('reconciliation_id')
+        if reconciliation_id and 'detailed_mismatches' not in payload:
+            reconciliation_data_json = _load_stored_reconciliation(reconciliation_id)
+        else:
+            reconciliation_data_json = payload
         discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
         excel_buffer = _generate_discount_report_excel(reconciliation_data_json, discount_data)
         if excel_buffer:
             excel_buffer.seek(0)
             return send_file(excel_buffer, as_attachment=True, download_name='BaoCaoChietKhau.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    except LookupError as le:
+        return jsonify({"status": "error", "message": str(le)}), 404
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/process_stock_card', methods=['POST'])
+@_profile_if_requested
 def process_stock_card():
     chxd_list = get_chxd_list()
     selected_chxd = request.form.get('chxd_thekho')
@@ -552,5 +621,496 @@ def process_stock_card():
         flash(f"Lỗi xử lý: {e}", 'danger')
     return redirect(url_for('index', active_tab='thekho'))
 
+# --- JSON API v1 ---
+# Dành cho việc tự động hóa (không qua trình duyệt): nhận multipart hoặc body thô, trả về JSON/tệp kèm thời gian xử lý.
+
+class _ApiError(Exception):
+    """Lỗi trả về cho client API dưới dạng JSON có mã lỗi máy đọc được."""
+    def __init__(self, code, message, http_status=400, details=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.http_status = http_status
+        self.details = details
+
+class _ApiTimer:
+    """Đo thời gian từng bước xử lý của một request API (ms)."""
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._last = self._started
+        self.timings_ms = {}
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.timings_ms[stage] = round((now - self._last) * 1000, 2)
+        self._last = now
+
+    def total(self):
+        self.timings_ms['total'] = round((time.perf_counter() - self._started) * 1000, 2)
+        return self.timings_ms
+
+def _api_params():
+    """Gộp tham số từ query string, form multipart và body JSON (ưu tiên JSON > form > query)."""
+    params = dict(request.args.items())
+    params.update(request.form.items())
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            params.update({k: v for k, v in body.items() if not isinstance(v, (dict, list))})
+    return params
+
+def _api_read_file(field, allow_raw_body=False):
+    """
+    Đọc tệp tải lên cho API theo thứ tự: multipart (field), JSON (field + '_b64'),
+    hoặc toàn bộ body thô (application/octet-stream) nếu endpoint chỉ nhận một tệp.
+    """
+    uploaded = request.files.get(field)
+    if uploaded and uploaded.filename:
+        return uploaded.read()
+    if request.is_json:
+        body = request.get_json(silent=True) or {}
+        encoded = body.get(f'{field}_b64') if isinstance(body, dict) else None
+        if encoded:
+            try:
+                return base64.b64decode(encoded)
+            except Exception:
+                raise _ApiError('invalid_base64', f"Trường '{field}_b64' không phải base64 hợp lệ.")
+    elif allow_raw_body and not request.files and not request.form:
+        data = request.get_data()
+        if data:
+            return data
+    raise _ApiError('missing_file', f"Thiếu tệp '{field}'.")
+
+def _api_read_files(field):
+    """
+    Đọc một hoặc nhiều tệp cùng tên trường: multipart (lặp lại field), hoặc JSON field + '_b64' là chuỗi hoặc danh sách.
+    """
+    uploaded = [f for f in request.files.getlist(field) if f and f.filename]
+    if uploaded:
+        return [f.read() for f in uploaded]
+    if request.is_json:
+        body = request.get_json(silent=True) or {}
+        encoded = body.get(f'{field}_b64') if isinstance(body, dict) else None
+        if isinstance(encoded, str):
+            encoded = [encoded]
+        if encoded:
+            try:
+                return [base64.b64decode(item) for item in encoded]
+            except Exception:
+                raise _ApiError('invalid_base64', f"Trường '{field}_b64' không phải base64 hợp lệ.")
+    raise _ApiError('missing_file', f"Thiếu tệp '{field}'.")
+
+def _api_resolve_store(params, file_content=None, report_type=None):
+    """Lấy CHXD từ tham số 'chxd', hoặc tự nhận diện từ ký hiệu hóa đơn trong tệp."""
+    chxd_list = get_chxd_list()
+    chxd_name = (params.get('chxd') or '').strip()
+    if chxd_name:
+        symbol = _find_chxd_symbol(chxd_name, chxd_list)
+        if not symbol:
+            raise _ApiError('unknown_store', f"Không tìm thấy cửa hàng '{chxd_name}' trong Data_HDDT.xlsx.", 404)
+        return {'name': chxd_name, 'symbol': symbol}
+    if file_content is None or report_type not in ('HDDT', 'POS'):
+        raise _ApiError('missing_store', "Thiếu tham số 'chxd'.")
+    try:
+        return detect_store_for_file(file_content, report_type, chxd_list)
+    except ValueError as ve:
+        raise _ApiError('store_not_detected', str(ve), 422)
+
+def _api_error_response(error, timer):
+    payload = {"status": "error", "error": {"code": error.code, "message": error.message}, "timings_ms": timer.total()}
+    if error.details is not None:
+        payload["error"]["details"] = error.details
+    return jsonify(payload), error.http_status
+
+def _api_endpoint(view):
+    """Bọc view API: kiểm tra cấu hình, chuyển ValueError/Exception thành lỗi JSON thống nhất."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        timer = _ApiTimer()
+        try:
+            if _static_config_error:
+                raise _ApiError('config_error', _static_config_error, 503)
+            return view(timer, *args, **kwargs)
+        except _ApiError as ae:
+            return _api_error_response(ae, timer)
+        except ValueError as ve:
+            return _api_error_response(_ApiError('invalid_input', str(ve), 422), timer)
+        except Exception as e:
+            return _api_error_response(_ApiError('internal_error', f"Đã xảy ra lỗi không mong muốn: {e}", 500), timer)
+    return wrapper
+
+def _api_timing_headers(response, timer):
+    for stage, value in timer.total().items():
+        response.headers[f'X-Timing-{stage.replace("_", "-").title()}-Ms'] = str(value)
+    return response
+
+@app.route('/api/v1/detect', methods=['POST'])
+@_api_endpoint
+def api_detect(timer):
+    """Nhận diện loại bảng kê (HDDT/POS) và CHXD của tệp."""
+    file_content = _api_read_file('file', allow_raw_body=True)
+    timer.mark('upload_read')
+    report_type = detect_report_type(file_content)
+    timer.mark('detect')
+    store = None
+    if report_type in ('HDDT', 'POS'):
+        try:
+            store = detect_store_for_file(file_content, report_type, get_chxd_list())
+        except ValueError:
+            store = None
+        timer.mark('store_detect')
+    return jsonify({"status": "ok", "report_type": report_type, "chxd": store, "timings_ms": timer.total()})
+
+@app.route('/api/v1/process', methods=['POST'])
+@_api_endpoint
+def api_process(timer):
+    """
+    Chuyển đổi bảng kê sang UpSSE.
+    Tham số: chxd (tùy chọn, tự nhận diện nếu bỏ trống), price_periods ('1'/'2'), invoice_number, confirmed_date (YYYY-MM-DD).
+    Trả về tệp .xlsx (1 giai đoạn) hoặc .zip (2 giai đoạn); thêm ?response=json để nhận JSON chứa base64.
+    """
+    params = _api_params()
+    file_content = _api_read_file('file', allow_raw_body=True)
+    timer.mark('upload_read')
+    report_type = detect_report_type(file_content)
+    timer.mark('detect')
+    if report_type not in ('HDDT', 'POS'):
+        raise _ApiError('unknown_report_type', "Không thể nhận diện tự động loại bảng kê.", 422)
+    store = _api_resolve_store(params, file_content, report_type)
+    timer.mark('store_resolve')
+
+    price_periods = str(params.get('price_periods') or '1')
+    if price_periods not in ('1', '2'):
+        raise _ApiError('invalid_price_periods', "price_periods phải là '1' hoặc '2'.")
+    confirmed_date = params.get('confirmed_date') or None
+    result, report_type = _run_upsse_conversion(
+        file_content, store['name'], price_periods, (params.get('invoice_number') or '').strip(), confirmed_date,
+        report_type=report_type
+    )
+    timer.mark('convert')
+
+    if isinstance(result, dict) and result.get('choice_needed'):
+        raise _ApiError('date_confirmation_required',
+                        "Ngày trong bảng kê không rõ ràng, gửi lại kèm confirmed_date là một trong các giá trị options.",
+                        409, details={'options': result['options']})
+
+    report_date = _extract_report_date_for_filename(file_content, report_type, confirmed_date)
+    base_filename = _make_base_filename(store['name'], report_date)
+    if isinstance(result, dict) and ('old' in result or 'new' in result):
+        content, download_name, mimetype = _zip_two_period_result(result, base_filename), f'{base_filename}_2_giai_doan.zip', 'application/zip'
+    elif isinstance(result, io.BytesIO):
+        content, download_name, mimetype = result.getvalue(), f'{base_filename}.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        raise _ApiError('invalid_handler_result', "Hàm xử lý không trả về kết quả hợp lệ.", 500)
+    timer.mark('package')
+
+    meta = {"report_type": report_type, "chxd": store['name'], "report_date": report_date.isoformat(), "filename": download_name}
+    if params.get('response') == 'json':
+        return jsonify({"status": "ok", **meta, "content_b64": base64.b64encode(content).decode('ascii'), "timings_ms": timer.total()})
+    response = send_file(io.BytesIO(content), as_attachment=True, download_name=download_name, mimetype=mimetype)
+    response.headers['X-Report-Type'] = report_type
+    response.headers['X-Report-Date'] = meta['report_date']
+    return _api_timing_headers(response, timer)
+
+@app.route('/api/v1/reconcile', methods=['POST'])
+@_api_endpoint
+def api_reconcile(timer):
+    """
+    Đối soát Log Bơm với Bảng kê HĐĐT. Tệp: file_log_bom, file_hddt; tham số: chxd.
+    Gửi nhiều tệp cho một trường (hoặc danh sách base64) để đối soát nhiều ngày/cả tháng: kết quả có thêm
+    daily_summary và item_daily_comparison.
+    """
+    params = _api_params()
+    log_bom_files = _api_read_files('file_log_bom')
+    hddt_files = _api_read_files('file_hddt')
+    timer.mark('upload_read')
+    store = _api_resolve_store(params)
+    invoice_rows = []
+    reconciliation_data = _run_reconciliation_files(log_bom_files, hddt_files, store['name'], store['symbol'],
+                                                    history_sink=invoice_rows.extend)
+    timer.mark('reconcile')
+    reconciliation_id = _save_reconciliation(reconciliation_data, store['name'], invoice_rows)
+    reconciliation_data['reconciliation_id'] = reconciliation_id
+    timer.mark('store')
+    return jsonify({"status": "ok", "reconciliation_id": reconciliation_id, "result": reconciliation_data, "timings_ms": timer.total()})
+
+@app.route('/api/v1/reconcile/incremental', methods=['POST'])
+@_api_endpoint
+def api_reconcile_incremental(timer):
+    """
+    Đối soát tăng dần trong ngày. Tệp: file_log_bom, file_hddt (file của một ngày tại thời điểm tải lên); tham số: chxd.
+    Chỉ các dòng mới/đã thay đổi so với lần tải lên trước của CHXD/ngày được xử lý; kết quả gồm các thay đổi
+    (deltas: new_matches, resolved, broken, removed) và tổng sau cập nhật.
+    """
+    params = _api_params()
+    log_bom_bytes = _api_read_file('file_log_bom')
+    hddt_bytes = _api_read_file('file_hddt')
+    timer.mark('upload_read')
+    store = _api_resolve_store(params)
+    discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
+    reconciliation_data = perform_incremental_reconciliation(log_bom_bytes, hddt_bytes, store['name'], store['symbol'],
+                                                             discount_data)
+    timer.mark('reconcile')
+    return jsonify({"status": "ok", "chxd": store['name'], "result": reconciliation_data, "timings_ms": timer.total()})
+
+@app.route('/api/v1/reconcile/three-way', methods=['POST'])
+@_api_endpoint
+def api_reconcile_three_way(timer):
+    """
+    Đối soát ba chiều trước khi xuất UpSSE. Tệp: file_log_bom, file_pos (bảng kê POS), file_hddt; tham số: chxd.
+    Kết quả gồm ma trận chênh lệch theo cặp nguồn, danh sách giao dịch có vấn đề và cờ upsse_consistent.
+    """
+    params = _api_params()
+    log_bom_bytes = _api_read_file('file_log_bom')
+    pos_bytes = _api_read_file('file_pos')
+    hddt_bytes = _api_read_file('file_hddt')
+    timer.mark('upload_read')
+    store = _api_resolve_store(params)
+    reconciliation_data = perform_three_way_reconciliation(log_bom_bytes, pos_bytes, hddt_bytes, store['name'], store['symbol'])
+    timer.mark('reconcile')
+    return jsonify({"status": "ok", "chxd": store['name'], "result": reconciliation_data, "timings_ms": timer.total()})
+
+@app.route('/api/v1/reconcile/incremental', methods=['DELETE'])
+@_api_endpoint
+def api_reset_incremental_reconciliation(timer):
+    """
+    Xóa trạng thái đối soát tăng dần của một CHXD/ngày (tham số: chxd, date=YYYY-MM-DD) để đối soát lại từ đầu.
+    Chỉ dành cho quản trị (xem _is_admin_request).
+    """
+    if not _is_admin_request():
+        raise _ApiError('forbidden', "Forbidden", 403)
+    params = _api_params()
+    store = _api_resolve_store(params)
+    day = params.get('date') or ''
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        raise _ApiError('invalid_date', "Tham số 'date' phải có dạng YYYY-MM-DD.")
+    removed_keys = incremental_reconciler.reset(store['name'], day)
+    timer.mark('reset')
+    return jsonify({"status": "ok", "chxd": store['name'], "date": day, "removed_keys": removed_keys,
+                    "timings_ms": timer.total()})
+
+def _api_stored_reconciliation(reconciliation_id):
+    try:
+        return _load_stored_reconciliation(reconciliation_id)
+    except LookupError as le:
+        raise _ApiError('reconciliation_not_found', str(le), 404)
+
+@app.route('/api/v1/reconciliations/<reconciliation_id>', methods=['GET'])
+@_api_endpoint
+def api_get_reconciliation(timer, reconciliation_id):
+    """Xuất lại kết quả đối soát đã lưu dưới dạng JSON."""
+    reconciliation_data = _api_stored_reconciliation(reconciliation_id)
+    timer.mark('load')
+    return jsonify({"status": "ok", "reconciliation_id": reconciliation_id, "result": reconciliation_data, "timings_ms": timer.total()})
+
+# --- LỊCH SỬ ĐỐI SOÁT ---
+def _history_filters(*names):
+    """Tham số lọc lịch sử từ query string; quarter=YYYY-Qn được đổi thành date_from/date_to."""
+    filters = {name: request.args.get(name) for name in (*names, 'date_from', 'date_to') if request.args.get(name)}
+    if request.args.get('quarter'):
+        filters['date_from'], filters['date_to'] = quarter_range(request.args['quarter'])
+    for name in ('date_from', 'date_to'):
+        if filters.get(name):
+            try:
+                datetime.strptime(filters[name], '%Y-%m-%d')
+            except ValueError:
+                raise _ApiError('invalid_date', f"Tham số '{name}' phải có dạng YYYY-MM-DD.")
+    if 'chxd' in request.args:
+        filters['store'] = request.args['chxd']
+    return filters
+
+def _history_limit():
+    """Tham số limit (số nguyên, được giới hạn trong 1..query_limit khi truy vấn); None nếu không có."""
+    limit = request.args.get('limit')
+    if not limit:
+        return None
+    try:
+        return int(limit)
+    except ValueError:
+        raise _ApiError('invalid_limit', "Tham số 'limit' phải là số nguyên.")
+
+def _history_response(timer, rows):
+    timer.mark('query')
+    return jsonify({"status": "ok", "count": len(rows), "results": rows, "timings_ms": timer.total()})
+
+@app.route('/api/v1/history/runs', methods=['GET'])
+@_api_endpoint
+def api_history_runs(timer):
+    """Các lần đối soát đã lưu. Lọc: chxd, date_from, date_to, quarter, limit."""
+    return _history_response(timer, reconciliation_history.runs(_history_limit(), **_history_filters()))
+
+@app.route('/api/v1/history/invoices', methods=['GET'])
+@_api_endpoint
+def api_history_invoices(timer):
+    """
+    Trạng thái đối soát từng hóa đơn (matched/mismatch/missing/extra).
+    Lọc: chxd, fkey, mst, invoice_number, status, item_name, run_id, date_from, date_to, quarter, limit.
+    """
+    filters = _history_filters('fkey', 'mst', 'invoice_number', 'status', 'item_name', 'run_id')
+    return _history_response(timer, reconciliation_history.invoices(_history_limit(), **filters))
+
+@app.route('/api/v1/history/mismatches', methods=['GET'])
+@_api_endpoint
+def api_history_mismatches(timer):
+    """
+    Các chênh lệch đã ghi nhận (kind: quantity/amount; discount_match: 0/1).
+    Ví dụ: chênh lệch chiết khấu của một MST trong quý: ?mst=...&kind=amount&discount_match=0&quarter=2025-Q3
+    """
+    filters = _history_filters('fkey', 'mst', 'invoice_number', 'kind', 'discount_match', 'item_name', 'run_id')
+    return _history_response(timer, reconciliation_history.mismatches(_history_limit(), **filters))
+
+@app.route('/api/v1/history/fkeys/<fkey>', methods=['GET'])
+@_api_endpoint
+def api_history_fkey(timer, fkey):
+    """Lịch sử của một FKEY: mọi lần xuất hiện và các cờ ever_missing/ever_extra/ever_mismatch."""
+    result = reconciliation_history.fkey_history(fkey)
+    timer.mark('query')
+    return jsonify({"status": "ok", **result, "timings_ms": timer.total()})
+
+@app.route('/api/v1/history/items', methods=['GET'])
+@_api_endpoint
+def api_history_items(timer):
+    """Tổng số lượng/thành tiền theo mặt hàng (Log Bơm và HĐĐT) trong khoảng ngày. Lọc: chxd, date_from, date_to, quarter."""
+    return _history_response(timer, reconciliation_history.item_totals(**_history_filters()))
+
+@app.route('/api/v1/discount-report', methods=['POST'])
+@_api_endpoint
+def api_discount_report(timer):
+    """
+    Tạo báo cáo chiết khấu (.xlsx) từ kết quả đối soát đã lưu (reconciliation_id trong query/JSON)
+    hoặc từ kết quả gửi lên dạng JSON (trường 'result' hoặc toàn bộ body).
+    """
+    body = request.get_json(silent=True)
+    reconciliation_id = request.args.get('reconciliation_id') or (body.get('reconciliation_id') if isinstance(body, dict) else None)
+    if reconciliation_id and not (isinstance(body, dict) and ('result' in body or 'detailed_mismatches' in body)):
+        reconciliation_data = _api_stored_reconciliation(reconciliation_id)
+    elif isinstance(body, dict):
+        reconciliation_data = body.get('result', body)
+    else:
+        raise _ApiError('invalid_json', "Cần reconciliation_id hoặc body JSON chứa kết quả đối soát.")
+    timer.mark('load')
+    discount_data = _global_static_config_data.get('discount_data', defaultdict(dict))
+    excel_buffer = _generate_discount_report_excel(reconciliation_data, discount_data)
+    timer.mark('generate')
+    response = send_file(excel_buffer, as_attachment=True, download_name='BaoCaoChietKhau.xlsx',
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return _api_timing_headers(response, timer)
+
+def _is_admin_request():
+    """Kiểm tra quyền truy cập các endpoint quản trị.
+    Nếu đặt biến môi trường ADMIN_TOKEN thì yêu cầu header X-Admin-Token hoặc tham số ?token= khớp;
+    nếu không đặt thì chỉ cho phép truy cập từ máy cục bộ."""
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if admin_token:
+        supplied = request.headers.get('X-Admin-Token') or request.args.get('token')
+        return supplied == admin_token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/admin/artifacts', methods=['GET'])
+def admin_artifacts():
+    """Số liệu sử dụng của kho tệp tạm (số tệp, dung lượng, số tệp đã hết hạn/bị loại bỏ)."""
+    if not _is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    return jsonify(artifact_manager.usage())
+
+@app.route('/admin/memory', methods=['GET'])
+def admin_memory():
+    """Bộ nhớ của worker đang phục vụ request (RSS, PSS, phần chia sẻ/riêng và mức tăng từ khi fork)."""
+    if not _is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    return jsonify(memory_report())
+
+@app.route('/admin/profiles', methods=['GET'])
+def admin_profiles():
+    """Danh sách profile đã lưu của worker/máy chủ hiện tại."""
+    if not _is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    return jsonify({"profile_dir": request_profiler.profile_dir, "profiles": request_profiler.list_profiles()})
+
+@app.route('/admin/profiles/<filename>', methods=['GET'])
+def admin_profile_download(filename):
+    """Tải một tệp profile (.pstats để mở bằng pstats/snakeviz, .folded để vẽ flame graph)."""
+    if not _is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    path = request_profiler.path_for(filename)
+    if path is None:
+        return jsonify({"status": "error", "message": "Không tìm thấy profile."}), 404
+    return send_file(path, as_attachment=True, download_name=filename, mimetype='application/octet-stream')
+
+# --- SỐ LIỆU ĐO LƯỜNG (PROMETHEUS) ---
+def _artifact_usage_metrics():
+    usage = artifact_manager.usage()
+    return {('files',): usage['files'], ('bytes',): usage['total_bytes']}
+
+def _process_memory_metrics():
+    breakdown = memory_report()
+    return {('rss',): breakdown.get('rss_bytes'), ('private',): breakdown.get('private_bytes'),
+            ('peak_rss',): breakdown.get('peak_rss_bytes')}
+
+registry.register(Gauge('upsse_artifacts', 'Kho tệp tạm: số tệp và tổng dung lượng (byte).', ('kind',),
+                        callback=_artifact_usage_metrics))
+registry.register(Gauge('upsse_process_memory_bytes', 'Bộ nhớ của worker đang phục vụ request.', ('kind',),
+                        callback=_process_memory_metrics))
+registry.register(Counter('upsse_worker_recycles_total', 'Số lần worker được tái tạo do vượt ngưỡng bộ nhớ (MEMORY_RECYCLE_RSS_MB).',
+                          ('reason',), callback=memory_watchdog.recycle_counts))
+
+@app.before_request
+def _metrics_before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+@app.before_request
+def _logging_before_request():
+    g.log_tokens = begin_log_context(request.headers.get('X-Request-Id'), endpoint=request.path)
+    g.log_started = time.perf_counter()
+    # Span gốc của request; trace_id trùng request_id nên có thể ghép log với waterfall
+    g.trace_span = open_span(f"{request.method} {request.path}", method=request.method, path=request.path)
+
+@app.after_request
+def _metrics_after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = g.pop('metrics_endpoint')
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def _logging_after_request(response):
+    g.log_status = response.status_code
+    if current_request_id():
+        response.headers['X-Request-Id'] = current_request_id()
+    return response
+
+@app.teardown_request
+def _logging_teardown_request(error=None):
+    """Một dòng log tổng kết cho mỗi request: trạng thái, thời gian, số dòng, thời gian từng bước và số cảnh báo bị lược."""
+    tokens = g.pop('log_tokens', None)
+    if tokens is None:
+        return
+    close_span(g.pop('trace_span', None), error)
+    try:
+        if request.endpoint not in ('metrics', 'static'):
+            summary = {'method': request.method, 'status': g.pop('log_status', 500),
+                       'duration_ms': round((time.perf_counter() - g.pop('log_started')) * 1000, 2),
+                       **(request_stats() or {})}
+            if error is not None:
+                logger.error("Request lỗi: %s", error, extra=summary)
+            else:
+                logger.info("Request hoàn tất.", extra=summary)
+    finally:
+        end_log_context(tokens)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Số liệu thời gian từng bước xử lý, request HTTP, kho tệp tạm và bộ nhớ theo định dạng Prometheus."""
+    if not _is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
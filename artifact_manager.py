@@ -0,0 +1,242 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+DEFAULT_TTL_SECONDS = int(os.environ.get('ARTIFACT_TTL_SECONDS', 30 * 60))
+DEFAULT_QUOTA_BYTES = int(os.environ.get('ARTIFACT_QUOTA_MB', 512)) * 1024 * 1024
+DEFAULT_SWEEP_INTERVAL = int(os.environ.get('ARTIFACT_SWEEP_INTERVAL_SECONDS', 60))
+
+# Các tiền tố tệp tạm do ứng dụng tạo ra, dùng để dọn các tệp mồ côi từ lần chạy trước
+# (hoặc do worker khác tạo ra khi chạy nhiều tiến trình)
+_MANAGED_NAME_PATTERN = re.compile(r'^(pending|processed|reconcile)_[0-9a-f]{32}\.(dat|xlsx|zip|pkl)$')
+# Tệp khóa trong base_dir: các worker kiểm tra quota lần lượt trên cùng một thư mục
+_QUOTA_LOCK_NAME = '.upsse_artifacts.lock'
+
+
+class ArtifactManager:
+    """
+    Quản lý vòng đời các tệp tạm (pending_*.dat, processed_*.xlsx/.zip, reconcile_*.pkl).
+    - Mỗi tệp được đăng ký kèm TTL, luồng nền định kỳ xóa các tệp hết hạn.
+    - Tổng dung lượng bị giới hạn bởi quota, vượt quá thì xóa tệp ít dùng nhất (LRU).
+      Quota áp dụng cho cả thư mục (mọi worker gunicorn dùng chung base_dir): dung lượng được tính bằng cách quét
+      các tệp của ứng dụng trong base_dir khi giữ khóa tệp; thời điểm truy cập (LRU) là atime của tệp.
+    - Cung cấp số liệu sử dụng qua usage().
+    """
+
+    def __init__(self, base_dir=None, ttl_seconds=DEFAULT_TTL_SECONDS, quota_bytes=DEFAULT_QUOTA_BYTES,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        self.base_dir = base_dir or tempfile.gettempdir()
+        self.ttl_seconds = ttl_seconds
+        self.quota_bytes = quota_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.RLock()
+        # Tệp do worker này tạo: path -> {'size', 'expires_at', 'last_access'}; thứ tự = thứ tự truy cập (LRU ở đầu)
+        self._registry = OrderedDict()
+        self._sweeper_thread = None
+        self._sweeper_pid = None
+        self._stats = {'registered': 0, 'expired': 0, 'evicted': 0, 'released': 0, 'orphans_removed': 0}
+
+    # --- GHI / ĐỌC TỆP ---
+    def path_for(self, prefix, artifact_id, suffix):
+        """Đường dẫn của tệp tạm ứng với một mã (uuid hex) cho trước."""
+        return os.path.join(self.base_dir, f"{prefix}_{artifact_id}{suffix}")
+
+    def write_bytes(self, data, prefix, suffix, ttl_seconds=None, artifact_id=None):
+        """Ghi dữ liệu ra một tệp tạm mới, đăng ký vào registry và trả về đường dẫn."""
+        path = self.path_for(prefix, artifact_id or uuid.uuid4().hex, suffix)
+        # Ghi ra tệp phụ rồi đổi tên để worker khác không đọc phải tệp đang ghi dở
+        tmp_path = f"{path}.part"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.register(path, ttl_seconds)
+        return path
+
+    def register(self, path, ttl_seconds=None):
+        """Đăng ký một tệp đã tồn tại để được dọn dẹp theo TTL/quota."""
+        self._ensure_sweeper()
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._registry.pop(path, None)
+            self._registry[path] = {'size': size, 'expires_at': now + ttl, 'last_access': now}
+            self._stats['registered'] += 1
+        self._enforce_quota(keep=path)
+
+    def read_bytes(self, path):
+        """Đọc nội dung tệp và đánh dấu vừa được truy cập (cập nhật LRU)."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.touch(path)
+        return data
+
+    def touch(self, path):
+        now = time.time()
+        with self._lock:
+            entry = self._registry.get(path)
+            if entry:
+                entry['last_access'] = now
+                self._registry.move_to_end(path)
+        # atime là thời điểm truy cập dùng chung giữa các worker; giữ nguyên mtime (thời điểm ghi, dùng để tính hạn)
+        try:
+            os.utime(path, (now, os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def release(self, path):
+        """Xóa tệp và gỡ khỏi registry (dùng khi người dùng đã tải xong)."""
+        with self._lock:
+            if self._registry.pop(path, None):
+                self._stats['released'] += 1
+        self._remove_file(path)
+
+    def exists(self, path):
+        return bool(path) and os.path.exists(path)
+
+    # --- DỌN DẸP ---
+    def sweep(self):
+        """Xóa các tệp đã hết hạn. Trả về số tệp đã xóa."""
+        now = time.time()
+        expired = []
+        with self._lock:
+            for path, entry in list(self._registry.items()):
+                if entry['expires_at'] <= now:
+                    self._registry.pop(path)
+                    expired.append(path)
+            self._stats['expired'] += len(expired)
+        for path in expired:
+            self._remove_file(path)
+        return len(expired)
+
+    def sweep_orphans(self):
+        """Xóa các tệp tạm của ứng dụng nằm ngoài registry và đã quá TTL (ví dụ còn sót sau khi khởi động lại)."""
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        try:
+            names = os.listdir(self.base_dir)
+        except OSError:
+            return 0
+        for name in names:
+            if not _MANAGED_NAME_PATTERN.match(name):
+                continue
+            path = os.path.join(self.base_dir, name)
+            with self._lock:
+                if path in self._registry:
+                    continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        with self._lock:
+            self._stats['orphans_removed'] += removed
+        return removed
+
+    def _scan(self):
+        """Các tệp của ứng dụng trong base_dir (của mọi worker): [(path, size, atime)]."""
+        files = []
+        try:
+            entries = os.scandir(self.base_dir)
+        except OSError:
+            return files
+        with entries:
+            for entry in entries:
+                if not _MANAGED_NAME_PATTERN.match(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_atime))
+        return files
+
+    @contextmanager
+    def _quota_lock(self):
+        with open(os.path.join(self.base_dir, _QUOTA_LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _enforce_quota(self, keep=None):
+        """Xóa các tệp ít được dùng nhất (của bất kỳ worker nào) cho tới khi tổng dung lượng thư mục nằm trong quota."""
+        evicted = []
+        with self._quota_lock():
+            files = self._scan()
+            total_bytes = sum(size for _, size, _ in files)
+            for path, size, _ in sorted(files, key=lambda file: file[2]):
+                if total_bytes <= self.quota_bytes:
+                    break
+                if path == keep:
+                    continue
+                self._remove_file(path)
+                total_bytes -= size
+                evicted.append(path)
+        with self._lock:
+            for path in evicted:
+                self._registry.pop(path, None)
+            self._stats['evicted'] += len(evicted)
+
+    def _sweeper_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+                self.sweep_orphans()
+            except Exception as e:
+                logger.warning("Lỗi khi dọn dẹp tệp tạm: %s", e)
+
+    def _ensure_sweeper(self):
+        """Khởi động luồng dọn dẹp nền (một lần cho mỗi tiến trình, kể cả sau khi fork)."""
+        pid = os.getpid()
+        if self._sweeper_pid == pid and self._sweeper_thread and self._sweeper_thread.is_alive():
+            return
+        with self._lock:
+            if self._sweeper_pid == pid and self._sweeper_thread and self._sweeper_thread.is_alive():
+                return
+            self._sweeper_thread = threading.Thread(target=self._sweeper_loop, name='artifact-sweeper', daemon=True)
+            self._sweeper_thread.start()
+            self._sweeper_pid = pid
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # --- SỐ LIỆU ---
+    def usage(self):
+        """
+        Số liệu sử dụng của kho tệp tạm: số tệp và dung lượng tính trên cả thư mục (mọi worker);
+        'worker': số lần đăng ký/hết hạn/bị loại bỏ... do worker phục vụ request thực hiện.
+        """
+        files = self._scan()
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            'files': len(files),
+            'total_bytes': sum(size for _, size, _ in files),
+            'quota_bytes': self.quota_bytes,
+            'ttl_seconds': self.ttl_seconds,
+            'worker': {'pid': os.getpid(), **stats},
+        }
+
+
+artifact_manager = ArtifactManager()
@@ -0,0 +1,201 @@
+import io
+import logging
+import os
+import csv
+import time
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from openpyxl import load_workbook
+
+from detector import detect_report_type
+from job_pool import FORKSERVER_PRELOAD
+from hddt_handler import process_hddt_report, _clean_string_hddt, _to_float_hddt
+from pos_handler import process_pos_report, _pos_clean_string
+from report_naming import _extract_report_date_for_filename, _make_base_filename
+from structured_logging import configure_logging, log_context, current_request_id, request_stats
+
+logger = logging.getLogger(__name__)
+
+# Cấu hình tĩnh được nạp một lần cho mỗi tiến trình con (qua initializer) thay vì gửi kèm từng tệp
+_worker_static_data = None
+_worker_chxd_list = None
+
+BATCH_STATUS_FILENAME = 'KetQua_XuLy.csv'
+
+
+def _init_batch_worker(static_data, chxd_list):
+    global _worker_static_data, _worker_chxd_list
+    configure_logging()
+    _worker_static_data = static_data
+    _worker_chxd_list = chxd_list
+
+
+def detect_store_for_file(file_bytes, report_type, chxd_list):
+    """
+    Tự động xác định CHXD của bảng kê dựa trên 6 ký tự cuối của ký hiệu hóa đơn.
+    - HDDT: ký hiệu ở cột T (index 19) của dòng hóa đơn đầu tiên có số lượng > 0.
+    - POS: ký hiệu ở ô B5.
+    """
+    wb = load_workbook(io.BytesIO(file_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
+    try:
+        ws = wb.active
+        symbol = ''
+        if report_type == 'HDDT':
+            for row_values in ws.iter_rows(min_row=11, max_row=110, values_only=True):
+                if _to_float_hddt(row_values[9] if len(row_values) > 9 else None) > 0:
+                    symbol = _clean_string_hddt(row_values[19] if len(row_values) > 19 else None)
+                    break
+        elif report_type == 'POS':
+            for row_values in ws.iter_rows(min_row=5, max_row=5, values_only=True):
+                symbol = _pos_clean_string(row_values[1] if len(row_values) > 1 else None)
+    finally:
+        wb.close()
+
+    if len(symbol) < 6:
+        raise ValueError("Không đọc được ký hiệu hóa đơn để xác định cửa hàng.")
+    suffix = symbol[-6:].upper()
+    matches = [x for x in chxd_list if x['symbol'] and x['symbol'][-6:].upper() == suffix]
+    if not matches:
+        raise ValueError(f"Không tìm thấy cửa hàng có ký hiệu hóa đơn '{symbol}' trong Data_HDDT.xlsx.")
+    if len(matches) > 1:
+        raise ValueError(f"Ký hiệu hóa đơn '{symbol}' khớp với nhiều cửa hàng: {', '.join(x['name'] for x in matches)}.")
+    return matches[0]
+
+
+def _resolve_ambiguous_date(options, period):
+    """Chọn ngày phù hợp với kỳ báo cáo (YYYY-MM) khi bảng kê HDDT có ngày không rõ ràng."""
+    if not period:
+        return None
+    candidates = [opt['value'] for opt in options if opt['value'].startswith(period)]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def _process_batch_item(filename, file_bytes, period=None, request_id=None):
+    """Xử lý một bảng kê trong tiến trình con. Trả về (trạng thái, [(tên tệp, nội dung)])."""
+    # Log của tiến trình con mang cùng request_id với request /process_batch đã gửi tệp
+    with log_context(request_id, batch_file=filename):
+        status, outputs = _convert_batch_item(filename, file_bytes, period)
+        log = logger.info if status['status'] == 'OK' else logger.warning
+        log("Đã xử lý tệp trong lô: %s", status['status'], extra={
+            'duration_ms': round(status['seconds'] * 1000, 2), 'message_detail': status['message'], **(request_stats() or {})})
+    return status, outputs
+
+
+def _convert_batch_item(filename, file_bytes, period=None):
+    started = time.perf_counter()
+    status = {'file': filename, 'report_type': '', 'chxd': '', 'date': '', 'status': 'OK', 'outputs': [], 'message': ''}
+    outputs = []
+    try:
+        report_type = detect_report_type(file_bytes)
+        status['report_type'] = report_type
+        if report_type not in ('HDDT', 'POS'):
+            raise ValueError("Không thể nhận diện tự động loại bảng kê.")
+
+        store = detect_store_for_file(file_bytes, report_type, _worker_chxd_list)
+        status['chxd'] = store['name']
+
+        confirmed_date = None
+        if report_type == 'POS':
+            result = process_pos_report(
+                file_content_bytes=file_bytes,
+                selected_chxd=store['name'],
+                price_periods='1',
+                new_price_invoice_number='',
+                static_data_pos=_worker_static_data['pos_config'],
+                selected_chxd_symbol=store['symbol']
+            )
+        else:
+            hddt_kwargs = dict(
+                file_content_bytes=file_bytes,
+                selected_chxd=store['name'],
+                price_periods='1',
+                new_price_invoice_number='',
+                static_data_hddt=_worker_static_data['hddt_config'],
+                selected_chxd_symbol=store['symbol']
+            )
+            result = process_hddt_report(**hddt_kwargs)
+            if isinstance(result, dict) and result.get('choice_needed'):
+                confirmed_date = _resolve_ambiguous_date(result['options'], period)
+                if not confirmed_date:
+                    raise ValueError("Ngày trong bảng kê không rõ ràng ("
+                                     + " / ".join(opt['text'] for opt in result['options'])
+                                     + "). Hãy nhập kỳ báo cáo hoặc xử lý riêng tệp này.")
+                result = process_hddt_report(confirmed_date_str=confirmed_date, **hddt_kwargs)
+
+        if not isinstance(result, io.BytesIO):
+            raise ValueError("Hàm xử lý không trả về kết quả hợp lệ.")
+
+        report_date = _extract_report_date_for_filename(file_bytes, report_type, confirmed_date)
+        status['date'] = report_date.strftime('%d/%m/%Y')
+        base_filename = _make_base_filename(store['name'], report_date)
+        outputs.append((f'{base_filename}.xlsx', result.getvalue()))
+    except Exception as e:
+        status['status'] = 'LỖI'
+        status['message'] = str(e)
+    status['seconds'] = round(time.perf_counter() - started, 3)
+    return status, outputs
+
+
+def _unique_name(name, used_names):
+    """Tránh trùng tên tệp trong zip (nhiều bảng kê cùng cửa hàng, cùng ngày)."""
+    if name not in used_names:
+        used_names.add(name)
+        return name
+    stem, ext = os.path.splitext(name)
+    index = 2
+    while f"{stem}_{index}{ext}" in used_names:
+        index += 1
+    unique = f"{stem}_{index}{ext}"
+    used_names.add(unique)
+    return unique
+
+
+def _build_status_csv(statuses):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Tệp tải lên', 'Loại bảng kê', 'CHXD', 'Ngày', 'Trạng thái', 'Tệp UpSSE', 'Thời gian (giây)', 'Ghi chú'])
+    for st in statuses:
+        writer.writerow([st['file'], st['report_type'], st['chxd'], st['date'], st['status'],
+                         '; '.join(st['outputs']), st['seconds'], st['message']])
+    # utf-8-sig để Excel mở đúng tiếng Việt
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def process_batch(files, static_data, chxd_list, period=None, max_workers=None):
+    """
+    Xử lý hàng loạt bảng kê (HDDT/POS) song song trên nhiều tiến trình.
+    files: danh sách (tên tệp, bytes). period: kỳ báo cáo 'YYYY-MM' để tự chọn ngày khi không rõ ràng.
+    Trả về (nội dung zip, danh sách trạng thái từng tệp).
+    """
+    if not files:
+        raise ValueError("Vui lòng tải lên ít nhất một file Bảng kê.")
+    if period:
+        try:
+            datetime.strptime(period, '%Y-%m')
+        except ValueError:
+            raise ValueError(f"Kỳ báo cáo '{period}' không hợp lệ, định dạng đúng là YYYY-MM.")
+
+    workers = max(1, min(len(files), max_workers or os.cpu_count() or 1))
+    # forkserver: không fork trực tiếp từ tiến trình web đang chạy nhiều luồng
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_batch_worker, initargs=(static_data, chxd_list)) as pool:
+        request_id = current_request_id()
+        futures = [pool.submit(_process_batch_item, name, data, period, request_id) for name, data in files]
+        results = [future.result() for future in futures]
+
+    zip_buffer = io.BytesIO()
+    statuses = []
+    used_names = {BATCH_STATUS_FILENAME}
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for status, outputs in results:
+            for name, content in outputs:
+                unique = _unique_name(name, used_names)
+                zipf.writestr(unique, content)
+                status['outputs'].append(unique)
+            statuses.append(status)
+        zipf.writestr(BATCH_STATUS_FILENAME, _build_status_csv(statuses))
+    return zip_buffer.getvalue(), statuses
@@ -0,0 +1,206 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from openpyxl import load_workbook
+
+from detector import detect_report_type
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# off: tắt | failures: chỉ lưu tệp bị lỗi | slow: lỗi hoặc chạy lâu hơn CAPTURE_SLOW_SECONDS | all: lưu mọi tệp
+DEFAULT_CAPTURE_MODE = os.environ.get('CAPTURE_MODE', 'off').lower()
+DEFAULT_CAPTURE_DIR = os.environ.get('CAPTURE_DIR', os.path.join(tempfile.gettempdir(), 'upsse_captures'))
+DEFAULT_CAPTURE_SLOW_SECONDS = float(os.environ.get('CAPTURE_SLOW_SECONDS', 10))
+DEFAULT_CAPTURE_MAX_COUNT = int(os.environ.get('CAPTURE_MAX_COUNT', 100))
+
+_CAPTURE_NAME_PATTERN = re.compile(r'^\d{8}T\d{6}_[a-z_]+_[0-9a-f]{12}$')
+
+# Vị trí dữ liệu khách hàng trong từng loại tệp (chỉ số cột tính từ 0, dòng dữ liệu đầu tiên tính từ 1).
+# Các cột khác (mặt hàng, số lượng, tiền, ký hiệu, số hóa đơn, ngày, FKEY...) giữ nguyên vì handler cần chúng.
+INPUT_LAYOUTS = {
+    # Bảng kê HĐĐT dùng cho UpSSE: mã KH, tên KH, địa chỉ, MST
+    'HDDT': {'data_start_row': 11, 'columns': {2: 'code', 4: 'name', 5: 'address', 6: 'tax_code'}},
+    # Bảng kê POS: mã KH, tên KH, địa chỉ, MST
+    'POS': {'data_start_row': 5, 'columns': {4: 'code', 5: 'name', 6: 'address', 7: 'tax_code'}},
+    # Bảng kê HĐĐT dùng cho đối soát: tên KH, địa chỉ, MST
+    'RECONCILE_HDDT': {'data_start_row': 11, 'columns': {3: 'name', 4: 'address', 5: 'tax_code'}},
+    # Log bơm không chứa thông tin định danh khách hàng
+    'LOG_BOM': {'data_start_row': 10, 'columns': {}},
+}
+
+# Tên khách vãng lai mà handler dựa vào để gộp dòng, phải giữ nguyên khi ẩn danh
+_PRESERVED_PHRASES = ('không lấy hóa đơn', 'bán cho người tiêu dùng')
+
+
+class _Scrambler:
+    """
+    Thay chữ/số bằng ký tự ngẫu nhiên cùng loại (giữ độ dài, chữ hoa/thường, dấu câu, khoảng trắng).
+    Cùng một giá trị luôn cho cùng một kết quả trong một lần lưu, nên việc gộp theo khách hàng không đổi;
+    khóa ngẫu nhiên của mỗi lần lưu bị bỏ đi nên không thể khôi phục giá trị gốc.
+    """
+
+    def __init__(self):
+        self._key = os.urandom(16)
+        self._cache = {}
+
+    def _rng(self, text):
+        digest = hashlib.blake2b(text.encode('utf-8'), key=self._key, digest_size=16).digest()
+        return random.Random(digest)
+
+    def scramble_text(self, value):
+        if value in self._cache:
+            return self._cache[value]
+        lowered = value.lower()
+        if any(phrase in lowered for phrase in _PRESERVED_PHRASES):
+            return value
+        rng = self._rng(value)
+        out = []
+        for ch in value:
+            if ch.isdigit():
+                out.append(str(rng.randrange(10)))
+            elif ch.isalpha():
+                letter = chr(ord('a') + rng.randrange(26))
+                out.append(letter.upper() if ch.isupper() else letter)
+            else:
+                out.append(ch)
+        scrambled = ''.join(out)
+        self._cache[value] = scrambled
+        return scrambled
+
+    def scramble_number(self, value):
+        # MST/mã KH đôi khi được lưu dạng số: đổi chữ số nhưng giữ số chữ số và kiểu dữ liệu
+        digits = str(int(value))
+        scrambled = self.scramble_text(digits)
+        if scrambled[0] == '0':
+            scrambled = '1' + scrambled[1:]
+        return int(scrambled)
+
+
+def anonymize_workbook(file_bytes, layout_name, scrambler=None):
+    """
+    Trả về nội dung tệp Excel đã ẩn danh: giữ nguyên bố cục, số dòng và mọi giá trị số,
+    chỉ thay tên khách hàng, mã KH, địa chỉ và MST trong vùng dữ liệu.
+    """
+    layout = INPUT_LAYOUTS[layout_name]
+    scrambler = scrambler or _Scrambler()
+    wb = load_workbook(io.BytesIO(file_bytes))
+    ws = wb.active
+    if layout['columns']:
+        for row in ws.iter_rows(min_row=layout['data_start_row']):
+            for col_index in layout['columns']:
+                if col_index >= len(row):
+                    continue
+                cell = row[col_index]
+                if isinstance(cell.value, str) and cell.value.strip():
+                    cell.value = scrambler.scramble_text(cell.value)
+                elif isinstance(cell.value, int) and not isinstance(cell.value, bool) and cell.value > 0:
+                    cell.value = scrambler.scramble_number(cell.value)
+    output = io.BytesIO()
+    wb.save(output)
+    wb.close()
+    return output.getvalue()
+
+
+class CaptureManager:
+    """
+    Lưu bảng kê gây lỗi/chạy chậm trên production (đã ẩn danh) cùng tham số xử lý,
+    làm kho dữ liệu cho replay.py. Việc ẩn danh và ghi tệp chạy ở luồng nền để không kéo dài request.
+    """
+
+    def __init__(self, capture_dir=DEFAULT_CAPTURE_DIR, mode=DEFAULT_CAPTURE_MODE,
+                 slow_seconds=DEFAULT_CAPTURE_SLOW_SECONDS, max_count=DEFAULT_CAPTURE_MAX_COUNT):
+        self.capture_dir = capture_dir
+        self.mode = mode
+        self.slow_seconds = slow_seconds
+        self.max_count = max_count
+        self._lock = threading.Lock()
+
+    def should_capture(self, duration_seconds, failed, forced=False):
+        if forced or self.mode == 'all':
+            return True
+        if self.mode == 'failures':
+            return failed
+        if self.mode == 'slow':
+            return failed or duration_seconds >= self.slow_seconds
+        return False
+
+    def maybe_capture(self, kind, inputs, params, duration_seconds, error=None, forced=False):
+        """
+        kind: 'upsse' hoặc 'reconcile'. inputs: {vai trò: (loại bố cục, bytes)}, bố cục None = tự nhận diện.
+        Trả về mã capture nếu tệp được lưu, None nếu không.
+        """
+        if not self.should_capture(duration_seconds, error is not None, forced):
+            return None
+        capture_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{kind}_{uuid.uuid4().hex[:12]}"
+        meta = {
+            'capture_id': capture_id,
+            'kind': kind,
+            'params': params,
+            'inputs': {role: {'layout': layout, 'file': f'input_{role}.xlsx', 'size_bytes': len(data)}
+                       for role, (layout, data) in inputs.items()},
+            'production': {
+                'duration_ms': round(duration_seconds * 1000, 2),
+                'status': 'error' if error is not None else 'ok',
+                'error': str(error) if error is not None else None,
+                'captured_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+        }
+        threading.Thread(target=self._write_capture, args=(capture_id, inputs, meta),
+                         name='input-capture', daemon=True).start()
+        return capture_id
+
+    def _write_capture(self, capture_id, inputs, meta):
+        target_dir = os.path.join(self.capture_dir, capture_id)
+        tmp_dir = f"{target_dir}.part"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            # Dùng chung bộ ẩn danh cho các tệp của cùng một lần xử lý (giữ liên kết giữa Log bơm và HĐĐT)
+            scrambler = _Scrambler()
+            for role, (layout, data) in inputs.items():
+                if layout is None:
+                    layout = detect_report_type(data)
+                    meta['inputs'][role]['layout'] = layout
+                if layout not in INPUT_LAYOUTS:
+                    raise ValueError(f"Không xác định được bố cục của tệp '{role}' để ẩn danh.")
+                with open(os.path.join(tmp_dir, meta['inputs'][role]['file']), 'wb') as f:
+                    f.write(anonymize_workbook(data, layout, scrambler))
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2, default=str)
+            os.replace(tmp_dir, target_dir)
+            logger.info("Đã lưu bảng kê (ẩn danh) để replay.", extra={'capture_id': capture_id})
+        except Exception as e:
+            # Tệp không mở được bằng openpyxl (tệp hỏng...) thì không lưu: không bao giờ lưu bản gốc chưa ẩn danh
+            logger.warning("Không lưu được bảng kê để replay: %s", e, extra={'capture_id': capture_id})
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.enforce_retention()
+
+    def list_captures(self, capture_dir=None):
+        """Các thư mục capture hợp lệ, cũ nhất trước."""
+        capture_dir = capture_dir or self.capture_dir
+        try:
+            names = os.listdir(capture_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(capture_dir, name) for name in names
+                      if _CAPTURE_NAME_PATTERN.match(name) and os.path.isfile(os.path.join(capture_dir, name, 'meta.json')))
+
+    def enforce_retention(self):
+        with self._lock:
+            captures = self.list_captures()
+            for path in captures[:max(0, len(captures) - self.max_count)]:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+capture_manager = CaptureManager()
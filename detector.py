@@ -1,5 +1,6 @@
 import io
 from openpyxl import load_workbook
+from metrics import stage_timer
 
 def detect_report_type(file_content_bytes):
     """
@@ -7,6 +8,10 @@ def detect_report_type(file_content_bytes):
     - Bảng kê POS có chữ "Seri" ở ô B4.
     - Bảng kê HDDT có chữ "số công văn (số tham chiếu)" ở dòng 9.
     """
+    with stage_timer('upsse', 'detect_report_type'):
+        return _detect_report_type(file_content_bytes)
+
+def _detect_report_type(file_content_bytes):
     try:
         wb = load_workbook(io.BytesIO(file_content_bytes), data_only=True)
         ws = wb.active
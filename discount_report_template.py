@@ -0,0 +1,289 @@
+import io
+import os
+import posixpath
+import re
+import threading
+import zipfile
+from xml.sax.saxutils import escape
+
+from openpyxl.utils import get_column_letter, range_boundaries
+
+# --- GHI BÁO CÁO CHIẾT KHẤU THEO MẪU, KHÔNG QUA OPENPYXL ---
+# openpyxl phải đọc toàn bộ file mẫu ở mỗi request, tạo đối tượng cho từng ô và làm mất các phần nó không hiểu
+# (slicer, slicer cache). Ở đây file mẫu (.xlsx là một tệp zip các phần XML) được phân tích một lần và giữ trong bộ nhớ:
+# các phần không đổi (slicer, theme, bảng...) được chép nguyên; sheet dữ liệu được ghép từ phần đầu cố định
+# (dòng tiêu đề 1-10), các dòng dữ liệu sinh trực tiếp dạng XML với style dùng chung đã thêm sẵn vào styles.xml,
+# và phần cuối cố định. Phạm vi Table (và autoFilter) được kéo giãn theo số dòng dữ liệu.
+
+_NS_RELATIONSHIP = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_TABLE_REL_TYPE = f'{_NS_RELATIONSHIP}/table'
+_CALC_CHAIN_REL_TYPE = f'{_NS_RELATIONSHIP}/calcChain'
+
+_ROW_PATTERN = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+_XF_PATTERN = re.compile(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', re.S)
+_RELATIONSHIP_PATTERN = re.compile(r'<Relationship\b[^>]*/?>')
+# Ký tự điều khiển không hợp lệ trong XML
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Dòng dữ liệu bắt đầu từ dòng 11 (dòng 10 là tiêu đề bảng trong mẫu)
+DATA_START_ROW = 11
+# Định dạng số dựng sẵn của Excel: 3 = '#,##0', 4 = '#,##0.00'
+_NUMBER_FORMAT_IDS = {'#,##0': 3, '#,##0.00': 4}
+
+
+def _attribute(tag, name):
+    match = re.search(rf'\s{name}="([^"]*)"', tag)
+    return match.group(1) if match else None
+
+
+def _set_attribute(tag, name, value):
+    """Đặt thuộc tính của thẻ mở (ghi đè nếu đã có)."""
+    if re.search(rf'\s{name}="[^"]*"', tag):
+        return re.sub(rf'(\s{name}=)"[^"]*"', rf'\g<1>"{value}"', tag, count=1)
+    return re.sub(r'^(<[\w:]+)', rf'\g<1> {name}="{value}"', tag, count=1)
+
+
+def _relationships(xml):
+    return [(_attribute(tag, 'Id'), _attribute(tag, 'Type'), _attribute(tag, 'Target'))
+            for tag in _RELATIONSHIP_PATTERN.findall(xml)]
+
+
+def _resolve_target(base_part, target):
+    """Đường dẫn phần được tham chiếu trong zip (Target có thể tuyệt đối '/xl/...' hoặc tương đối với phần gốc)."""
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
+
+
+def _rels_path(part):
+    return posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+
+
+def _text(value):
+    return escape(_INVALID_XML_CHARS.sub('', str(value)))
+
+
+def _inline_string_cell(reference, style, value):
+    return f'<c r="{reference}" s="{style}" t="inlineStr"><is><t xml:space="preserve">{_text(value)}</t></is></c>'
+
+
+class _PreparedTemplate:
+    """
+    Các phần của file mẫu đã phân tích sẵn: phần zip chép nguyên, sheet dữ liệu (đầu/cuối cố định và hai dòng
+    tiêu đề A4/A5 cần thay nội dung), Table và các style dùng chung đã thêm vào styles.xml.
+    """
+
+    def __init__(self, template_bytes, column_number_formats, data_font, header_font):
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as source:
+            self.parts = {info.filename: source.read(info.filename) for info in source.infolist()}
+        self.part_order = list(self.parts)
+
+        workbook_xml = self.parts['xl/workbook.xml'].decode('utf-8')
+        workbook_rels = _relationships(self.parts['xl/_rels/workbook.xml.rels'].decode('utf-8'))
+        active_tab = int(_attribute(re.search(r'<workbookView\b[^>]*>', workbook_xml).group(0), 'activeTab') or 0) \
+            if '<workbookView' in workbook_xml else 0
+        sheet_tags = re.findall(r'<sheet\b[^>]*/?>', workbook_xml)
+        sheet_rel_id = _attribute(sheet_tags[min(active_tab, len(sheet_tags) - 1)], 'r:id')
+        self.sheet_part = next(_resolve_target('xl/workbook.xml', target) for rel_id, _, target in workbook_rels
+                               if rel_id == sheet_rel_id)
+        self._drop_calc_chain(workbook_rels)
+
+        # Table của sheet dữ liệu (nếu có): phạm vi được kéo giãn theo số dòng
+        self.table_part = None
+        sheet_rels_part = _rels_path(self.sheet_part)
+        if sheet_rels_part in self.parts:
+            self.table_part = next((_resolve_target(self.sheet_part, target) for _, rel_type, target
+                                    in _relationships(self.parts[sheet_rels_part].decode('utf-8'))
+                                    if rel_type == _TABLE_REL_TYPE), None)
+        if self.table_part:
+            self.table_xml = self.parts[self.table_part].decode('utf-8')
+            min_col, min_row, max_col, _ = range_boundaries(_attribute(re.search(r'<table\b[^>]*>', self.table_xml).group(0), 'ref'))
+            self.table_columns = (get_column_letter(min_col), min_row, get_column_letter(max_col))
+
+        self._prepare_styles(column_number_formats, data_font, header_font)
+        self._prepare_sheet()
+        # Style của ô A4/A5 được thêm khi phân tích sheet: ghi styles.xml sau cùng
+        self.parts['xl/styles.xml'] = (
+            self._styles_prefix.replace(self._xfs_open, _set_attribute(
+                self._xfs_open, 'count', len(self._cell_xfs) + len(self._new_xfs)), 1)
+            + ''.join(self._new_xfs) + self._styles_suffix).encode('utf-8')
+
+    def _drop_calc_chain(self, workbook_rels):
+        """Chuỗi tính toán tham chiếu cả các ô đã xóa: bỏ đi để Excel tự dựng lại khi mở."""
+        for rel_id, rel_type, target in workbook_rels:
+            if rel_type != _CALC_CHAIN_REL_TYPE:
+                continue
+            part = _resolve_target('xl/workbook.xml', target)
+            self.parts.pop(part, None)
+            rels_xml = self.parts['xl/_rels/workbook.xml.rels'].decode('utf-8')
+            rels_xml = re.sub(rf'<Relationship\b[^>]*\sId="{rel_id}"[^>]*/?>', '', rels_xml)
+            self.parts['xl/_rels/workbook.xml.rels'] = rels_xml.encode('utf-8')
+            content_types = self.parts['[Content_Types].xml'].decode('utf-8')
+            content_types = re.sub(rf'<Override\b[^>]*PartName="/{re.escape(part)}"[^>]*/?>', '', content_types)
+            self.parts['[Content_Types].xml'] = content_types.encode('utf-8')
+        self.part_order = [name for name in self.part_order if name in self.parts]
+
+    def _prepare_styles(self, column_number_formats, data_font, header_font):
+        """Thêm một lần các font và định dạng ô dùng chung (dữ liệu theo cột, tiêu đề A4/A5) vào styles.xml."""
+        styles_xml = self.parts['xl/styles.xml'].decode('utf-8')
+        fonts_open = re.search(r'<fonts\b[^>]*>', styles_xml)
+        font_count = len(re.findall(r'<font\b', styles_xml[fonts_open.end():styles_xml.index('</fonts>')]))
+        data_font_id, header_font_id = font_count, font_count + 1
+        styles_xml = styles_xml.replace('</fonts>', data_font + header_font + '</fonts>', 1)
+        styles_xml = styles_xml.replace(fonts_open.group(0), _set_attribute(fonts_open.group(0), 'count', font_count + 2), 1)
+
+        xfs_open = re.search(r'<cellXfs\b[^>]*>', styles_xml)
+        xfs_end = styles_xml.index('</cellXfs>')
+        self._cell_xfs = _XF_PATTERN.findall(styles_xml[xfs_open.end():xfs_end])
+        new_xfs = []
+        self.column_styles = []
+        for number_format in column_number_formats:
+            self.column_styles.append(len(self._cell_xfs) + len(new_xfs))
+            new_xfs.append(f'<xf numFmtId="{_NUMBER_FORMAT_IDS.get(number_format, 0)}" fontId="{data_font_id}" fillId="0" '
+                           f'borderId="0" xfId="0" applyFont="1" applyNumberFormat="1"/>')
+        self._header_font_id = header_font_id
+        self._styles_prefix = styles_xml[:xfs_end]
+        self._styles_suffix = styles_xml[xfs_end:]
+        self._new_xfs = new_xfs
+        self._xfs_open = xfs_open.group(0)
+
+    def _header_style(self, existing_style):
+        """Style của ô A4/A5: giữ nguyên style sẵn có của ô trong mẫu (viền, căn lề...) và chỉ đổi font."""
+        base = self._cell_xfs[int(existing_style)] if existing_style and int(existing_style) < len(self._cell_xfs) \
+            else '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        open_tag = re.match(r'<xf\b[^>]*?(?=/?>)', base).group(0)
+        cloned = base.replace(open_tag, _set_attribute(_set_attribute(open_tag, 'fontId', self._header_font_id),
+                                                       'applyFont', 1), 1)
+        index = len(self._cell_xfs) + len(self._new_xfs)
+        self._new_xfs.append(cloned)
+        return index
+
+    def _prepare_sheet(self):
+        sheet_xml = self.parts[self.sheet_part].decode('utf-8')
+        if '<sheetData/>' in sheet_xml:
+            sheet_xml = sheet_xml.replace('<sheetData/>', '<sheetData></sheetData>', 1)
+        data_open = sheet_xml.index('<sheetData>') + len('<sheetData>')
+        data_close = sheet_xml.index('</sheetData>')
+        # Thẻ <dimension> (phạm vi đã dùng của sheet) được ghi lại theo số dòng dữ liệu
+        self._sheet_prefix = re.sub(r'<dimension\b[^>]*/>', '', sheet_xml[:data_open], count=1)
+        dimension_at = sheet_xml.find('<sheetView')
+        if '<dimension' in sheet_xml[:data_open]:
+            dimension_at = sheet_xml.index('<dimension')
+        elif dimension_at < 0:
+            dimension_at = self._sheet_prefix.index('<sheetData>')
+        self._dimension_at = dimension_at
+        self._sheet_suffix = sheet_xml[data_close:]
+
+        # Giữ các dòng tiêu đề (trước dòng dữ liệu); các dòng từ dòng 11 trở đi của mẫu bị bỏ (như xóa dòng)
+        header_rows = {}
+        for row_xml in _ROW_PATTERN.findall(sheet_xml[data_open:data_close]):
+            row_number = int(_attribute(row_xml[:row_xml.index('>') + 1], 'r'))
+            if row_number < DATA_START_ROW:
+                header_rows[row_number] = row_xml
+        self._header_rows = []
+        self._header_slots = {}
+        for row_number in sorted(set(header_rows) | {4, 5}):
+            row_xml = header_rows.get(row_number, f'<row r="{row_number}"/>')
+            if row_number in (4, 5):
+                reference = f'A{row_number}'
+                cell = re.search(rf'<c r="{reference}"(?:\s[^>]*?)?(?:/>|>.*?</c>)', row_xml, re.S)
+                style = self._header_style(_attribute(cell.group(0).split('>', 1)[0], 's') if cell else None)
+                if cell:
+                    row_xml = row_xml.replace(cell.group(0), '', 1)
+                if row_xml.endswith('/>'):
+                    row_xml = row_xml[:-2] + '></row>'
+                open_end = row_xml.index('>') + 1
+                # Ô A luôn đứng đầu dòng; nội dung được điền khi ghi báo cáo
+                self._header_slots[row_number] = (row_xml[:open_end], reference, style, row_xml[open_end:])
+                self._header_rows.append(row_number)
+            else:
+                self._header_rows.append(row_xml)
+
+    def sheet_chunks(self, header_texts, rows):
+        """Sinh nội dung sheet dữ liệu theo từng đoạn (không dựng đối tượng cho từng ô)."""
+        yield self._sheet_prefix[:self._dimension_at]
+        yield f'<dimension ref="A1:{self.last_column}{DATA_START_ROW - 1 + len(rows)}"/>'
+        yield self._sheet_prefix[self._dimension_at:]
+        for header_row in self._header_rows:
+            if isinstance(header_row, int):
+                open_tag, reference, style, rest = self._header_slots[header_row]
+                yield open_tag + _inline_string_cell(reference, style, header_texts[header_row]) + rest
+            else:
+                yield header_row
+        letters = [get_column_letter(index) for index in range(1, len(self.column_styles) + 1)]
+        styles = self.column_styles
+        for row_number, values in enumerate(rows, start=DATA_START_ROW):
+            cells = []
+            for letter, style, value in zip(letters, styles, values):
+                if value is None or value == '':
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    cells.append(f'<c r="{letter}{row_number}" s="{style}"><v>{value!r}</v></c>')
+                else:
+                    cells.append(_inline_string_cell(f'{letter}{row_number}', style, value))
+            yield f'<row r="{row_number}">{"".join(cells)}</row>'
+        yield self._sheet_suffix
+
+    @property
+    def last_column(self):
+        return self.table_columns[2] if self.table_part else get_column_letter(len(self.column_styles))
+
+    def table_with_rows(self, row_count):
+        """XML của Table với phạm vi (và autoFilter) kéo tới dòng dữ liệu cuối; Table cần ít nhất một dòng dữ liệu."""
+        first_column, header_row, last_column = self.table_columns
+        ref = f'{first_column}{header_row}:{last_column}{max(DATA_START_ROW - 1 + row_count, header_row + 1)}'
+        table_xml = re.sub(r'(<table\b[^>]*?\sref=)"[^"]*"', rf'\g<1>"{ref}"', self.table_xml, count=1)
+        return re.sub(r'(<autoFilter\b[^>]*?\sref=)"[^"]*"', rf'\g<1>"{ref}"', table_xml, count=1)
+
+
+class DiscountReportTemplate:
+    """
+    Bộ nhớ đệm file mẫu báo cáo chiết khấu: mẫu được phân tích lại chỉ khi tệp trên đĩa thay đổi (mtime/kích thước).
+    column_number_formats: định dạng số của từng cột dữ liệu ('' = chung); data_font/header_font: XML <font> dùng chung.
+    """
+
+    def __init__(self, column_number_formats, data_font, header_font):
+        self.column_number_formats = tuple(column_number_formats)
+        self.data_font = data_font
+        self.header_font = header_font
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _prepared(self, template_path):
+        stat = os.stat(template_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(template_path)
+            if cached and cached[0] == signature:
+                return cached[1]
+            with open(template_path, 'rb') as f:
+                prepared = _PreparedTemplate(f.read(), self.column_number_formats, self.data_font, self.header_font)
+            self._cache[template_path] = (signature, prepared)
+            return prepared
+
+    def render(self, template_path, header_texts, rows):
+        """
+        Ghi báo cáo: header_texts = {4: nội dung A4, 5: nội dung A5}; rows: danh sách giá trị từng dòng dữ liệu
+        (từ dòng 11). Trả về BytesIO của file .xlsx.
+        """
+        prepared = self._prepared(template_path)
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+            for name in prepared.part_order:
+                if name == prepared.sheet_part:
+                    with target.open(name, 'w') as sheet:
+                        for chunk in prepared.sheet_chunks(header_texts, rows):
+                            sheet.write(chunk.encode('utf-8'))
+                elif name == prepared.table_part:
+                    target.writestr(name, prepared.table_with_rows(len(rows)))
+                else:
+                    target.writestr(name, prepared.parts[name])
+        output.seek(0)
+        return output
+
+
+# Cột dữ liệu: STT, Tên khách hàng, MST, Số hóa đơn, Ký hiệu, Ngày, Mặt hàng, Số lượng, Đơn giá chiết khấu, Tiền chiết khấu
+discount_report_template = DiscountReportTemplate(
+    column_number_formats=('', '', '', '', '', '', '', '#,##0.00', '#,##0', '#,##0'),
+    data_font='<font><sz val="10"/><name val="Times New Roman"/></font>',
+    header_font='<font><b/><sz val="12"/><name val="Times New Roman"/></font>')
@@ -1,11 +1,20 @@
 import io
+import logging
 import re
 from collections import defaultdict
 from datetime import datetime
 import pandas as pd
-from openpyxl import load_workbook, Workbook 
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment # Import thêm các style
+from openpyxl import load_workbook
+from metrics import StageTimer, count_rows
+from structured_logging import warn_row, bind_log_context
+from memory_profiling import memory_tracked
+from tracing import traced, current_span
+from job_pool import run_jobs_parallel
+from reconcile_join import sort_merge_join
+from reconcile_candidates import suggest_candidates
+from reconcile_incremental import incremental_reconciler
+from discount_report_template import discount_report_template
+from reconcile_three_way import three_way_join
 # openpyxl.drawing.image và openpyxl.utils.cell không còn cần thiết
 # from openpyxl.drawing.image import Image as OpenpyxlImage 
 # from openpyxl.utils.cell import coordinate_to_tuple 
@@ -13,6 +22,8 @@ from openpyxl.styles import Font, PatternFill, Border, Side, Alignment # Import
 # xlsxwriter không còn sử dụng cho hàm này
 # import xlsxwriter 
 
+logger = logging.getLogger(__name__)
+
 # --- CÁC HÀM TIỆN ÍCH ---
 def _clean_string(s):
     """Làm sạch chuỗi, loại bỏ khoảng trắng thừa và ký tự '."""
@@ -97,141 +108,200 @@ def _load_discount_data(discount_file_bytes):
                                 discount_amount_per_unit = _to_float(discount_amount_raw)
                                 discount_map[mst_khach_hang][product_name] = discount_amount_per_unit
                             except Exception as e:
-                                print(f"Cảnh báo: Bỏ qua giá trị chiết khấu lỗi tại dòng {row_index}, cột {chr(68+i)}: {e} - Dữ liệu: '{discount_amount_raw}'")
+                                warn_row(logger, 'discount.invalid_value', "Bỏ qua giá trị chiết khấu lỗi tại dòng %s, cột %s: %s - Dữ liệu: '%s'",
+                                         row_index, chr(68 + i), e, discount_amount_raw)
         wb.close()
     except FileNotFoundError:
-        print("Cảnh báo: Không tìm thấy file 'ChietKhau.xlsx'. Chức năng chiết khấu sẽ không hoạt động.")
+        logger.warning("Không tìm thấy file 'ChietKhau.xlsx'. Chức năng chiết khấu sẽ không hoạt động.")
         return defaultdict(dict) # Trả về map rỗng nếu file không tồn tại
     except Exception as e:
-        print(f"Lỗi khi tải file chiết khấu 'ChietKhau.xlsx': {e}")
+        logger.error("Lỗi khi tải file chiết khấu 'ChietKhau.xlsx': %s", e)
         # Trả về map rỗng nếu có lỗi để chương trình vẫn chạy
         return defaultdict(dict) 
     return discount_map
 
-def _parse_hddt_file(hddt_bytes):
-    """Phân tích dữ liệu từ file Bảng kê HĐĐT."""
+def _iter_hddt_invoices(ws, expected_invoice_symbol_suffix):
+    """
+    Duyệt Bảng kê HĐĐT một lần duy nhất từ dòng 11: vừa xác thực ký hiệu hóa đơn (cột S) của từng dòng hóa đơn,
+    vừa trả về dữ liệu hóa đơn đã xác thực. Lỗi ký hiệu được báo ngay tại dòng gặp lỗi.
+    """
+    for row_index, row_values in enumerate(ws.iter_rows(min_row=11, values_only=True), start=11):
+        quantity = _to_float(row_values[8] if len(row_values) > 8 else None)
+        if quantity <= 0:
+            continue # Bỏ qua các dòng không có số lượng hoặc số lượng <= 0 (dòng tiêu đề, chân trang, dòng tổng)
+
+        # Xác thực ký hiệu hóa đơn từ cột S (index 18): 6 ký tự cuối phải khớp với cấu hình của CHXD
+        if len(row_values) <= 18 or row_values[18] is None:
+            raise ValueError(f"Hóa đơn tại dòng {row_index} của bảng kê HDDT thiếu ký hiệu hóa đơn (cột S).")
+        invoice_symbol_hddt = _clean_string(row_values[18])
+        if len(invoice_symbol_hddt) < 6:
+            raise ValueError(f"Ký hiệu hóa đơn tại dòng {row_index} của bảng kê HDDT quá ngắn để xác thực.")
+        if invoice_symbol_hddt[-6:].upper() != expected_invoice_symbol_suffix:
+            raise ValueError("Bảng kê hddt không phải của cửa hàng bạn chọn.")
+
+        yield {
+            'fkey': _clean_string(row_values[24] if len(row_values) > 24 else None),
+            'item_name': _clean_string(row_values[6] if len(row_values) > 6 else None),
+            'quantity': quantity,
+            'total_amount': _to_float(row_values[16] if len(row_values) > 16 else None),
+            'invoice_number': _clean_string(row_values[19] if len(row_values) > 19 else None),
+            'invoice_date_raw': row_values[20] if len(row_values) > 20 else None,
+            'invoice_symbol_hddt': invoice_symbol_hddt,
+            'mst_khach_hang': _clean_string(row_values[5] if len(row_values) > 5 else None), # Cột F: Mã số Thuế
+            'unit_price': _to_float(row_values[9] if len(row_values) > 9 else None),        # Cột J: Đơn giá
+            'customer_name': _clean_string(row_values[3] if len(row_values) > 3 else None), # Cột D: Tên khách hàng
+            'source_row': row_index
+        }
+
+@traced('reconcile.parse_hddt')
+def _parse_hddt_file(hddt_bytes, invoice_symbol_from_config):
+    """
+    Phân tích dữ liệu từ file Bảng kê HĐĐT, đồng thời xác thực ký hiệu hóa đơn trong cùng một lượt đọc.
+    Lỗi xác thực được giữ nguyên thông báo; lỗi đọc file được bọc lại.
+    """
+    # Lấy 6 ký tự cuối của ký hiệu hóa đơn từ file cấu hình
+    # Đảm bảo ký hiệu từ config đủ dài để cắt
+    if len(invoice_symbol_from_config) < 6:
+        raise ValueError(f"Ký hiệu hóa đơn trong file cấu hình Data_HDDT.xlsx ('{invoice_symbol_from_config}') quá ngắn để xác thực.")
+    expected_invoice_symbol_suffix = invoice_symbol_from_config[-6:].upper()
+
+    PETROLEUM_PRODUCTS = [
+        'Xăng RON 95-III', 'Dầu DO 0,05S-II', 
+        'Xăng E5 RON 92-II', 'Dầu DO 0,001S-V'
+    ]
+
+    pos_invoices = []
+    direct_petroleum_invoices = []
+    other_invoices = []
     try:
         # Tối ưu hóa: Chỉ đọc dữ liệu, bỏ qua định dạng, VBA, và liên kết
         wb = load_workbook(io.BytesIO(hddt_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
-        ws = wb.active
-        
-        pos_invoices = []
-        direct_petroleum_invoices = []
-        other_invoices = []
-
-        PETROLEUM_PRODUCTS = [
-            'Xăng RON 95-III', 'Dầu DO 0,05S-II', 
-            'Xăng E5 RON 92-II', 'Dầu DO 0,001S-V'
-        ]
-        
-        for row_index, row_values in enumerate(ws.iter_rows(min_row=11, values_only=True), start=11):
-            quantity = _to_float(row_values[8] if len(row_values) > 8 else None)
-            if quantity <= 0:
-                continue # Bỏ qua các dòng không có số lượng hoặc số lượng <= 0 (bao gồm dòng tổng)
-
-            fkey = _clean_string(row_values[24] if len(row_values) > 24 else None)
-            item_name = _clean_string(row_values[6] if len(row_values) > 6 else None)
-            
-            # Bổ sung trích xuất Mã số Thuế (cột F - index 5) và Đơn giá (cột J - index 9)
-            mst_khach_hang = _clean_string(row_values[5] if len(row_values) > 5 else None)
-            unit_price = _to_float(row_values[9] if len(row_values) > 9 else None)
-            customer_name = _clean_string(row_values[3] if len(row_values) > 3 else None) # Cột D: Tên khách hàng
-
-            invoice_data = {
-                'fkey': fkey,
-                'item_name': item_name,
-                'quantity': quantity,
-                'total_amount': _to_float(row_values[16] if len(row_values) > 16 else None),
-                'invoice_number': _clean_string(row_values[19] if len(row_values) > 19 else None),
-                'invoice_date_raw': row_values[20] if len(row_values) > 20 else None,
-                'invoice_symbol_hddt': _clean_string(row_values[18] if len(row_values) > 18 else None), # Lấy ký hiệu hóa đơn từ cột S (index 18)
-                'mst_khach_hang': mst_khach_hang, # Thêm MST khách hàng
-                'unit_price': unit_price,         # Thêm đơn giá
-                'customer_name': customer_name,   # Thêm Tên khách hàng
-                'source_row': row_index
-            }
-
+    except Exception as e:
+        raise ValueError(f"Lỗi khi đọc file Bảng kê HĐĐT: {e}")
+    try:
+        for invoice_data in _iter_hddt_invoices(wb.active, expected_invoice_symbol_suffix):
+            fkey = invoice_data['fkey']
             if fkey and fkey.upper().startswith('POS'):
                 pos_invoices.append(invoice_data)
+            elif invoice_data['item_name'] in PETROLEUM_PRODUCTS:
+                direct_petroleum_invoices.append(invoice_data)
             else:
-                if item_name in PETROLEUM_PRODUCTS:
-                    direct_petroleum_invoices.append(invoice_data)
-                else:
-                    other_invoices.append(invoice_data)
-        
-        wb.close() # Đảm bảo đóng workbook sau khi đọc
-        return {
-            'pos_invoices': pos_invoices,
-            'direct_petroleum_invoices': direct_petroleum_invoices,
-            'other_invoices': other_invoices
-        }
+                other_invoices.append(invoice_data)
+    except ValueError:
+        raise
     except Exception as e:
         raise ValueError(f"Lỗi khi đọc file Bảng kê HĐĐT: {e}")
-
-def _parse_log_bom_file(log_bom_bytes):
-    """Phân tích dữ liệu từ file Log Bơm (POS)."""
+    finally:
+        wb.close() # Đảm bảo đóng workbook sau khi đọc (kể cả khi xác thực lỗi giữa chừng)
+
+    # Không có dòng hóa đơn nào (số lượng > 0) để xác thực ký hiệu
+    if not (pos_invoices or direct_petroleum_invoices or other_invoices):
+        raise ValueError("Không tìm thấy hóa đơn hợp lệ nào trong file Bảng kê HDDT để xác thực ký hiệu.")
+
+    current_span().set_attributes(pos_invoices=len(pos_invoices), direct_petroleum_invoices=len(direct_petroleum_invoices),
+                                  other_invoices=len(other_invoices))
+    return {
+        'pos_invoices': pos_invoices,
+        'direct_petroleum_invoices': direct_petroleum_invoices,
+        'other_invoices': other_invoices
+    }
+
+# Các loại giao dịch cần xuất hóa đơn
+VALID_TRANSACTION_TYPES = frozenset(['bán lẻ', 'hợp đồng', 'khuyến mãi', 'trả trước'])
+
+def _format_log_date(transaction_date_raw, date_cache):
+    """Định dạng ngày giao dịch thành dd/mm/yyyy; giao dịch cùng ngày dùng lại chuỗi đã định dạng."""
+    if isinstance(transaction_date_raw, datetime):
+        key = (transaction_date_raw.year, transaction_date_raw.month, transaction_date_raw.day)
+    else:
+        key = transaction_date_raw
+    try:
+        return date_cache[key]
+    except KeyError:
+        pass
+    except TypeError: # Giá trị không băm được, không cache
+        key = None
+    transaction_date_dt = _excel_date_to_datetime(transaction_date_raw)
+    transaction_date_str = transaction_date_dt.strftime('%d/%m/%Y') if transaction_date_dt else 'N/A'
+    if key is not None:
+        date_cache[key] = transaction_date_str
+    return transaction_date_str
+
+@traced('reconcile.parse_log_bom')
+def _parse_log_bom_file(log_bom_bytes, selected_chxd_name):
+    """
+    Phân tích dữ liệu từ file Log Bơm (POS) trong một lượt đọc: ô A2 (tên CHXD) được xác thực khi đi qua,
+    sau đó các dòng giao dịch từ dòng 10 được lọc loại giao dịch, kiểm tra FKEY và định dạng ngày ngay khi đọc.
+    """
     try:
         # Tối ưu hóa: Chỉ đọc dữ liệu, bỏ qua định dạng, VBA, và liên kết
         wb = load_workbook(io.BytesIO(log_bom_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
-        ws = wb.active
-        
-        pump_logs = []
-        # Các loại giao dịch cần xuất hóa đơn
-        VALID_TRANSACTION_TYPES = ['bán lẻ', 'hợp đồng', 'khuyến mãi', 'trả trước']
-        
-        for row_index, row_values in enumerate(ws.iter_rows(min_row=10, values_only=True), start=10):
-            transaction_type = _clean_string(row_values[7] if len(row_values) > 7 else None)
-            
-            # Kiểm tra xem loại giao dịch có nằm trong danh sách hợp lệ không
-            if transaction_type.lower() not in VALID_TRANSACTION_TYPES:
-                continue
-
-            fkey = _clean_string(row_values[14] if len(row_values) > 14 else None)
-            if not fkey:
-                raise ValueError(
-                    f"Lỗi nghiêm trọng tại dòng {row_index} của file Log Bơm: "
-                    f"Giao dịch '{transaction_type}' bắt buộc phải có mã H.Đơn (FKEY) ở cột O nhưng lại bị trống."
-                )
-
-            item_name = _clean_string(row_values[3] if len(row_values) > 3 else None)
-            quantity = _to_float(row_values[4] if len(row_values) > 4 else None)
-            total_amount = _to_float(row_values[6] if len(row_values) > 6 else None)
-            
-            # Lấy dữ liệu ngày tháng từ cột B (index 1) của bảng kê POS
-            transaction_date_raw = row_values[1] if len(row_values) > 1 else None
-            transaction_date_dt = _excel_date_to_datetime(transaction_date_raw)
-            # Chuyển đổi về định dạng dd/mm/yyyy
-            transaction_date_str = transaction_date_dt.strftime('%d/%m/%Y') if transaction_date_dt else 'N/A'
-
-            pump_logs.append({
-                'fkey': fkey,
-                'item_name': item_name,
-                'quantity': quantity,
-                'total_amount': total_amount,
-                'source_row': row_index,
-                'transaction_date': transaction_date_str # Lưu ngày tháng đã định dạng từ POS
-            })
-            
-        if not pump_logs:
-            raise ValueError("Không tìm thấy giao dịch nào cần xuất hóa đơn trong file Log Bơm.")
-        
-        wb.close() # Đảm bảo đóng workbook sau khi đọc
-        return pump_logs
     except Exception as e:
         raise ValueError(f"Lỗi khi đọc file Log Bơm: {e}")
+    try:
+        # Chỉ cần tới cột O (FKEY): bỏ qua các cột phía sau khi đọc
+        rows = wb.active.iter_rows(min_row=1, max_col=15, values_only=True)
+
+        # --- XÁC THỰC CHXD: ô A2 (có thể là merged cell A-B-C-D-E2) nằm trong phần tiêu đề (dòng 1-9) ---
+        header_rows = [row_values for _, row_values in zip(range(9), rows)]
+        pos_chxd_cell_value = header_rows[1][0] if len(header_rows) > 1 and header_rows[1] else None
+        if pos_chxd_cell_value:
+            # Loại bỏ "CHXD " và làm sạch chuỗi để so sánh
+            pos_chxd_name_extracted = _clean_string(str(pos_chxd_cell_value).replace("CHXD ", ""))
+            if pos_chxd_name_extracted.lower() != selected_chxd_name.lower():
+                raise ValueError("Bảng kê log bơm không phải của cửa hàng bạn chọn.")
+        else:
+            raise ValueError("Không tìm thấy thông tin CHXD trong file Log Bơm (ô A2 trống).")
+
+        try:
+            pump_logs = []
+            date_cache = {}
+            for row_index, row_values in enumerate(rows, start=10):
+                transaction_type = _clean_string(row_values[7] if len(row_values) > 7 else None)
+
+                # Kiểm tra xem loại giao dịch có nằm trong danh sách hợp lệ không
+                if transaction_type.lower() not in VALID_TRANSACTION_TYPES:
+                    continue
+
+                fkey = _clean_string(row_values[14] if len(row_values) > 14 else None)
+                if not fkey:
+                    raise ValueError(
+                        f"Lỗi nghiêm trọng tại dòng {row_index} của file Log Bơm: "
+                        f"Giao dịch '{transaction_type}' bắt buộc phải có mã H.Đơn (FKEY) ở cột O nhưng lại bị trống."
+                    )
+
+                pump_logs.append({
+                    'fkey': fkey,
+                    'item_name': _clean_string(row_values[3] if len(row_values) > 3 else None),
+                    'quantity': _to_float(row_values[4] if len(row_values) > 4 else None),
+                    'total_amount': _to_float(row_values[6] if len(row_values) > 6 else None),
+                    'source_row': row_index,
+                    # Ngày giao dịch lấy từ cột B (index 1), định dạng dd/mm/yyyy
+                    'transaction_date': _format_log_date(row_values[1] if len(row_values) > 1 else None, date_cache)
+                })
+
+            if not pump_logs:
+                raise ValueError("Không tìm thấy giao dịch nào cần xuất hóa đơn trong file Log Bơm.")
+        except Exception as e:
+            raise ValueError(f"Lỗi khi đọc file Log Bơm: {e}")
+    finally:
+        wb.close() # Đảm bảo đóng workbook sau khi đọc
+
+    current_span().set_attribute('pump_logs', len(pump_logs))
+    return pump_logs
 
 
+@memory_tracked('discount_report')
 def _generate_discount_report_excel(reconciliation_data, discount_data, template_file_path="BaoCaoChietKhau.xlsx"):
     """
     Điền dữ liệu chênh lệch chiết khấu vào file Excel mẫu và tạo báo cáo.
-    Sử dụng openpyxl để ghi dữ liệu vào file mẫu đã có sẵn Table và Slicers.
+    File mẫu (có sẵn Table và Slicers) được phân tích một lần và giữ trong bộ nhớ; các dòng dữ liệu được ghi thẳng
+    dạng XML với style dùng chung (discount_report_template), Table được kéo giãn theo số dòng.
     Chỉ bao gồm các hóa đơn có discount_match == True.
     """
+    bind_log_context(store=reconciliation_data.get('selected_chxd_name'), report_type='discount_report')
     try:
-        # Load the template workbook
-        # data_only=False để giữ lại công thức và các yếu tố khác như bảng, slicer
-        output_wb = load_workbook(template_file_path, data_only=False) 
-        output_ws = output_wb.active # Get the active sheet from the loaded template
+        timer = StageTimer('discount_report')
 
         # Extract selected CHXD name
         selected_chxd_name = reconciliation_data.get('selected_chxd_name', 'N/A')
@@ -264,25 +334,12 @@ def _generate_discount_report_excel(reconciliation_data, discount_data, template
                 date_range_text = f"Từ Ngày {min_date.day} tháng {min_date.month} năm {min_date.year} tới Ngày {max_date.day} tháng {max_date.month} năm {max_date.year}"
         else:
             date_range_text = "Không xác định được khoảng thời gian"
-        
-        # --- ÁP DỤNG ĐỊNH DẠNG FONT VÀ GHI NỘI DUNG VÀO A4, A5 ---
-        # Định nghĩa font và cỡ chữ tùy chỉnh cho A4 và A5
-        # Bạn có thể điều chỉnh 'Times New Roman' và 12 để khớp với font/cỡ chữ mong muốn
-        custom_header_font = Font(name='Times New Roman', size=12, bold=True) 
-
-        # Ghi vào A4
-        a4_cell = output_ws.cell(row=4, column=1, value=f"ĐƠN VỊ: CỬA HÀNG XĂNG DẦU {selected_chxd_name.upper()}")
-        a4_cell.font = custom_header_font
-        
-        # Ghi vào A5
-        a5_cell = output_ws.cell(row=5, column=1, value=f"Thời gian: {date_range_text}")
-        a5_cell.font = custom_header_font
-
-        # Clear existing data from row 11 downwards to prevent old data from remaining
-        # We assume that the data starts from row 11 and headers are in row 10.
-        if output_ws.max_row > 10:
-            # Xóa các hàng từ dòng 11 đến dòng cuối cùng
-            output_ws.delete_rows(11, output_ws.max_row - 10) 
+
+        # Nội dung A4, A5 (font Times New Roman 12 đậm, giữ các định dạng khác của ô trong mẫu)
+        header_texts = {
+            4: f"ĐƠN VỊ: CỬA HÀNG XĂNG DẦU {selected_chxd_name.upper()}",
+            5: f"Thời gian: {date_range_text}",
+        }
         
         # Chuẩn bị dữ liệu để ghi
         report_data_rows = []
@@ -306,181 +363,405 @@ def _generate_discount_report_excel(reconciliation_data, discount_data, template
                         mismatch.get('actual_difference_amount_raw', 0.0) # Tiền chiết khấu
                     ])
 
-        # Định nghĩa font và cỡ chữ tùy chỉnh cho dữ liệu bảng
-        # Bạn có thể điều chỉnh 'Times New Roman' và 10 để khớp với font/cỡ chữ mong muốn
-        custom_data_font = Font(name='Times New Roman', size=10) 
+        timer.mark('row_build')
 
-        # Ghi dữ liệu vào worksheet, bắt đầu từ dòng 11 (Excel's 1-indexed)
-        data_start_row_excel = 11 
-        for r_idx, row_data in enumerate(report_data_rows):
-            for c_idx, cell_value in enumerate(row_data):
-                cell = output_ws.cell(row=data_start_row_excel + r_idx, column=c_idx + 1, value=cell_value)
-                
-                # Áp dụng font và cỡ chữ cho tất cả các ô dữ liệu
-                cell.font = custom_data_font
-
-                # Áp dụng định dạng số cho các cột tương ứng
-                # "Số lượng" là cột H (index 7, Excel column 8)
-                # "Đơn giá chiết khấu" là cột I (index 8, Excel column 9)
-                # "Tiền chiết khấu" là cột J (index 9, Excel column 10)
-                if c_idx == 7: # Số lượng
-                    cell.number_format = '#,##0.00'
-                elif c_idx == 8 or c_idx == 9: # Đơn giá chiết khấu, Tiền chiết khấu
-                    cell.number_format = '#,##0'
-        
-        # Lưu workbook vào buffer
-        output_buffer = io.BytesIO()
-        output_wb.save(output_buffer)
-        output_buffer.seek(0)
+        # Ghi dữ liệu từ dòng 11 (font Times New Roman 10; Số lượng '#,##0.00', Đơn giá/Tiền chiết khấu '#,##0')
+        output_buffer = discount_report_template.render(template_file_path, header_texts, report_data_rows)
+        timer.mark('workbook_save')
+        count_rows('discount_report', 'output', len(report_data_rows))
         return output_buffer
 
     except FileNotFoundError:
         raise ValueError(f"Không tìm thấy file mẫu báo cáo chiết khấu: '{template_file_path}'. Vui lòng đảm bảo file tồn tại và có tên đúng.")
     except Exception as e:
-        print(f"Lỗi khi tạo báo cáo chiết khấu bằng openpyxl (sử dụng mẫu): {e}")
+        logger.exception("Lỗi khi tạo báo cáo chiết khấu từ file mẫu.")
         raise ValueError(f"Đã xảy ra lỗi khi tạo báo cáo chiết khấu: {e}")
 
-def perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, invoice_symbol_from_config, discount_data=None):
+# --- TỔNG HỢP THEO MẶT HÀNG VÀ THEO NGÀY ---
+
+def _new_item_summary():
+    return defaultdict(lambda: {'quantity': {'pos': 0, 'hddt': 0}, 'amount': {'pos': 0, 'hddt': 0}})
+
+def _add_to_item_summary(item_summary, records, side):
+    """Cộng dồn số lượng/thành tiền của các dòng vào bảng tổng hợp theo mặt hàng (side: 'pos' hoặc 'hddt')."""
+    for record in records:
+        item_summary[record['item_name']]['quantity'][side] += record['quantity']
+        item_summary[record['item_name']]['amount'][side] += record['total_amount']
+
+def _format_item_summary(item_summary):
+    """Định dạng bảng tổng hợp theo mặt hàng để hiển thị (kèm chênh lệch và cờ khớp)."""
+    final_item_summary = {}
+    for name, data in item_summary.items():
+        qty_diff = data['quantity']['pos'] - data['quantity']['hddt']
+        amt_diff = data['amount']['pos'] - data['amount']['hddt']
+        final_item_summary[name] = {
+            'quantity': {'pos': _format_number(data['quantity']['pos']), 'hddt': _format_number(data['quantity']['hddt']), 'difference': _format_number(qty_diff), 'is_match': abs(qty_diff) < 0.001},
+            'amount': {'pos': _format_number(data['amount']['pos']), 'hddt': _format_number(data['amount']['hddt']), 'difference': _format_number(amt_diff), 'is_match': abs(amt_diff) < 1}
+        }
+    return final_item_summary
+
+def _build_invoice_status_rows(join):
+    """
+    Trạng thái đối soát của từng khóa (fkey, mặt hàng): 'matched', 'mismatch' (lệch số lượng/thành tiền),
+    'missing' (có trên Log Bơm, thiếu trên HĐĐT) hoặc 'extra' (có trên HĐĐT, không có trên Log Bơm).
+    Ngày là ngày giao dịch trên Log Bơm, hoặc ngày hóa đơn với dòng chỉ có trên HĐĐT.
+    """
+    log_side, hddt_side = join.log_side, join.hddt_side
+    date_cache = {}
+
+    def status_row(status, log_position, hddt_position):
+        log = log_side.record(log_position) if log_position is not None else None
+        inv = hddt_side.record(hddt_position) if hddt_position is not None else None
+        source = inv or log
+        return {
+            'status': status,
+            'invoice_date': log['transaction_date'] if log else _format_log_date(inv['invoice_date_raw'], date_cache),
+            'fkey': source['fkey'],
+            'item_name': source['item_name'],
+            'invoice_number': inv.get('invoice_number', '') if inv else '',
+            'mst_khach_hang': inv.get('mst_khach_hang', '') if inv else '',
+            'customer_name': inv.get('customer_name', '') if inv else '',
+            'pos_quantity': log_side.quantity[log_position].item() if log else None,
+            'hddt_quantity': hddt_side.quantity[hddt_position].item() if inv else None,
+            'pos_amount': log_side.total_amount[log_position].item() if log else None,
+            'hddt_amount': hddt_side.total_amount[hddt_position].item() if inv else None,
+        }
+
+    flagged = (join.quantity_mismatch | join.amount_mismatch).tolist()
+    rows = [status_row('mismatch' if is_flagged else 'matched', log_position, hddt_position)
+            for log_position, hddt_position, is_flagged in zip(join.common_log.tolist(), join.common_hddt.tolist(), flagged)]
+    rows.extend(status_row('missing', log_position, None) for log_position in join.log_only.tolist())
+    rows.extend(status_row('extra', None, hddt_position) for hddt_position in join.hddt_only.tolist())
+    return rows
+
+def _day_sort_key(day_str):
+    """Sắp xếp ngày dd/mm/yyyy theo thời gian, ngày không xác định ('N/A') xếp cuối."""
+    try:
+        return (0, datetime.strptime(day_str, '%d/%m/%Y'))
+    except (TypeError, ValueError):
+        return (1, datetime.max)
+
+def _build_daily_rollups(log_bom_data, hddt_invoices, join, quantity_mismatches, amount_mismatches):
+    """
+    Tổng hợp kết quả đối soát nhiều ngày theo từng ngày: số giao dịch, FKEY thiếu/thừa, số chênh lệch và bảng mặt hàng.
+    Ngày của dòng Log Bơm là ngày giao dịch; ngày của hóa đơn HĐĐT là ngày hóa đơn (cột U).
+    FKEY thiếu và chênh lệch được tính vào ngày giao dịch trên Log Bơm, FKEY thừa vào ngày hóa đơn.
+    """
+    date_cache = {}
+    hddt_days = [_format_log_date(inv['invoice_date_raw'], date_cache) for inv in hddt_invoices]
+    days = defaultdict(lambda: {'pos_count': 0, 'hddt_count': 0, 'items': _new_item_summary(), 'missing_fkeys': [],
+                                'extra_fkeys': [], 'quantity_mismatch_count': 0, 'amount_mismatch_count': 0})
+
+    for log in log_bom_data:
+        day_data = days[log['transaction_date']]
+        day_data['pos_count'] += 1
+        _add_to_item_summary(day_data['items'], (log,), 'pos')
+    for day, inv in zip(hddt_days, hddt_invoices):
+        day_data = days[day]
+        day_data['hddt_count'] += 1
+        _add_to_item_summary(day_data['items'], (inv,), 'hddt')
+
+    for position, fkey in zip(join.log_only.tolist(), join.log_side.fkeys_at(join.log_only)):
+        missing = days[join.log_side.record(position)['transaction_date']]['missing_fkeys']
+        if not missing or missing[-1] != fkey:
+            missing.append(fkey)
+    for position, fkey in zip(join.hddt_only.tolist(), join.hddt_side.fkeys_at(join.hddt_only)):
+        extra = days[hddt_days[join.hddt_side.first_index[position]]]['extra_fkeys']
+        if not extra or extra[-1] != fkey:
+            extra.append(fkey)
+    for mismatch in quantity_mismatches:
+        days[mismatch['invoice_date']]['quantity_mismatch_count'] += 1
+    for mismatch in amount_mismatches:
+        days[mismatch['invoice_date']]['amount_mismatch_count'] += 1
+
+    daily_summary = []
+    item_daily_comparison = defaultdict(dict)
+    for day in sorted(days, key=_day_sort_key):
+        data = days[day]
+        item_comparison = _format_item_summary(data['items'])
+        for name, comparison in item_comparison.items():
+            item_daily_comparison[name][day] = comparison
+        daily_summary.append({
+            'date': day,
+            'pos_count': data['pos_count'],
+            'hddt_count': data['hddt_count'],
+            'difference': data['pos_count'] - data['hddt_count'],
+            'is_match': data['pos_count'] == data['hddt_count'] and not data['missing_fkeys'] and not data['extra_fkeys']
+                        and not data['quantity_mismatch_count'] and not data['amount_mismatch_count'],
+            'missing_fkeys': data['missing_fkeys'],
+            'extra_fkeys': data['extra_fkeys'],
+            'quantity_mismatch_count': data['quantity_mismatch_count'],
+            'amount_mismatch_count': data['amount_mismatch_count'],
+            'item_comparison': item_comparison,
+        })
+    return daily_summary, dict(item_daily_comparison)
+
+@traced('reconcile.perform')
+@memory_tracked('reconcile')
+def perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, invoice_symbol_from_config, discount_data=None,
+                           history_sink=None):
     """
     Thực hiện đối soát dữ liệu giữa file Log Bơm (POS) và file Bảng kê HĐĐT.
     Bổ sung bước xác thực CHXD và ký hiệu hóa đơn, và tính toán chiết khấu.
+    Nếu file Log Bơm có nhiều ngày (file xuất cả tháng), kết quả có thêm 'daily_summary' và 'item_daily_comparison'.
+    history_sink: hàm nhận danh sách trạng thái đối soát của từng hóa đơn (để lưu lịch sử), không bắt buộc.
     """
-    if discount_data is None:
-        discount_data = defaultdict(dict) # Đảm bảo có một dictionary rỗng nếu không có dữ liệu chiết khấu
+    return _reconcile([log_bom_bytes], [hddt_bytes], selected_chxd_name, invoice_symbol_from_config, discount_data,
+                      history_sink=history_sink)
 
+@traced('reconcile.perform_range')
+@memory_tracked('reconcile')
+def perform_range_reconciliation(log_bom_files, hddt_files, selected_chxd_name, invoice_symbol_from_config, discount_data=None,
+                                 history_sink=None):
+    """
+    Đối soát nhiều ngày (hoặc cả tháng) như một tập dữ liệu: nhiều file Log Bơm và nhiều file Bảng kê HĐĐT
+    (từng cặp theo ngày, hoặc một file xuất cả tháng mỗi loại; số file hai bên không cần bằng nhau).
+    Ngoài kết quả như đối soát một ngày, có thêm bảng tổng hợp theo ngày ('daily_summary')
+    và theo mặt hàng từng ngày ('item_daily_comparison').
+    """
+    if not log_bom_files or not hddt_files:
+        raise ValueError("Cần ít nhất một file Log Bơm và một file Bảng kê HĐĐT để đối soát.")
+    return _reconcile(list(log_bom_files), list(hddt_files), selected_chxd_name, invoice_symbol_from_config, discount_data,
+                      daily_rollups=True, history_sink=history_sink)
+
+@traced('reconcile.perform_incremental')
+@memory_tracked('reconcile')
+def perform_incremental_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, invoice_symbol_from_config,
+                                       discount_data=None, reconciler=None):
+    """
+    Đối soát tăng dần một ngày: file Log Bơm và Bảng kê HĐĐT của ngày (tại thời điểm tải lên) được so với trạng thái
+    đã đối soát của CHXD/ngày đó; chỉ các dòng mới hoặc đã thay đổi được xử lý. Kết quả gồm các thay đổi
+    ('deltas': new_matches, resolved, broken, removed) và tổng sau cập nhật. Lần tải lên đầu tiên của ngày
+    tương đương đối soát đầy đủ (mọi khóa đều là thay đổi).
+    Ngày đối soát lấy từ Log Bơm; hóa đơn HĐĐT của ngày khác bị bỏ qua (số lượng ghi ở 'hddt_other_days').
+    Chênh lệch thành tiền đúng bằng chiết khấu (discount_data) có trạng thái 'discount' và không tính là chênh lệch.
+    """
+    bind_log_context(store=selected_chxd_name, report_type='reconcile_incremental')
+    reconciler = reconciler or incremental_reconciler
     try:
-        # --- BƯỚC XÁC THỰC CHXD TỪ FILE LOG BƠM (POS) ---
-        # Tối ưu hóa: Chỉ đọc dữ liệu, bỏ qua định dạng, VBA, và liên kết
-        log_wb = load_workbook(io.BytesIO(log_bom_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
-        log_ws = log_wb.active
-        
-        # Đọc ô A2 (có thể là merged cell A-B-C-D-E2)
-        pos_chxd_cell_value = log_ws['A2'].value
-        if pos_chxd_cell_value:
-            # Loại bỏ "CHXD " và làm sạch chuỗi để so sánh
-            pos_chxd_name_extracted = _clean_string(str(pos_chxd_cell_value).replace("CHXD ", ""))
-            if pos_chxd_name_extracted.lower() != selected_chxd_name.lower():
-                log_wb.close() # Đóng workbook trước khi raise lỗi
-                raise ValueError("Bảng kê log bơm không phải của cửa hàng bạn chọn.")
-        else:
-            log_wb.close() # Đóng workbook trước khi raise lỗi
-            raise ValueError("Không tìm thấy thông tin CHXD trong file Log Bơm (ô A2 trống).")
-        
-        log_wb.close() # Đảm bảo đóng workbook sau khi đọc
+        timer = StageTimer('reconcile')
+        log_bom_data, parsed_hddt_data = _parse_reconciliation_files([log_bom_bytes], [hddt_bytes], selected_chxd_name,
+                                                                     invoice_symbol_from_config)
+        hddt_invoices = parsed_hddt_data['pos_invoices']
+        timer.mark('parse')
+        if not hddt_invoices:
+            raise ValueError("Không tìm thấy hóa đơn nào có FKEY bắt đầu bằng 'POS' để tiến hành đối soát.")
+        days = sorted({log['transaction_date'] for log in log_bom_data}, key=_day_sort_key)
+        if len(days) != 1 or days[0] == 'N/A':
+            raise ValueError("Đối soát tăng dần cần file Log Bơm của đúng một ngày "
+                             f"(file có {len(days)} ngày: {', '.join(days[:5])}). Dùng đối soát nhiều ngày cho khoảng ngày.")
+        day = datetime.strptime(days[0], '%d/%m/%Y').strftime('%Y-%m-%d')
+        # Trạng thái được lưu theo ngày: chỉ giữ hóa đơn có ngày HĐĐT trùng ngày của Log Bơm
+        date_cache = {}
+        day_invoices = [inv for inv in hddt_invoices if _format_log_date(inv['invoice_date_raw'], date_cache) == days[0]]
+        other_day_invoices = len(hddt_invoices) - len(day_invoices)
+        if not day_invoices:
+            raise ValueError(f"Bảng kê HĐĐT không có hóa đơn nào của ngày {days[0]}.")
+
+        result = reconciler.apply(selected_chxd_name, day, log_bom_data, day_invoices,
+                                  discount_data if discount_data is not None else defaultdict(dict))
+        timer.mark('incremental_apply')
+        count_rows('reconcile', 'incremental_changed',
+                   sum(stats['new'] + stats['removed'] for stats in result['rows'].values()))
+
+        status_counts = result['status_counts']
+        matched_keys = status_counts['matched'] + status_counts['discount']
+        count_diff = result['pos_count'] - result['hddt_count']
+        reconciliation_data = {
+            'date': days[0],
+            'first_upload': result['first_upload'],
+            'rows': result['rows'],
+            'deltas': result['deltas'],
+            'summary': {
+                'pos_count': result['pos_count'],
+                'hddt_count': result['hddt_count'],
+                'difference': count_diff,
+                'is_match': count_diff == 0 and matched_keys == sum(status_counts.values()),
+                'hddt_other_days': other_day_invoices,
+                **{f'{status}_count': count for status, count in status_counts.items()},
+            },
+            'item_comparison': _format_item_summary(result['items']),
+        }
+        current_span().set_attributes(store=selected_chxd_name, first_upload=result['first_upload'],
+                                      **{f'{kind}_deltas': len(entries) for kind, entries in result['deltas'].items()})
+        return reconciliation_data
 
-        # --- BƯỚC XÁC THỰC KÝ HIỆU HÓA ĐƠN TỪ FILE HĐĐT ---
-        # Tối ưu hóa: Chỉ đọc dữ liệu, bỏ qua định dạng, VBA, và liên kết
-        hddt_wb = load_workbook(io.BytesIO(hddt_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
-        hddt_ws = hddt_wb.active
-        
-        # Lấy 6 ký tự cuối của ký hiệu hóa đơn từ file cấu hình
-        # Đảm bảo ký hiệu từ config đủ dài để cắt
-        if len(invoice_symbol_from_config) < 6:
-            hddt_wb.close() # Đóng workbook trước khi raise lỗi
-            raise ValueError(f"Ký hiệu hóa đơn trong file cấu hình Data_HDDT.xlsx ('{invoice_symbol_from_config}') quá ngắn để xác thực.")
-        expected_invoice_symbol_suffix = invoice_symbol_from_config[-6:].upper()
-
-        has_at_least_one_valid_invoice_for_symbol_check = False
-
-        # Duyệt qua cột S (index 18) từ dòng 11 để kiểm tra ký hiệu hóa đơn
-        for row_index, row_values in enumerate(hddt_ws.iter_rows(min_row=11, values_only=True), start=11):
-            # Kiểm tra xem dòng này có phải là một hóa đơn thực tế (có số lượng > 0) không
-            # Cột I (index 8) là số lượng
-            quantity_val = _to_float(row_values[8] if len(row_values) > 8 else None)
-            
-            # Nếu số lượng <= 0, đây có thể là dòng tiêu đề, chân trang, hoặc dòng tổng cộng. Bỏ qua xác thực ký hiệu cho các dòng này.
-            if quantity_val <= 0:
-                continue
-
-            # Nếu đến đây, đây là một dòng hóa đơn hợp lệ (có số lượng > 0)
-            has_at_least_one_valid_invoice_for_symbol_check = True
-
-            # Thực hiện xác thực ký hiệu hóa đơn
-            if len(row_values) > 18 and row_values[18] is not None: # Cột S (index 18)
-                actual_invoice_symbol_hddt = _clean_string(row_values[18])
-                if len(actual_invoice_symbol_hddt) >= 6:
-                    if actual_invoice_symbol_hddt[-6:].upper() != expected_invoice_symbol_suffix:
-                        hddt_wb.close() # Đóng workbook trước khi raise lỗi
-                        raise ValueError("Bảng kê hddt không phải của cửa hàng bạn chọn.")
-                else:
-                    # Dòng hóa đơn hợp lệ nhưng ký hiệu quá ngắn
-                    hddt_wb.close() # Đóng workbook trước khi raise lỗi
-                    raise ValueError(f"Ký hiệu hóa đơn tại dòng {row_index} của bảng kê HDDT quá ngắn để xác thực.")
-            else:
-                # Dòng hóa đơn hợp lệ nhưng thiếu ký hiệu hóa đơn
-                hddt_wb.close() # Đóng workbook trước khi raise lỗi
-                raise ValueError(f"Hóa đơn tại dòng {row_index} của bảng kê HDDT thiếu ký hiệu hóa đơn (cột S).")
-        
-        # Sau khi kiểm tra tất cả các dòng, nếu không tìm thấy bất kỳ dòng hóa đơn hợp lệ nào để xác thực ký hiệu.
-        if not has_at_least_one_valid_invoice_for_symbol_check:
-            hddt_wb.close() # Đóng workbook trước khi raise lỗi
-            raise ValueError("Không tìm thấy hóa đơn hợp lệ nào trong file Bảng kê HDDT để xác thực ký hiệu.")
-        
-        hddt_wb.close() # Đảm bảo đóng workbook sau khi đọc
+    except Exception as e:
+        logger.exception("Lỗi trong quá trình đối soát tăng dần.")
+        raise ValueError(f"Đã xảy ra lỗi trong quá trình đối soát: {e}")
 
-        # Nếu các bước xác thực thành công, tiếp tục xử lý đối soát
-        parsed_hddt_data = _parse_hddt_file(hddt_bytes)
+@traced('reconcile.perform_three_way')
+@memory_tracked('reconcile')
+def perform_three_way_reconciliation(log_bom_bytes, pos_bytes, hddt_bytes, selected_chxd_name, invoice_symbol_from_config):
+    """
+    Đối soát ba chiều Log Bơm - Bảng kê POS - Bảng kê HĐĐT trước khi xuất UpSSE (file UpSSE được tạo từ bảng kê POS).
+    Ba file được phân tích song song một lần; Log Bơm nối HĐĐT qua FKEY, POS nối HĐĐT qua số hóa đơn.
+    Kết quả: ma trận chênh lệch theo từng cặp nguồn ('mismatch_matrix'), số giao dịch theo tổ hợp nguồn có mặt
+    ('presence'), danh sách giao dịch có vấn đề ('mismatches') và cờ 'upsse_consistent': mọi giao dịch đã bơm
+    đều có trên bảng kê POS với cùng số lượng và ngược lại (chênh lệch thành tiền do chiết khấu không tính).
+    """
+    bind_log_context(store=selected_chxd_name, report_type='reconcile_three_way')
+    try:
+        timer = StageTimer('reconcile')
+        jobs = [('reconcile_parse_log_bom', {'log_bom_bytes': log_bom_bytes}, {'selected_chxd_name': selected_chxd_name}),
+                ('reconcile_parse_pos', {'file_content_bytes': pos_bytes}, {'selected_chxd_symbol': invoice_symbol_from_config}),
+                ('reconcile_parse_hddt', {'hddt_bytes': hddt_bytes}, {'invoice_symbol_from_config': invoice_symbol_from_config})]
+        try:
+            log_bom_data, pos_invoices, parsed_hddt_data = run_jobs_parallel(jobs)
+        except Exception as e:
+            job_index = getattr(e, 'job_index', None)
+            if job_index is None:
+                raise
+            raise ValueError(f"{('File Log Bơm', 'File Bảng kê POS', 'File Bảng kê HĐĐT')[job_index]}: {e}") from e
         hddt_invoices = parsed_hddt_data['pos_invoices']
-        log_bom_data = _parse_log_bom_file(log_bom_bytes) # log_bom_data giờ đã có 'transaction_date'
-
+        timer.mark('parse')
+        count_rows('reconcile', 'log_bom', len(log_bom_data))
+        count_rows('reconcile', 'pos', len(pos_invoices))
+        count_rows('reconcile', 'hddt', len(hddt_invoices))
         if not hddt_invoices:
-             raise ValueError("Không tìm thấy hóa đơn nào có FKEY bắt đầu bằng 'POS' để tiến hành đối soát.")
+            raise ValueError("Không tìm thấy hóa đơn nào có FKEY bắt đầu bằng 'POS' để tiến hành đối soát.")
 
-        log_map = {log['fkey']: log for log in log_bom_data}
-        hddt_map = {inv['fkey']: inv for inv in hddt_invoices}
+        rows, matrix, presence = three_way_join(log_bom_data, pos_invoices, hddt_invoices)
+        timer.mark('join')
 
-        log_fkeys = set(log_map.keys())
-        hddt_fkeys = set(hddt_map.keys())
+        mismatches = sorted((row for row in rows if row['issues']),
+                            key=lambda row: (_day_sort_key(row['date']), row['invoice_number'], row['fkey']))
+        log_vs_pos = matrix['log_vs_pos']
+        pos_vs_hddt = matrix['pos_vs_hddt']
+        upsse_consistent = not (log_vs_pos['only_log'] or log_vs_pos['only_pos'] or log_vs_pos['quantity_mismatch']
+                                or pos_vs_hddt['only_pos'] or pos_vs_hddt['only_hddt'] or pos_vs_hddt['quantity_mismatch'])
+        reconciliation_data = {
+            'summary': {
+                'pos_count': len(log_bom_data),
+                'pos_report_count': len(pos_invoices),
+                'hddt_count': len(hddt_invoices),
+                'transactions': len(rows),
+                'consistent': len(rows) - len(mismatches),
+                'inconsistent': len(mismatches),
+                'is_match': not mismatches,
+                'upsse_consistent': upsse_consistent,
+            },
+            'mismatch_matrix': matrix,
+            'presence': presence,
+            'mismatches': mismatches,
+        }
+        timer.mark('summary')
+        current_span().set_attributes(store=selected_chxd_name, transactions=len(rows), inconsistent=len(mismatches),
+                                      upsse_consistent=upsse_consistent)
+        return reconciliation_data
 
-        missing_invoices_fkeys = sorted(list(log_fkeys - hddt_fkeys))
-        extra_invoices_fkeys = sorted(list(hddt_fkeys - log_fkeys))
-        common_fkeys = sorted(list(log_fkeys.intersection(hddt_fkeys)))
+    except Exception as e:
+        logger.exception("Lỗi trong quá trình đối soát ba chiều.")
+        raise ValueError(f"Đã xảy ra lỗi trong quá trình đối soát: {e}")
+
+def _parse_reconciliation_files(log_bom_files, hddt_files, selected_chxd_name, invoice_symbol_from_config):
+    """
+    Phân tích song song mọi file đầu vào trong các tiến trình xử lý (file nào lỗi trước thì các file còn lại bị hủy).
+    Trả về (log_bom_data, parsed_hddt_data) đã nối dữ liệu của tất cả các file theo thứ tự tải lên.
+    """
+    jobs = [('reconcile_parse_log_bom', {'log_bom_bytes': log_bom_bytes}, {'selected_chxd_name': selected_chxd_name})
+            for log_bom_bytes in log_bom_files]
+    jobs += [('reconcile_parse_hddt', {'hddt_bytes': hddt_bytes}, {'invoice_symbol_from_config': invoice_symbol_from_config})
+             for hddt_bytes in hddt_files]
+    multiple_files = len(jobs) > 2
+    try:
+        results = run_jobs_parallel(jobs)
+    except Exception as e:
+        job_index = getattr(e, 'job_index', None)
+        if not multiple_files or job_index is None:
+            raise
+        # Nhiều file: cho biết file nào lỗi
+        if job_index < len(log_bom_files):
+            raise ValueError(f"File Log Bơm thứ {job_index + 1}: {e}") from e
+        raise ValueError(f"File Bảng kê HĐĐT thứ {job_index - len(log_bom_files) + 1}: {e}") from e
+
+    if not multiple_files:
+        return results[0], results[1]
+    log_bom_data = []
+    parsed_hddt_data = {'pos_invoices': [], 'direct_petroleum_invoices': [], 'other_invoices': []}
+    for file_number, pump_logs in enumerate(results[:len(log_bom_files)], start=1):
+        for log in pump_logs:
+            log['source_file'] = file_number # Dòng gốc (source_row) chỉ có nghĩa trong từng file
+        log_bom_data.extend(pump_logs)
+    for file_number, parsed in enumerate(results[len(log_bom_files):], start=1):
+        for group, invoices in parsed.items():
+            for invoice in invoices:
+                invoice['source_file'] = file_number
+            parsed_hddt_data[group].extend(invoices)
+    return log_bom_data, parsed_hddt_data
+
+def _reconcile(log_bom_files, hddt_files, selected_chxd_name, invoice_symbol_from_config, discount_data=None,
+               daily_rollups=False, history_sink=None):
+    """Phần chung của đối soát một ngày và đối soát nhiều ngày."""
+    bind_log_context(store=selected_chxd_name, report_type='reconcile')
+    if discount_data is None:
+        discount_data = defaultdict(dict) # Đảm bảo có một dictionary rỗng nếu không có dữ liệu chiết khấu
+
+    try:
+        timer = StageTimer('reconcile')
+        # --- BƯỚC XÁC THỰC VÀ ĐỌC DỮ LIỆU ---
+        # Các file độc lập với nhau: Log Bơm (xác thực CHXD) và Bảng kê HĐĐT (xác thực ký hiệu hóa đơn) được phân tích
+        # song song trong các tiến trình xử lý; log_bom_data đã có 'transaction_date'
+        log_bom_data, parsed_hddt_data = _parse_reconciliation_files(log_bom_files, hddt_files, selected_chxd_name,
+                                                                     invoice_symbol_from_config)
+        hddt_invoices = parsed_hddt_data['pos_invoices']
+        timer.mark('parse')
+        count_rows('reconcile', 'log_bom', len(log_bom_data))
+        count_rows('reconcile', 'hddt', len(hddt_invoices))
+
+        if not hddt_invoices:
+             raise ValueError("Không tìm thấy hóa đơn nào có FKEY bắt đầu bằng 'POS' để tiến hành đối soát.")
+
+        # Ghép theo khóa (fkey, mặt hàng): hóa đơn nhiều dòng/nhiều lần bơm cùng FKEY được cộng dồn trước khi so sánh
+        join = sort_merge_join(log_bom_data, hddt_invoices)
+        missing_invoices_fkeys = join.missing_fkeys()
+        extra_invoices_fkeys = join.extra_fkeys()
 
         quantity_mismatches = []
         amount_mismatches = []
 
-        for fkey in common_fkeys:
-            log = log_map[fkey]
-            inv = hddt_map[fkey]
+        # Chênh lệch đã được tính theo mảng; chỉ dựng thông tin chi tiết cho các khóa có chênh lệch
+        for log_position, hddt_position, actual_difference_raw, is_quantity_mismatch, is_amount_mismatch in join.mismatches():
+            log = join.log_side.record(log_position)
+            inv = join.hddt_side.record(hddt_position)
+            hddt_amount = join.hddt_side.total_amount[hddt_position].item()
+            hddt_quantity = join.hddt_side.quantity[hddt_position].item()
             
             # Lấy ngày tháng đã được định dạng từ dữ liệu Log Bơm (POS)
             pos_date_str = log.get('transaction_date', 'N/A')
             
             mismatch_info = {
-                'fkey': fkey,
+                'fkey': inv['fkey'],
                 'invoice_number': inv.get('invoice_number', 'N/A'),
                 'invoice_date': pos_date_str, # Sử dụng ngày tháng từ POS
-                'hddt_amount': inv['total_amount'], 
-                'pos_amount': log['total_amount'],   
+                'hddt_amount': hddt_amount, 
+                'pos_amount': join.log_side.total_amount[log_position].item(),   
                 'customer_name': inv.get('customer_name', ''),
                 'mst_khach_hang': inv.get('mst_khach_hang', ''),
                 'item_name': inv.get('item_name', ''),
-                'quantity': inv.get('quantity', 0.0),
+                'quantity': hddt_quantity,
                 'invoice_symbol_hddt': inv.get('invoice_symbol_hddt', ''),
                 'invoice_date_raw': inv['invoice_date_raw'] # Giữ lại để debug nếu cần
             }
 
-            # Kiểm tra chênh lệch số lượng
-            if abs(log['quantity'] - inv['quantity']) > 0.001:
+            # Chênh lệch số lượng
+            if is_quantity_mismatch:
                 quantity_mismatches.append(mismatch_info)
 
-            # Tính toán chênh lệch thực tế (raw)
-            actual_difference_raw = log['total_amount'] - inv['total_amount']
+            # Chênh lệch thực tế (raw)
             mismatch_info['actual_difference_amount_raw'] = actual_difference_raw # Lưu giá trị raw để hiển thị và tính toán
 
-            # Kiểm tra chênh lệch thành tiền và tính toán chiết khấu
-            # Chênh lệch > 1 VNĐ được coi là có chênh lệch cần kiểm tra
-            if abs(actual_difference_raw) > 1: 
+            # Chênh lệch thành tiền > 1 VNĐ được coi là có chênh lệch cần kiểm tra, tính toán chiết khấu
+            if is_amount_mismatch: 
                 mst_khach_hang = inv.get('mst_khach_hang', '')
                 item_name = inv.get('item_name', '')
-                quantity = inv.get('quantity', 0.0) # Lấy số lượng từ HDDT
 
                 # Lấy số tiền chiết khấu cố định trên mỗi đơn vị từ dữ liệu chiết khấu
                 discount_amount_per_unit = discount_data.get(mst_khach_hang, {}).get(item_name, 0.0)
                 
                 # Tính toán tổng số tiền chiết khấu dự kiến cho hóa đơn này
-                # (Số tiền chiết khấu cố định trên mỗi đơn vị * Số lượng)
-                expected_discount_total_amount = round(discount_amount_per_unit * quantity)
+                # (Số tiền chiết khấu cố định trên mỗi đơn vị * Số lượng trên HĐĐT)
+                expected_discount_total_amount = round(discount_amount_per_unit * hddt_quantity)
                 mismatch_info['expected_discount_amount'] = expected_discount_total_amount # Lưu giá trị raw
 
                 # So sánh chênh lệch thực tế với chiết khấu dự kiến
@@ -489,23 +770,12 @@ def perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, invoic
                 mismatch_info['discount_match'] = discount_match
                 
                 amount_mismatches.append(mismatch_info)
+        timer.mark('join')
                 
-        item_summary = defaultdict(lambda: {'quantity': {'pos': 0, 'hddt': 0}, 'amount': {'pos': 0, 'hddt': 0}})
-        for log in log_bom_data:
-            item_summary[log['item_name']]['quantity']['pos'] += log['quantity']
-            item_summary[log['item_name']]['amount']['pos'] += log['total_amount']
-        for inv in hddt_invoices:
-            item_summary[inv['item_name']]['quantity']['hddt'] += inv['quantity']
-            item_summary[inv['item_name']]['amount']['hddt'] += inv['total_amount']
-            
-        final_item_summary = {}
-        for name, data in item_summary.items():
-            qty_diff = data['quantity']['pos'] - data['quantity']['hddt']
-            amt_diff = data['amount']['pos'] - data['amount']['hddt']
-            final_item_summary[name] = {
-                'quantity': {'pos': _format_number(data['quantity']['pos']), 'hddt': _format_number(data['quantity']['hddt']), 'difference': _format_number(qty_diff), 'is_match': abs(qty_diff) < 0.001},
-                'amount': {'pos': _format_number(data['amount']['pos']), 'hddt': _format_number(data['amount']['hddt']), 'difference': _format_number(amt_diff), 'is_match': abs(amt_diff) < 1}
-            }
+        item_summary = _new_item_summary()
+        _add_to_item_summary(item_summary, log_bom_data, 'pos')
+        _add_to_item_summary(item_summary, hddt_invoices, 'hddt')
+        final_item_summary = _format_item_summary(item_summary)
             
         count_diff = len(log_bom_data) - len(hddt_invoices)
         reconciliation_data = {
@@ -527,11 +797,30 @@ def perform_reconciliation(log_bom_bytes, hddt_bytes, selected_chxd_name, invoic
                 'others': parsed_hddt_data['other_invoices']
             }
         }
+        # Gợi ý ghép cặp cho FKEY thiếu/thừa (sai FKEY hoặc sai mặt hàng trên hóa đơn)
+        date_cache = {}
+        reconciliation_data['candidate_matches'] = suggest_candidates(
+            join, [join.log_side.record(position)['transaction_date'] for position in join.log_only.tolist()],
+            [_format_log_date(join.hddt_side.record(position)['invoice_date_raw'], date_cache)
+             for position in join.hddt_only.tolist()])
+        timer.mark('candidates')
+        if history_sink is not None:
+            history_sink(_build_invoice_status_rows(join))
+        # Một cặp file xuất cả tháng cũng là đối soát nhiều ngày: chỉ bỏ bảng theo ngày khi dữ liệu đúng một ngày
+        if daily_rollups or len({log['transaction_date'] for log in log_bom_data}) > 1:
+            reconciliation_data['daily_summary'], reconciliation_data['item_daily_comparison'] = _build_daily_rollups(
+                log_bom_data, hddt_invoices, join, quantity_mismatches, amount_mismatches)
+            reconciliation_data['summary']['log_bom_files'] = len(log_bom_files)
+            reconciliation_data['summary']['hddt_files'] = len(hddt_files)
+        timer.mark('summary')
+        current_span().set_attributes(store=selected_chxd_name, missing_in_hddt=len(missing_invoices_fkeys),
+                                      extra_in_hddt=len(extra_invoices_fkeys), quantity_mismatches=len(quantity_mismatches),
+                                      amount_mismatches=len(amount_mismatches))
         
         return reconciliation_data
 
     except Exception as e:
-        # In ra lỗi chi tiết để debug trên Render logs
-        print(f"Lỗi trong quá trình đối soát: {e}")
+        # Ghi lỗi chi tiết (kèm traceback) để debug trên Render logs
+        logger.exception("Lỗi trong quá trình đối soát.")
         raise ValueError(f"Đã xảy ra lỗi trong quá trình đối soát: {e}")
 
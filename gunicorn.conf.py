@@ -0,0 +1,73 @@
+import gc
+import os
+import multiprocessing
+
+# --- CẤU HÌNH GUNICORN ĐA TIẾN TRÌNH ---
+# openpyxl xử lý thuần CPU nên bị GIL tuần tự hóa khi chạy nhiều luồng trong một tiến trình.
+# Chạy nhiều worker (mặc định = số vCPU) để các cửa hàng tải lên song song dùng hết CPU.
+
+bind = f":{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 0))
+# Thời gian chờ request đang chạy hoàn tất khi worker được tái tạo (memory_watchdog) hoặc khi tắt máy chủ
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 120))
+
+# Nạp app (và toàn bộ cấu hình Data_HDDT/MaHH/DSKH/ChietKhau) một lần trong master trước khi fork,
+# các worker dùng chung bộ nhớ đó theo cơ chế copy-on-write.
+preload_app = True
+
+MEMORY_LOG_EVERY = int(os.environ.get('MEMORY_LOG_EVERY', 50))
+
+
+def on_starting(server):
+    # Số liệu /metrics gộp từ tệp của các worker: bỏ tệp của lần chạy trước
+    from metrics import clear_multiprocess_dir
+    clear_multiprocess_dir()
+
+
+def when_ready(server):
+    # Đưa toàn bộ đối tượng đã nạp vào thế hệ "permanent" của GC: bộ gom rác không duyệt
+    # (và không ghi vào header) các đối tượng này nữa, nên các trang bộ nhớ chứa cấu hình
+    # không bị sao chép riêng cho từng worker.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Đã nạp cấu hình trước khi fork, %s đối tượng được đóng băng cho GC.", gc.get_freeze_count())
+
+
+def post_fork(server, worker):
+    from memory_monitor import mark_baseline
+    mark_baseline()
+    # Ghi số liệu của worker ra thư mục dùng chung để /metrics gộp được số liệu của mọi worker
+    from metrics import registry
+    registry.enable_multiprocess()
+    # Dựng sẵn tiến trình xử lý (job_pool) cho worker để job đầu tiên không phải chờ khởi động
+    from job_pool import job_pool
+    job_pool.start()
+
+
+def post_request(worker, req, environ, resp):
+    # Worker vượt ngưỡng RSS: ngừng nhận request mới, xử lý nốt request đang chạy rồi để master tạo worker mới
+    from memory_watchdog import memory_watchdog
+    memory_watchdog.check_worker(worker)
+
+    # Ghi log mức tăng bộ nhớ của worker định kỳ để định cỡ số worker theo giới hạn bộ nhớ Cloud Run
+    if MEMORY_LOG_EVERY > 0 and worker.nr % MEMORY_LOG_EVERY == 0:
+        from memory_monitor import memory_report
+        report = memory_report()
+        worker.log.info(
+            "Bộ nhớ worker %s sau %s request: RSS=%s MB, riêng=%s MB, tăng từ khi fork=%s MB",
+            report['pid'], worker.nr, _mb(report['rss_bytes']), _mb(report['private_bytes']), _mb(report['private_growth_bytes'])
+        )
+
+
+def _mb(value):
+    return None if value is None else round(value / (1024 * 1024), 1)
+
+
+def worker_exit(server, worker):
+    from memory_watchdog import memory_watchdog
+    if memory_watchdog.is_recycling():
+        from memory_monitor import current_rss_bytes
+        worker.log.info("Worker %s đã xử lý xong request đang chạy và thoát (RSS=%s MB).", worker.pid, _mb(current_rss_bytes()))
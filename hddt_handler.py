@@ -1,9 +1,16 @@
 import io
+import logging
 import re
 import unicodedata
 from datetime import datetime
 import pandas as pd
 from openpyxl import load_workbook, Workbook
+from metrics import StageTimer, count_rows
+from structured_logging import warn_row, bind_log_context
+from memory_profiling import memory_tracked
+from tracing import traced, current_span
+
+logger = logging.getLogger(__name__)
 
 # --- Các hàm tiện ích nội bộ ---
 def _clean_string_hddt(s):
@@ -99,13 +106,15 @@ def _parse_date_from_excel_cell(date_val):
     return None
 
 # --- Hàm xử lý chính ---
+@traced('hddt.generate_upsse_rows')
 def _generate_upsse_from_hddt_rows(rows_to_process, static_data_hddt, selected_chxd, final_date, summary_suffix_map):
     """Tạo các dòng dữ liệu cho file UpSSE từ dữ liệu bảng kê HĐĐT."""
+    timer = StageTimer('hddt')
     upsse_wb = _create_upsse_workbook_hddt()
     ws = upsse_wb.active
 
     if not rows_to_process:
-        print(f"DEBUG: Không có dòng nào để xử lý trong giai đoạn này. Trả về workbook rỗng.")
+        logger.debug("Không có dòng nào để xử lý trong giai đoạn này, trả về workbook rỗng.")
         output_buffer = io.BytesIO()
         upsse_wb.save(output_buffer)
         output_buffer.seek(0)
@@ -243,10 +252,13 @@ def _generate_upsse_from_hddt_rows(rows_to_process, static_data_hddt, selected_c
     
     for row_data in original_invoice_rows + bvmt_rows:
         ws.append(row_data)
+    timer.mark('row_generation')
+    count_rows('hddt', 'input', processed_row_count)
+    count_rows('hddt', 'output', len(original_invoice_rows) + len(bvmt_rows))
+    current_span().set_attributes(input_rows=processed_row_count, invoice_rows=len(original_invoice_rows), bvmt_rows=len(bvmt_rows))
 
-    print(f"DEBUG: Số dòng hóa đơn gốc được thêm vào workbook: {len(original_invoice_rows)}")
-    print(f"DEBUG: Số dòng BVMT được thêm vào workbook: {len(bvmt_rows)}")
-    print(f"DEBUG: Tổng số dòng (sau khi lọc số lượng <= 0) được xử lý: {processed_row_count}")
+    logger.debug("Đã tạo dòng UpSSE từ bảng kê HĐĐT.", extra={
+        'input_rows': processed_row_count, 'invoice_rows': len(original_invoice_rows), 'bvmt_rows': len(bvmt_rows)})
 
     for row_index in range(6, ws.max_row + 1):
         date_cell = ws[f'C{row_index}']
@@ -258,20 +270,26 @@ def _generate_upsse_from_hddt_rows(rows_to_process, static_data_hddt, selected_c
     output_buffer = io.BytesIO()
     upsse_wb.save(output_buffer)
     output_buffer.seek(0)
+    timer.mark('workbook_save')
     return output_buffer
 
 # --- Khối lệnh điều phối chính ---
+@traced('hddt.process_report')
+@memory_tracked('hddt')
 def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_price_invoice_number, confirmed_date_str=None, static_data_hddt=None, selected_chxd_symbol=None):
     """
     Xử lý bảng kê HĐĐT để tạo file UpSSE.
     """
+    bind_log_context(store=selected_chxd, report_type='HDDT')
     if static_data_hddt is None:
         raise ValueError("Dữ liệu cấu hình tĩnh cho HDDT chưa được tải.")
     if selected_chxd_symbol is None:
         raise ValueError("Ký hiệu hóa đơn của CHXD chưa được cung cấp để xác thực.")
 
+    timer = StageTimer('hddt')
     bkhd_wb = load_workbook(io.BytesIO(file_content_bytes), data_only=True)
     bkhd_ws = bkhd_wb.active
+    timer.mark('workbook_load')
 
     if len(selected_chxd_symbol) < 6:
         raise ValueError(f"Ký hiệu hóa đơn trong file cấu hình ('{selected_chxd_symbol}') quá ngắn.")
@@ -300,6 +318,7 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
     
     if not has_at_least_one_valid_invoice_for_symbol_check:
         raise ValueError("Không tìm thấy hóa đơn hợp lệ nào trong file Bảng kê HDDT để xác thực.")
+    timer.mark('validation')
 
     final_date = None
     if confirmed_date_str:
@@ -314,7 +333,7 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
                 if parsed_date:
                     unique_dates.add(parsed_date)
                 else:
-                    print(f"WARNING: Could not parse date '{date_val_from_cell}' from valid row.")
+                    warn_row(logger, 'hddt.unparsable_date', "Không đọc được ngày '%s' ở dòng hóa đơn hợp lệ.", date_val_from_cell)
         
         if not unique_dates:
             raise ValueError("Không tìm thấy dữ liệu hóa đơn hợp lệ nào trong file Bảng kê HDDT.")
@@ -336,17 +355,22 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
                     {'text': date2.strftime('%d/%m/%Y'), 'value': date2.strftime('%Y-%m-%d')}
                 ]
                 options.sort(key=lambda x: datetime.strptime(x['value'], '%Y-%m-%d'))
+                timer.mark('date_resolution')
                 return {'choice_needed': True, 'options': options}
             else:
                 final_date = date1
 
+    timer.mark('date_resolution')
+
     all_rows = list(bkhd_ws.iter_rows(min_row=11, values_only=True))
-    print(f"DEBUG: Tổng số dòng đọc được từ file Excel: {len(all_rows)}")
+    timer.mark('row_read')
+    current_span().set_attributes(store=selected_chxd, price_periods=price_periods, source_rows=len(all_rows))
+    logger.debug("Đã đọc bảng kê HĐĐT.", extra={'source_rows': len(all_rows), 'price_periods': price_periods})
 
     # Lấy danh sách mặt hàng xăng dầu từ dữ liệu cấu hình
     petroleum_products = static_data_hddt.get("petroleum_products", [])
     if not petroleum_products:
-        print("WARNING: Không tìm thấy mặt hàng nào được đánh dấu là 'Xăng dầu' trong file MaHH.xlsx.")
+        logger.warning("Không tìm thấy mặt hàng nào được đánh dấu là 'Xăng dầu' trong file MaHH.xlsx.")
 
     suffix_map_old = {product: str(i + 1) for i, product in enumerate(petroleum_products)}
     
@@ -355,10 +379,8 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
     suffix_map_new = {product: str(i + new_price_start_index) for i, product in enumerate(petroleum_products)}
 
     if price_periods == '1':
-        print(f"DEBUG: Xử lý 1 giai đoạn giá. Suffix map: {suffix_map_old}")
         return _generate_upsse_from_hddt_rows(all_rows, static_data_hddt, selected_chxd, final_date, suffix_map_old)
     else:
-        print(f"DEBUG: Xử lý 2 giai đoạn giá.")
         if not new_price_invoice_number: raise ValueError("Vui lòng nhập 'Số hóa đơn đầu tiên của giá mới'.")
         split_index = -1
         for i, row in enumerate(all_rows):
@@ -366,8 +388,8 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
                 split_index = i
                 break
         
-        print(f"DEBUG: Số hóa đơn giá mới cần tìm: '{new_price_invoice_number}'")
-        print(f"DEBUG: split_index tìm được: {split_index}")
+        logger.debug("Tách bảng kê theo hóa đơn giá mới.", extra={
+            'new_price_invoice_number': new_price_invoice_number, 'split_index': split_index})
 
         if split_index == -1: 
             raise ValueError(f"Không tìm thấy hóa đơn số '{new_price_invoice_number}'.")
@@ -375,8 +397,8 @@ def process_hddt_report(file_content_bytes, selected_chxd, price_periods, new_pr
         rows_old_price = all_rows[:split_index]
         rows_new_price = all_rows[split_index:]
 
-        print(f"DEBUG: Số dòng giá cũ: {len(rows_old_price)}. Suffix map: {suffix_map_old}")
-        print(f"DEBUG: Số dòng giá mới: {len(rows_new_price)}. Suffix map: {suffix_map_new}")
+        logger.debug("Chia dòng theo hai giai đoạn giá.", extra={
+            'old_price_rows': len(rows_old_price), 'new_price_rows': len(rows_new_price)})
         
         result_old = _generate_upsse_from_hddt_rows(rows_old_price, static_data_hddt, selected_chxd, final_date, suffix_map_old)
         result_new = _generate_upsse_from_hddt_rows(rows_new_price, static_data_hddt, selected_chxd, final_date, suffix_map_new)
@@ -0,0 +1,406 @@
+import contextvars
+import importlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from metrics import observe_job_memory, observe_stage_timings, ROWS_PROCESSED
+from structured_logging import (configure_logging, log_context, log_context_fields, request_stats,
+                                record_rows, record_timing, record_memory)
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# Số tiến trình xử lý dựng sẵn cho mỗi worker web; 0 = chạy handler ngay trong luồng web như trước
+DEFAULT_JOB_POOL_SIZE = int(os.environ.get('JOB_POOL_SIZE', 2))
+# Số job mỗi tiến trình xử lý trước khi được thay mới; 1 = mỗi job một tiến trình sạch,
+# bộ nhớ của job lớn được trả lại hệ điều hành ngay khi job kết thúc
+DEFAULT_MAX_TASKS_PER_CHILD = int(os.environ.get('JOB_POOL_MAX_TASKS_PER_CHILD', 1))
+# Job chạy quá thời gian này (giây) bị dừng cưỡng bức: tệp lỗi không làm treo luồng web
+DEFAULT_JOB_TIMEOUT_SECONDS = float(os.environ.get('JOB_TIMEOUT_SECONDS', 300))
+DEFAULT_JOB_SPOOL_DIR = os.environ.get('JOB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'upsse_jobs'))
+
+# Các module được nạp sẵn trong tiến trình forkserver (dùng chung với batch_handler): tiến trình xử lý
+# được fork từ đó nên không phải import lại openpyxl/pandas cho mỗi job
+FORKSERVER_PRELOAD = ['batch_handler', 'job_pool', 'hddt_handler', 'pos_handler', 'doisoat_handler']
+
+# Tên job -> (module, hàm). Hàm chạy trong tiến trình xử lý với đúng tham số như khi gọi trực tiếp.
+JOB_FUNCTIONS = {
+    'hddt': ('hddt_handler', 'process_hddt_report'),
+    'pos': ('pos_handler', 'process_pos_report'),
+    'pdf_render': ('TheKho_handler', '_render_pdf_pages'),
+    'reconcile_parse_log_bom': ('doisoat_handler', '_parse_log_bom_file'),
+    'reconcile_parse_hddt': ('doisoat_handler', '_parse_hddt_file'),
+    'reconcile_parse_pos': ('pos_handler', '_parse_pos_invoices'),
+}
+
+# Chu kỳ kiểm tra yêu cầu hủy (giây) khi chờ kết quả của job chạy song song
+_CANCEL_POLL_SECONDS = 0.05
+
+_in_job_process = False
+
+
+class JobTimeoutError(ValueError):
+    """Job vượt quá JOB_TIMEOUT_SECONDS và đã bị dừng."""
+
+
+class JobCrashedError(RuntimeError):
+    """Tiến trình xử lý bị dừng bất thường (hết bộ nhớ, lỗi thư viện C...) trước khi trả kết quả."""
+
+
+class JobCancelledError(RuntimeError):
+    """Job bị hủy (tiến trình xử lý bị dừng) vì một job khác chạy song song với nó đã lỗi."""
+
+
+def _resolve(job_name):
+    module_name, function_name = JOB_FUNCTIONS[job_name]
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+# --- TRUYỀN DỮ LIỆU QUA TỆP ---
+# Tệp đầu vào/kết quả được ghi vào thư mục tạm của job; qua pipe chỉ có đường dẫn và tham số nhỏ.
+def _write(job_dir, name, data):
+    path = os.path.join(job_dir, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Kiểu giá trị được phép trong một cột của kết quả dạng bảng (danh sách bản ghi của các hàm phân tích file)
+_COLUMN_TYPES = (str, int, float, bool, type(None), datetime)
+
+
+def _encode_records(records):
+    """
+    Chuyển danh sách bản ghi (dict cùng khóa, giá trị vô hướng) thành dạng cột: mỗi khóa một danh sách giá trị,
+    datetime ghi dạng ISO kèm vị trí để khôi phục. Trả về None nếu dữ liệu không phải dạng bảng như vậy.
+    """
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        return None
+    keys = list(records[0]) if records else []
+    columns, datetimes = {}, {}
+    for key in keys:
+        try:
+            values = [record[key] for record in records]
+        except KeyError:
+            return None
+        if not all(type(value) in _COLUMN_TYPES for value in values):
+            return None
+        positions = [index for index, value in enumerate(values) if type(value) is datetime]
+        if positions:
+            datetimes[key] = positions
+            values = [value.isoformat() if type(value) is datetime else value for value in values]
+        columns[key] = values
+    if any(len(record) != len(keys) for record in records):
+        return None
+    return {'rows': len(records), 'columns': columns, 'datetimes': datetimes}
+
+
+def _decode_records(table):
+    columns = table['columns']
+    for key, positions in table['datetimes'].items():
+        values = columns[key]
+        for index in positions:
+            values[index] = datetime.fromisoformat(values[index])
+    if not columns:
+        return [{} for _ in range(table['rows'])]
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+def _encode_tables(result):
+    """Kết quả của các job phân tích file: một bảng bản ghi, hoặc dict tên -> bảng bản ghi."""
+    if isinstance(result, dict) and result and all(isinstance(key, str) for key in result):
+        tables = {name: _encode_records(records) for name, records in result.items()}
+        return None if any(table is None for table in tables.values()) else {'tables': tables}
+    table = _encode_records(result)
+    return None if table is None else {'table': table}
+
+
+def _encode_result(result, job_dir):
+    if isinstance(result, io.BytesIO):
+        return ('bytesio', _write(job_dir, 'result.xlsx', result.getvalue()))
+    if isinstance(result, dict) and any(isinstance(result.get(k), io.BytesIO) for k in ('old', 'new')):
+        return ('periods', {period: _write(job_dir, f'result_{period}.xlsx', result[period].getvalue())
+                            for period in ('old', 'new') if result.get(period)})
+    if isinstance(result, list) and all(isinstance(item, bytes) for item in result):
+        return ('files', [_write(job_dir, f'result_{index}.bin', item) for index, item in enumerate(result)])
+    tables = _encode_tables(result)
+    if tables is not None:
+        return ('columns', _write(job_dir, 'result.json', json.dumps(tables, ensure_ascii=False).encode('utf-8')))
+    # Kết quả có cấu trúc khác (không có job nào hiện tại trả về): giữ pickle làm phương án dự phòng
+    return ('pickle', _write(job_dir, 'result.pkl', pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def _decode_result(encoded):
+    kind, value = encoded
+    if kind == 'bytesio':
+        return io.BytesIO(_read(value))
+    if kind == 'periods':
+        return {period: io.BytesIO(_read(path)) for period, path in value.items()}
+    if kind == 'files':
+        return [_read(path) for path in value]
+    if kind == 'columns':
+        tables = json.loads(_read(value))
+        if 'table' in tables:
+            return _decode_records(tables['table'])
+        return {name: _decode_records(table) for name, table in tables['tables'].items()}
+    return pickle.loads(_read(value))
+
+
+# --- TIẾN TRÌNH XỬ LÝ ---
+def _job_process_main(conn):
+    """Vòng lặp của tiến trình xử lý: nhận (job, tệp, tham số) qua pipe, ghi kết quả ra tệp, trả lại mô tả kết quả."""
+    global _in_job_process
+    _in_job_process = True
+    configure_logging()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        job_name, file_paths, kwargs, context, job_dir = message
+        with log_context(context.pop('request_id', None), **context):
+            try:
+                for argument, path in file_paths.items():
+                    kwargs[argument] = _read(path)
+                result = _resolve(job_name)(**kwargs)
+                reply = ('ok', _encode_result(result, job_dir))
+            except Exception as e:
+                reply = ('error', (isinstance(e, ValueError), f"{e}" or type(e).__name__))
+            stats = request_stats()
+        conn.send((*reply, stats))
+
+
+class _JobProcess:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_job_process_main, args=(child_conn,), name='upsse-job', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class JobPool:
+    """
+    Nhóm tiến trình dựng sẵn (fork từ forkserver) chạy các handler nặng: process_hddt_report, process_pos_report,
+    phân tích hai file đối soát và render PDF. Mỗi worker web có nhóm riêng, khởi tạo ở job đầu tiên (hoặc post_fork).
+    Lợi ích: job dùng CPU không bị GIL chặn các luồng web, bộ nhớ của job lớn được trả lại khi tiến trình
+    được thay mới, và tệp lỗi làm treo/đổ vỡ chỉ ảnh hưởng tiến trình xử lý của nó.
+    """
+
+    def __init__(self, size=DEFAULT_JOB_POOL_SIZE, max_tasks_per_child=DEFAULT_MAX_TASKS_PER_CHILD,
+                 timeout_seconds=DEFAULT_JOB_TIMEOUT_SECONDS, spool_dir=DEFAULT_JOB_SPOOL_DIR):
+        self.size = size
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout_seconds = timeout_seconds
+        self.spool_dir = spool_dir
+        self._ctx = None
+        self._idle = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def start(self):
+        """Dựng sẵn các tiến trình xử lý cho tiến trình hiện tại (gọi lại sau fork sẽ dựng nhóm mới)."""
+        if not self.enabled or _in_job_process:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # forkserver: không fork trực tiếp từ tiến trình web đang chạy nhiều luồng
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._ctx = ctx
+            self._idle = queue.Queue()
+            self._pid = os.getpid()
+            for _ in range(self.size):
+                self._idle.put(_JobProcess(ctx))
+
+    def _replace(self, job_process, killed=False):
+        """Thay tiến trình đã dùng đủ số job (hoặc đã bị dừng) bằng tiến trình mới, chạy nền để không chặn request."""
+        def _spawn():
+            if killed:
+                job_process.kill()
+            else:
+                job_process.stop()
+            try:
+                self._idle.put(_JobProcess(self._ctx))
+            except Exception as e:
+                logger.warning("Không tạo được tiến trình xử lý mới: %s", e)
+                # Giữ đủ số chỗ trong nhóm: job sau sẽ thử tạo lại tiến trình
+                self._idle.put(None)
+        threading.Thread(target=_spawn, name='job-pool-respawn', daemon=True).start()
+
+    def _wait_reply(self, job_process, cancel_event):
+        """Chờ kết quả tối đa timeout_seconds; None nếu quá hạn, JobCancelledError nếu cancel_event được đặt."""
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if job_process.conn.poll(remaining if cancel_event is None else min(remaining, _CANCEL_POLL_SECONDS)):
+                return job_process.conn.recv()
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelledError("Job đã bị hủy.")
+
+    def run(self, job_name, files=None, cancel_event=None, **kwargs):
+        """
+        Chạy job trong tiến trình xử lý và trả về kết quả như khi gọi hàm trực tiếp.
+        files: {tên tham số: bytes}, được ghi ra tệp và đọc lại trong tiến trình xử lý.
+        cancel_event: threading.Event; khi được đặt, tiến trình đang chạy job bị dừng và job báo JobCancelledError.
+        """
+        if not self.enabled or _in_job_process:
+            return _resolve(job_name)(**(files or {}), **kwargs)
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelledError("Job đã bị hủy.")
+        self.start()
+        job_dir = tempfile.mkdtemp(prefix=f'{job_name}_', dir=self.spool_dir)
+        try:
+            file_paths = {argument: _write(job_dir, f'input_{argument}', data) for argument, data in (files or {}).items()}
+            job_process = self._idle.get()
+            # Job khác có thể đã lỗi trong lúc chờ tiến trình rảnh: trả tiến trình lại nhóm thay vì gửi job rồi dừng nó
+            if cancel_event is not None and cancel_event.is_set():
+                self._idle.put(job_process)
+                raise JobCancelledError("Job đã bị hủy.")
+            if job_process is None:
+                job_process = _JobProcess(self._ctx)
+            try:
+                job_process.conn.send((job_name, file_paths, kwargs, log_context_fields(), job_dir))
+                reply = self._wait_reply(job_process, cancel_event)
+            except JobCancelledError:
+                self._replace(job_process, killed=True)
+                raise
+            except Exception as e:
+                job_process.process.join(timeout=1)
+                exitcode = job_process.process.exitcode
+                self._replace(job_process, killed=True)
+                raise JobCrashedError(f"Tiến trình xử lý bị dừng bất thường (mã thoát {exitcode}): {e}") from e
+            if reply is None:
+                self._replace(job_process, killed=True)
+                raise JobTimeoutError(f"Xử lý vượt quá {int(self.timeout_seconds)} giây và đã bị dừng. "
+                                      "Vui lòng kiểm tra lại file tải lên.")
+            job_process.tasks += 1
+            if job_process.tasks < self.max_tasks_per_child:
+                self._idle.put(job_process)
+            else:
+                self._replace(job_process)
+            status, payload, stats = reply
+            _merge_job_stats(stats)
+            if status == 'error':
+                is_value_error, message = payload
+                raise ValueError(message) if is_value_error else RuntimeError(message)
+            return _decode_result(payload)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def run_parallel(self, jobs):
+        """
+        Chạy đồng thời nhiều job độc lập, mỗi job một tiến trình xử lý; trả về danh sách kết quả theo thứ tự jobs.
+        jobs: [(job_name, files, kwargs)]. Job đầu tiên lỗi làm các job còn lại bị hủy ngay, lỗi của nó được ném lại
+        kèm thuộc tính job_index (vị trí của job lỗi trong jobs).
+        Khi nhóm bị tắt (hoặc đang ở trong tiến trình xử lý) các job chạy lần lượt ngay tại chỗ.
+        """
+        if not self.enabled or _in_job_process:
+            results = []
+            for job_index, (job_name, files, kwargs) in enumerate(jobs):
+                try:
+                    results.append(_resolve(job_name)(**(files or {}), **kwargs))
+                except Exception as e:
+                    e.job_index = job_index
+                    raise
+            return results
+        cancel_event = threading.Event()
+        # Không cần nhiều luồng chờ hơn số tiến trình trong nhóm: job chưa đến lượt bị hủy ngay khi có job lỗi
+        with ThreadPoolExecutor(max_workers=min(len(jobs), self.size), thread_name_prefix='job-pool-parallel') as executor:
+            # Mỗi luồng chạy trong bản sao ngữ cảnh của request: log và số liệu của job vẫn gắn với request
+            futures = [executor.submit(contextvars.copy_context().run, self.run, job_name, files, cancel_event, **kwargs)
+                       for job_name, files, kwargs in jobs]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            if any(future.exception() is not None for future in done):
+                cancel_event.set()
+                wait(futures)
+        for job_index, future in enumerate(futures):
+            error = future.exception()
+            if error is not None and not isinstance(error, JobCancelledError):
+                error.job_index = job_index
+                raise error
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            while True:
+                try:
+                    job_process = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if job_process is not None:
+                    job_process.stop()
+            self._pid = None
+
+
+def _merge_job_stats(stats):
+    """Đưa số liệu (số dòng, thời gian từng bước, bộ nhớ) của tiến trình xử lý vào request và /metrics của worker web."""
+    if not stats:
+        return
+    for name, amount in stats.get('rows', {}).items():
+        record_rows(name, amount)
+        flow, _, kind = name.partition('.')
+        ROWS_PROCESSED.inc(amount, flow=flow, kind=kind)
+    observe_stage_timings(stats.get('timings_ms', {}))
+    for name, milliseconds in stats.get('timings_ms', {}).items():
+        record_timing(name, milliseconds / 1000)
+    for flow, report in stats.get('memory', {}).items():
+        record_memory(flow, report)
+        observe_job_memory(flow, report)
+
+
+job_pool = JobPool()
+
+
+def run_job(job_name, files=None, **kwargs):
+    """Chạy handler trong nhóm tiến trình xử lý (hoặc trực tiếp nếu JOB_POOL_SIZE=0)."""
+    return job_pool.run(job_name, files, **kwargs)
+
+
+def run_jobs_parallel(jobs):
+    """Chạy đồng thời các job độc lập [(job_name, files, kwargs)], hủy các job còn lại nếu một job lỗi."""
+    return job_pool.run_parallel(jobs)
@@ -0,0 +1,415 @@
+"""
+Kiểm thử tải mô phỏng cao điểm cuối tháng: N cửa hàng đồng thời tải bảng kê HĐĐT/POS lên UpSSE
+và chạy đối soát Log bơm, với số dòng như thực tế. Báo cáo p50/p95/p99, thông lượng, tỷ lệ lỗi
+và bộ nhớ, dùng để chọn số worker/thread cho gunicorn.conf.py dựa trên số liệu đo được.
+
+Cách dùng:
+    python loadtest.py                                   # test client trong tiến trình (không qua socket)
+    python loadtest.py --url http://localhost:8080       # bắn vào server đang chạy
+    python loadtest.py --spawn-gunicorn --configs 1x4,2x2,4x1
+                                                         # khởi động gunicorn.conf.py với từng cấu hình workers x threads
+Tùy chọn: --stores 10 (số cửa hàng đồng thời), --rounds 2 (số lượt mỗi cửa hàng),
+--sizes 300,800,1500 (số dòng mỗi bảng kê, luân phiên giữa các cửa hàng), --mix hddt,pos,reconcile, --json.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = ('hddt', 'pos', 'reconcile')
+_MEMORY_FIELDS = ('Rss', 'Pss')
+
+
+# --- DỮ LIỆU TẢI ---
+def build_workload(stores, sizes, mix=OPERATIONS, seed=1):
+    """
+    Mỗi cửa hàng một danh sách thao tác (loại, endpoint, tệp, tham số) dựng sẵn trước khi đo,
+    để thời gian sinh tệp Excel không bị tính vào độ trễ.
+    """
+    from synthetic_data import hddt_report, pos_report, reconciliation_pair
+
+    workload = []
+    day = datetime(2025, 7, 31)
+    for index, store in enumerate(stores):
+        rows = sizes[index % len(sizes)]
+        store_seed = seed * 1000 + index
+        operations = []
+        if 'hddt' in mix:
+            operations.append(('hddt', '/api/v1/process',
+                               {'file': hddt_report(rows, day, store['symbol'], store_seed)},
+                               {'chxd': store['name'], 'price_periods': '1'}))
+        if 'pos' in mix:
+            operations.append(('pos', '/api/v1/process',
+                               {'file': pos_report(rows, day, store['symbol'], store_seed + 1)},
+                               {'chxd': store['name'], 'price_periods': '1'}))
+        if 'reconcile' in mix:
+            log_bom_bytes, hddt_bytes = reconciliation_pair(rows, day, store['name'], store['symbol'], store_seed + 2)
+            operations.append(('reconcile', '/api/v1/reconcile',
+                               {'file_log_bom': log_bom_bytes, 'file_hddt': hddt_bytes}, {'chxd': store['name']}))
+        workload.append({'store': store['name'], 'rows': rows, 'operations': operations})
+    return workload
+
+
+# --- ĐÍCH GỬI REQUEST ---
+class InProcessTarget:
+    """Gửi request qua Flask test client trong chính tiến trình này (không có chi phí mạng/gunicorn)."""
+
+    name = 'in-process'
+
+    def __init__(self, web_app):
+        self.web_app = web_app
+        self._local = threading.local()
+
+    def post(self, path, files, data):
+        import io
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.web_app.app.test_client()
+        form = dict(data)
+        form.update({field: (io.BytesIO(content), f'{field}.xlsx') for field, content in files.items()})
+        response = client.post(path, data=form, content_type='multipart/form-data')
+        return response.status_code, len(response.get_data())
+
+    def memory_pids(self):
+        return [os.getpid()]
+
+
+class HttpTarget:
+    """Gửi request multipart qua socket tới server đang chạy (gunicorn hoặc flask run)."""
+
+    def __init__(self, base_url, server_pid=None, timeout=600):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.name = self.base_url
+        self.server_pid = server_pid
+        self.timeout = timeout
+        self._requests = requests
+        self._local = threading.local()
+
+    def post(self, path, files, data):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        upload = {field: (f'{field}.xlsx', content) for field, content in files.items()}
+        response = session.post(self.base_url + path, files=upload, data=data, timeout=self.timeout)
+        return response.status_code, len(response.content)
+
+    def memory_pids(self):
+        return _process_tree(self.server_pid) if self.server_pid else []
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class GunicornServer:
+    """Khởi động gunicorn với gunicorn.conf.py (giống CMD trong Dockerfile), chỉ đổi cổng, workers và threads."""
+
+    def __init__(self, workers, threads, log_level=None, startup_timeout=120):
+        self.workers = workers
+        self.threads = threads
+        self.log_level = log_level
+        self.port = _free_port()
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.log_path = None
+
+    def __enter__(self):
+        env = dict(os.environ, PORT=str(self.port), WEB_CONCURRENCY=str(self.workers),
+                   GUNICORN_THREADS=str(self.threads))
+        env.pop('LOG_LEVEL', None)
+        if self.log_level:
+            env['LOG_LEVEL'] = self.log_level
+        log_fd, self.log_path = tempfile.mkstemp(prefix=f'gunicorn_{self.workers}x{self.threads}_', suffix='.log')
+        self.process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
+                                        cwd=APP_DIR, env=env, stdout=log_fd, stderr=log_fd)
+        os.close(log_fd)
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn dừng khi khởi động, xem log: {self.log_path}")
+            # Chờ đủ số worker được fork và cổng nhận kết nối
+            if len(_process_tree(self.process.pid)) > self.workers:
+                try:
+                    with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                        return self
+                except OSError:
+                    pass
+            time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f"gunicorn không sẵn sàng sau {self.startup_timeout}s, xem log: {self.log_path}")
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+
+# --- ĐO BỘ NHỚ ---
+def _process_tree(root_pid):
+    """PID của tiến trình gốc và các tiến trình con (master gunicorn + worker), đọc từ /proc."""
+    parents = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [root_pid]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Tên tiến trình nằm trong ngoặc và có thể chứa khoảng trắng: PPID là trường thứ 2 sau ')'
+                parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(child for child, parent in parents.items() if parent == pid)
+    return pids
+
+
+def _read_process_memory(pid):
+    values = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].rstrip(':') in _MEMORY_FIELDS:
+                    values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+class MemorySampler:
+    """
+    Lấy mẫu định kỳ tổng RSS/PSS của các tiến trình server trong lúc chạy tải.
+    PSS chia đều phần bộ nhớ chia sẻ copy-on-write giữa các worker, nên tổng PSS gần với
+    mức bộ nhớ thực sự bị tính vào giới hạn của container hơn tổng RSS.
+    """
+
+    def __init__(self, pids_provider, interval=0.25):
+        self.pids_provider = pids_provider
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        pids = self.pids_provider()
+        per_process = [_read_process_memory(pid) for pid in pids]
+        self.samples.append({
+            'processes': len(pids),
+            'rss_bytes': sum(p.get('Rss', 0) for p in per_process),
+            'pss_bytes': sum(p.get('Pss', 0) for p in per_process),
+            'max_process_rss_bytes': max((p.get('Rss', 0) for p in per_process), default=0),
+        })
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name='loadtest-memory', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def summary(self):
+        if not self.samples or not any(s['rss_bytes'] for s in self.samples):
+            return None
+        return {
+            'processes': self.samples[-1]['processes'],
+            'start_rss_mb': _mb(self.samples[0]['rss_bytes']),
+            'peak_rss_mb': _mb(max(s['rss_bytes'] for s in self.samples)),
+            'peak_pss_mb': _mb(max(s['pss_bytes'] for s in self.samples)),
+            'end_pss_mb': _mb(self.samples[-1]['pss_bytes']),
+            'peak_process_rss_mb': _mb(max(s['max_process_rss_bytes'] for s in self.samples)),
+        }
+
+
+def _mb(value):
+    return round(value / (1024 * 1024), 1)
+
+
+# --- CHẠY TẢI VÀ TỔNG HỢP ---
+def _percentile(sorted_values, percent):
+    """Phân vị theo thứ hạng gần nhất (không nội suy), đủ cho vài trăm mẫu."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def _summarize(results, wall_seconds):
+    latencies = sorted(r['seconds'] for r in results)
+    errors = sum(1 for r in results if not r['ok'])
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 1) if latencies else None,
+        'p95_ms': round(_percentile(latencies, 95) * 1000, 1) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 1) if latencies else None,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 1) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 1) if latencies else None,
+        'throughput_rps': round(len(results) / wall_seconds, 2) if wall_seconds > 0 else None,
+    }
+
+
+def run_load(target, workload, rounds=1, concurrency=None):
+    """
+    Mỗi cửa hàng là một người dùng ảo chạy lần lượt các thao tác của mình `rounds` lượt;
+    các cửa hàng chạy đồng thời (tối đa `concurrency` cùng lúc, mặc định tất cả).
+    """
+    results = []
+    results_lock = threading.Lock()
+    gate = threading.Semaphore(concurrency or len(workload))
+    start_barrier = threading.Barrier(len(workload) + 1)
+
+    def _store_user(item):
+        start_barrier.wait()
+        with gate:
+            for _ in range(rounds):
+                for operation, path, files, data in item['operations']:
+                    started = time.perf_counter()
+                    try:
+                        status, size = target.post(path, files, data)
+                        outcome = {'ok': status == 200, 'status': status, 'bytes': size}
+                    except Exception as e:
+                        outcome = {'ok': False, 'status': None, 'error': f"{type(e).__name__}: {e}"}
+                    outcome.update(operation=operation, store=item['store'], rows=item['rows'],
+                                   seconds=time.perf_counter() - started)
+                    with results_lock:
+                        results.append(outcome)
+
+    threads = [threading.Thread(target=_store_user, args=(item,), name=f"store-{index}", daemon=True)
+               for index, item in enumerate(workload)]
+    for thread in threads:
+        thread.start()
+    with MemorySampler(target.memory_pids) as sampler:
+        start_barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.perf_counter() - started
+
+    report = {
+        'target': target.name,
+        'stores': len(workload),
+        'rounds': rounds,
+        'wall_seconds': round(wall_seconds, 2),
+        'overall': _summarize(results, wall_seconds),
+        'operations': {op: _summarize([r for r in results if r['operation'] == op], wall_seconds)
+                       for op in OPERATIONS if any(r['operation'] == op for r in results)},
+        'memory': sampler.summary(),
+        'error_samples': sorted({r.get('error') or f"HTTP {r['status']}" for r in results if not r['ok']})[:5],
+    }
+    return report
+
+
+def format_report(report):
+    lines = [f"== {report.get('config', report['target'])}: {report['stores']} cửa hàng x {report['rounds']} lượt, "
+             f"{report['wall_seconds']}s =="]
+    lines.append(f"{'thao tác':<12} {'số req':>7} {'lỗi':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'req/s':>7}")
+    for name, stats in [*report['operations'].items(), ('TỔNG', report['overall'])]:
+        lines.append(f"{name:<12} {stats['requests']:>7} {stats['errors']:>5} {stats['p50_ms']:>9} {stats['p95_ms']:>9} "
+                     f"{stats['p99_ms']:>9} {stats['max_ms']:>9} {stats['throughput_rps']:>7}")
+    memory = report['memory']
+    if memory:
+        lines.append(f"Bộ nhớ ({memory['processes']} tiến trình): RSS {memory['start_rss_mb']} -> đỉnh {memory['peak_rss_mb']} MB, "
+                     f"PSS đỉnh {memory['peak_pss_mb']} MB, tiến trình lớn nhất {memory['peak_process_rss_mb']} MB")
+    for sample in report['error_samples']:
+        lines.append(f"  lỗi: {sample}")
+    return '\n'.join(lines)
+
+
+def _parse_configs(value):
+    configs = []
+    for part in value.split(','):
+        workers, _, threads = part.strip().lower().partition('x')
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm thử tải UpSSE/đối soát mô phỏng cao điểm cuối tháng.")
+    parser.add_argument('--stores', type=int, default=10, help="Số cửa hàng tải lên đồng thời")
+    parser.add_argument('--rounds', type=int, default=1, help="Số lượt mỗi cửa hàng")
+    parser.add_argument('--sizes', default='300,800,1500', help="Số dòng mỗi bảng kê, luân phiên theo cửa hàng")
+    parser.add_argument('--mix', default=','.join(OPERATIONS), help="Các thao tác: hddt,pos,reconcile")
+    parser.add_argument('--concurrency', type=int, help="Số cửa hàng chạy cùng lúc (mặc định: tất cả)")
+    parser.add_argument('--seed', type=int, default=1)
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument('--url', help="Địa chỉ server đang chạy")
+    target_group.add_argument('--spawn-gunicorn', action='store_true', help="Tự khởi động gunicorn cho từng cấu hình")
+    parser.add_argument('--server-pid', type=int, help="PID master gunicorn để đo bộ nhớ khi dùng --url")
+    parser.add_argument('--configs', default=None,
+                        help="Danh sách workers x threads khi dùng --spawn-gunicorn, ví dụ 1x4,2x2,4x1")
+    parser.add_argument('--json', action='store_true', help="In báo cáo dạng JSON")
+    args = parser.parse_args(argv)
+
+    # Cấu hình tĩnh (Data_HDDT.xlsx...) được nạp theo đường dẫn tương đối với thư mục ứng dụng
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    # Log từng request của app trong tiến trình này lẫn vào báo cáo; gunicorn được khởi động với mức log gốc
+    server_log_level = os.environ.get('LOG_LEVEL')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import app as web_app
+
+    all_stores = web_app.get_chxd_list()
+    if not all_stores:
+        print("Không đọc được danh sách CHXD từ Data_HDDT.xlsx.")
+        return 1
+    stores = [all_stores[i % len(all_stores)] for i in range(args.stores)]
+    sizes = [int(size) for size in args.sizes.split(',')]
+    mix = [op.strip() for op in args.mix.split(',') if op.strip() in OPERATIONS]
+    workload = build_workload(stores, sizes, mix, args.seed)
+
+    reports = []
+    if args.spawn_gunicorn:
+        configs = _parse_configs(args.configs or f"{os.cpu_count() or 1}x4")
+        for workers, threads in configs:
+            with GunicornServer(workers, threads, server_log_level) as server:
+                report = run_load(HttpTarget(server.url, server.process.pid), workload, args.rounds, args.concurrency)
+            report['config'] = f"gunicorn {workers} worker x {threads} thread"
+            reports.append(report)
+            if not args.json:
+                print(format_report(report), flush=True)
+    else:
+        target = HttpTarget(args.url, args.server_pid) if args.url else InProcessTarget(web_app)
+        reports.append(run_load(target, workload, args.rounds, args.concurrency))
+        if not args.json:
+            print(format_report(reports[0]))
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    return 1 if any(r['overall']['errors'] for r in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
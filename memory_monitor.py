@@ -0,0 +1,97 @@
+import os
+import resource
+import threading
+import time
+
+# --- ĐO BỘ NHỚ TIẾN TRÌNH ---
+# Đọc trực tiếp từ /proc (Linux/Cloud Run), không cần thư viện ngoài.
+# Trên hệ điều hành không có /proc, các giá trị không đo được sẽ là None.
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_SMAPS_FIELDS = {
+    'Rss': 'rss_bytes',
+    'Pss': 'pss_bytes',
+    'Shared_Clean': 'shared_clean_bytes',
+    'Shared_Dirty': 'shared_dirty_bytes',
+    'Private_Clean': 'private_clean_bytes',
+    'Private_Dirty': 'private_dirty_bytes',
+}
+
+_baseline_lock = threading.Lock()
+_baseline = {'pid': None, 'rss_bytes': None, 'private_bytes': None, 'since': None}
+
+
+def current_rss_bytes():
+    """RSS hiện tại của tiến trình (bytes)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    """RSS lớn nhất từ khi tiến trình khởi động (bytes)."""
+    # ru_maxrss tính bằng KB trên Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_memory_breakdown():
+    """
+    Phân tích bộ nhớ tiến trình: RSS, PSS, phần chia sẻ và phần riêng.
+    Phần 'shared' lớn và 'private' nhỏ nghĩa là cấu hình nạp trước khi fork vẫn được chia sẻ copy-on-write.
+    """
+    breakdown = {key: None for key in _SMAPS_FIELDS.values()}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].rstrip(':') in _SMAPS_FIELDS:
+                    breakdown[_SMAPS_FIELDS[parts[0].rstrip(':')]] = int(parts[1]) * 1024
+    except (OSError, ValueError):
+        breakdown['rss_bytes'] = current_rss_bytes()
+    if breakdown['private_clean_bytes'] is not None and breakdown['private_dirty_bytes'] is not None:
+        breakdown['private_bytes'] = breakdown['private_clean_bytes'] + breakdown['private_dirty_bytes']
+    else:
+        breakdown['private_bytes'] = None
+    breakdown['peak_rss_bytes'] = peak_rss_bytes()
+    return breakdown
+
+
+def mark_baseline():
+    """Ghi nhận mốc bộ nhớ (gọi ngay sau khi worker được fork) để đo mức tăng của từng worker."""
+    breakdown = read_memory_breakdown()
+    with _baseline_lock:
+        _baseline.update({
+            'pid': os.getpid(),
+            'rss_bytes': breakdown['rss_bytes'],
+            'private_bytes': breakdown['private_bytes'],
+            'since': time.time()
+        })
+
+
+def memory_report():
+    """Báo cáo bộ nhớ của worker hiện tại kèm mức tăng so với mốc sau khi fork."""
+    breakdown = read_memory_breakdown()
+    with _baseline_lock:
+        if _baseline['pid'] != os.getpid():
+            baseline = {'pid': os.getpid(), 'rss_bytes': None, 'private_bytes': None, 'since': None}
+        else:
+            baseline = dict(_baseline)
+
+    def _growth(key):
+        if breakdown.get(key) is None or baseline.get(key) is None:
+            return None
+        return breakdown[key] - baseline[key]
+
+    return {
+        'pid': os.getpid(),
+        'ppid': os.getppid(),
+        **breakdown,
+        'baseline_rss_bytes': baseline['rss_bytes'],
+        'baseline_private_bytes': baseline['private_bytes'],
+        'rss_growth_bytes': _growth('rss_bytes'),
+        'private_growth_bytes': _growth('private_bytes'),
+        'uptime_seconds': round(time.time() - baseline['since'], 1) if baseline['since'] else None
+    }
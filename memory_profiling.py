@@ -0,0 +1,243 @@
+import contextvars
+import linecache
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+from memory_monitor import current_rss_bytes
+from structured_logging import record_memory
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# Khoảng lấy mẫu RSS trong lúc job chạy (giây); 0 = chỉ đo đầu/cuối job và ranh giới các bước
+DEFAULT_SAMPLE_INTERVAL = float(os.environ.get('MEMORY_JOB_SAMPLE_INTERVAL', 0.05))
+# Job làm RSS tăng quá ngưỡng này (MB, đỉnh so với lúc bắt đầu) thì ghi cảnh báo kèm các vị trí cấp phát lớn nhất
+DEFAULT_THRESHOLD_MB = float(os.environ.get('MEMORY_JOB_THRESHOLD_MB', 150))
+# tracemalloc làm chậm xử lý 1.5-3 lần nên chỉ bật khi cần tìm nguồn cấp phát (MEMORY_TRACEMALLOC=1)
+DEFAULT_TRACEMALLOC = os.environ.get('MEMORY_TRACEMALLOC', '0') == '1'
+DEFAULT_TRACEMALLOC_FRAMES = int(os.environ.get('MEMORY_TRACEMALLOC_FRAMES', 1))
+DEFAULT_TOP_ALLOCATIONS = int(os.environ.get('MEMORY_TOP_ALLOCATIONS', 10))
+
+_MB = 1024 * 1024
+_current_job = contextvars.ContextVar('upsse_memory_job', default=None)
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+)
+
+
+def _mb(value):
+    return None if value is None else round(value / _MB, 1)
+
+
+class JobMemory:
+    """
+    Số đo bộ nhớ của một job (một lần gọi handler): RSS trước/đỉnh/sau, đỉnh theo từng bước
+    (ranh giới bước lấy từ StageTimer/stage_timer) và đỉnh bộ nhớ Python theo tracemalloc nếu bật.
+    RSS là số liệu của cả tiến trình: khi nhiều job chạy song song trong một worker, đỉnh của job
+    bao gồm cả phần của các job khác đang chạy cùng lúc (xem trường 'concurrent_jobs').
+    """
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.rss_before = current_rss_bytes()
+        self.rss_peak = self.rss_before
+        self.traced_peak = None
+        self.concurrent_jobs = 1
+        self.stages = {}
+        self.peak_snapshot = None
+        self._snapshot_size = 0
+        self._stage_started_rss = self.rss_before
+        self._stage_peak = self.rss_before
+        self._lock = threading.Lock()
+
+    def observe(self, rss, traced=None):
+        if rss is None:
+            return
+        with self._lock:
+            if rss > (self.rss_peak or 0):
+                self.rss_peak = rss
+            if rss > (self._stage_peak or 0):
+                self._stage_peak = rss
+            if traced is not None and traced > (self.traced_peak or 0):
+                self.traced_peak = traced
+
+    def end_stage(self, stage):
+        rss = current_rss_bytes()
+        self.observe(rss, _traced_current())
+        with self._lock:
+            if rss is not None and self._stage_started_rss is not None:
+                self.stages[stage] = {
+                    'peak_growth_bytes': max(0, self._stage_peak - self._stage_started_rss),
+                    'retained_bytes': rss - self._stage_started_rss,
+                }
+            self._stage_started_rss = self._stage_peak = rss
+
+    def wants_snapshot(self, traced_current, threshold_bytes):
+        """Cần chụp snapshot tracemalloc mới khi vượt ngưỡng và lớn hơn lần chụp trước 10% (giữ snapshot ở mức cao nhất)."""
+        return traced_current >= max(threshold_bytes, self._snapshot_size * 1.1)
+
+    def set_snapshot(self, snapshot, traced_current):
+        self._snapshot_size = traced_current
+        self.peak_snapshot = snapshot
+
+    def report(self, rss_after):
+        growth = None if self.rss_peak is None or self.rss_before is None else self.rss_peak - self.rss_before
+        retained = None if rss_after is None or self.rss_before is None else rss_after - self.rss_before
+        return {
+            'flow': self.flow,
+            'rss_before_mb': _mb(self.rss_before),
+            'rss_peak_mb': _mb(self.rss_peak),
+            'rss_after_mb': _mb(rss_after),
+            'rss_growth_mb': _mb(growth),
+            'rss_retained_mb': _mb(retained),
+            'traced_peak_mb': _mb(self.traced_peak),
+            'concurrent_jobs': self.concurrent_jobs,
+            'stages_mb': {stage: {key.replace('_bytes', '_mb'): _mb(value) for key, value in values.items()}
+                          for stage, values in self.stages.items()},
+        }
+
+
+def _traced_current():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+
+def top_allocations(snapshot, limit=DEFAULT_TOP_ALLOCATIONS):
+    """Các vị trí cấp phát chiếm nhiều bộ nhớ nhất trong snapshot (file:dòng, MB, số khối)."""
+    key_type = 'traceback' if DEFAULT_TRACEMALLOC_FRAMES > 1 else 'lineno'
+    result = []
+    for stat in snapshot.statistics(key_type)[:limit]:
+        frames = [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback]
+        result.append({'site': ' <- '.join(frames), 'size_mb': _mb(stat.size), 'count': stat.count})
+    return result
+
+
+class JobMemoryTracker:
+    """
+    Đo bộ nhớ quanh mỗi lần gọi handler. Một luồng nền dùng chung lấy mẫu RSS (và bộ nhớ tracemalloc)
+    cho mọi job đang chạy trong tiến trình; luồng chỉ chạy khi có job.
+    """
+
+    def __init__(self, sample_interval=DEFAULT_SAMPLE_INTERVAL, threshold_mb=DEFAULT_THRESHOLD_MB,
+                 use_tracemalloc=DEFAULT_TRACEMALLOC, tracemalloc_frames=DEFAULT_TRACEMALLOC_FRAMES):
+        self.sample_interval = sample_interval
+        self.threshold_bytes = int(threshold_mb * _MB)
+        self.use_tracemalloc = use_tracemalloc
+        self.tracemalloc_frames = tracemalloc_frames
+        self._jobs = set()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_pid = None
+        self._wakeup = threading.Event()
+
+    def _ensure_sampler(self):
+        # Luồng nền không tồn tại sau khi fork (gunicorn preload), mỗi tiến trình tự khởi động lại
+        if self.sample_interval <= 0:
+            return
+        if self._sampler_pid != os.getpid() or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._sample_loop, name='job-memory-sampler', daemon=True)
+            self._sampler_pid = os.getpid()
+            self._sampler.start()
+        self._wakeup.set()
+
+    def _sample_loop(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                jobs = list(self._jobs)
+                if not jobs:
+                    self._wakeup.clear()
+                    continue
+            rss = current_rss_bytes()
+            traced = _traced_current()
+            for job in jobs:
+                job.observe(rss, traced)
+                job.concurrent_jobs = max(job.concurrent_jobs, len(jobs))
+            if traced is not None:
+                # Snapshot là của cả tiến trình: chụp một lần, dùng chung cho các job cần
+                waiting = [job for job in jobs if job.wants_snapshot(traced, self.threshold_bytes)]
+                if waiting:
+                    try:
+                        snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+                        for job in waiting:
+                            job.set_snapshot(snapshot, traced)
+                    except Exception:
+                        pass
+            time.sleep(self.sample_interval)
+
+    @contextmanager
+    def track(self, flow):
+        """Đo bộ nhớ của một job; kết quả ghi vào log (kèm vị trí cấp phát nếu vượt ngưỡng), metrics và tóm tắt request."""
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            # Bắt đầu ở job đầu tiên của worker: cấu hình nạp sẵn trước khi fork không bị tính vào snapshot
+            tracemalloc.start(self.tracemalloc_frames)
+        job = JobMemory(flow)
+        token = _current_job.set(job)
+        with self._lock:
+            # Đỉnh tracemalloc là của cả tiến trình: chỉ đặt lại khi không có job nào khác đang chạy
+            if not self._jobs and tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            self._jobs.add(job)
+            job.concurrent_jobs = len(self._jobs)
+        self._ensure_sampler()
+        try:
+            yield job
+        finally:
+            with self._lock:
+                self._jobs.discard(job)
+            _current_job.reset(token)
+            if tracemalloc.is_tracing():
+                job.observe(current_rss_bytes(), tracemalloc.get_traced_memory()[1])
+            self._finish(job)
+
+    def _finish(self, job):
+        rss_after = current_rss_bytes()
+        job.observe(rss_after)
+        report = job.report(rss_after)
+        over_threshold = job.rss_peak is not None and job.rss_before is not None \
+            and job.rss_peak - job.rss_before >= self.threshold_bytes
+        if over_threshold and job.peak_snapshot is not None:
+            report['top_allocations'] = top_allocations(job.peak_snapshot)
+        record_memory(job.flow, report)
+        try:
+            from metrics import observe_job_memory
+            observe_job_memory(job.flow, report, over_threshold)
+        except Exception:
+            pass
+        if over_threshold:
+            logger.warning("Job dùng nhiều bộ nhớ: RSS tăng %s MB (ngưỡng %s MB).", report['rss_growth_mb'],
+                           _mb(self.threshold_bytes), extra={'memory': report})
+        else:
+            logger.debug("Bộ nhớ của job.", extra={'memory': report})
+
+
+job_memory_tracker = JobMemoryTracker()
+
+
+def track_job_memory(flow):
+    return job_memory_tracker.track(flow)
+
+
+def memory_tracked(flow):
+    """Decorator: đo bộ nhớ của mỗi lần gọi hàm xử lý như một job thuộc luồng `flow`."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with job_memory_tracker.track(flow):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def end_stage_memory(flow, stage):
+    """Ghi nhận kết thúc một bước của job đang chạy (gọi từ StageTimer/stage_timer)."""
+    job = _current_job.get()
+    if job is not None:
+        job.end_stage(f"{flow}.{stage}")
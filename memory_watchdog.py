@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from memory_monitor import current_rss_bytes
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# openpyxl/PyMuPDF làm phân mảnh heap: RSS của worker không giảm lại sau nhiều job lớn.
+# Khi RSS sau một request vượt ngưỡng (MB), worker ngừng nhận request mới, xử lý nốt request đang chạy
+# rồi thoát để gunicorn tạo worker mới. 0 = tắt.
+DEFAULT_RECYCLE_RSS_MB = float(os.environ.get('MEMORY_RECYCLE_RSS_MB', 1024))
+# Worker phải phục vụ tối thiểu số request này mới được tái tạo, tránh vòng lặp tái tạo liên tục
+# khi ngưỡng đặt thấp hơn RSS nền của worker mới
+DEFAULT_RECYCLE_MIN_REQUESTS = int(os.environ.get('MEMORY_RECYCLE_MIN_REQUESTS', 20))
+# Sự kiện tái tạo được ghi ra tệp dùng chung để worker mới (và mọi worker khác) vẫn báo được trên /metrics
+DEFAULT_RECYCLE_EVENTS_FILE = os.environ.get(
+    'MEMORY_RECYCLE_EVENTS_FILE', os.path.join(tempfile.gettempdir(), 'upsse_worker_recycles.jsonl'))
+
+
+class MemoryWatchdog:
+    """Theo dõi RSS của worker gunicorn sau mỗi request và yêu cầu tái tạo worker một cách an toàn khi vượt ngưỡng."""
+
+    def __init__(self, rss_limit_mb=DEFAULT_RECYCLE_RSS_MB, min_requests=DEFAULT_RECYCLE_MIN_REQUESTS,
+                 events_file=DEFAULT_RECYCLE_EVENTS_FILE):
+        self.rss_limit_bytes = int(rss_limit_mb * 1024 * 1024)
+        self.min_requests = min_requests
+        self.events_file = events_file
+        self._lock = threading.Lock()
+        self._recycling_pid = None
+
+    @property
+    def enabled(self):
+        return self.rss_limit_bytes > 0
+
+    def should_recycle(self, rss_bytes, requests_handled):
+        if not self.enabled or rss_bytes is None:
+            return False
+        return requests_handled >= self.min_requests and rss_bytes >= self.rss_limit_bytes
+
+    def is_recycling(self):
+        """Worker hiện tại đã được yêu cầu tái tạo (đang xử lý nốt request trước khi thoát)."""
+        return self._recycling_pid == os.getpid()
+
+    def check_worker(self, worker):
+        """
+        Gọi từ hook post_request của gunicorn. Đặt worker.alive = False: vòng lặp của worker gthread ngừng
+        nhận kết nối mới, chờ các request đang chạy xong (tối đa graceful_timeout) rồi thoát;
+        master gunicorn tự tạo worker thay thế.
+        """
+        if not self.enabled:
+            return False
+        rss = current_rss_bytes()
+        with self._lock:
+            if self.is_recycling() or not self.should_recycle(rss, worker.nr):
+                return False
+            self._recycling_pid = os.getpid()
+        worker.alive = False
+        self.record_recycle(rss, worker.nr)
+        return True
+
+    def record_recycle(self, rss_bytes, requests_handled, reason='rss'):
+        event = {'ts': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid(), 'reason': reason,
+                 'rss_bytes': rss_bytes, 'rss_limit_bytes': self.rss_limit_bytes, 'requests': requests_handled}
+        logger.warning("Worker %s vượt ngưỡng bộ nhớ (RSS %s MB >= %s MB sau %s request): ngừng nhận request mới, "
+                       "xử lý nốt request đang chạy rồi tái tạo.", os.getpid(), round(rss_bytes / (1024 * 1024), 1),
+                       round(self.rss_limit_bytes / (1024 * 1024), 1), requests_handled, extra={'recycle': event})
+        try:
+            # Ghi một dòng ngắn ở chế độ append: các worker ghi đồng thời không chồng lên nhau
+            with open(self.events_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event) + '\n')
+        except OSError as e:
+            logger.warning("Không ghi được sự kiện tái tạo worker: %s", e)
+
+    def recycle_events(self):
+        try:
+            with open(self.events_file, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            return []
+
+    def recycle_counts(self):
+        """Số lần tái tạo worker theo lý do, cho metric upsse_worker_recycles_total."""
+        counts = {}
+        for event in self.recycle_events():
+            key = (event.get('reason', 'rss'),)
+            counts[key] = counts.get(key, 0) + 1
+        return counts or {('rss',): 0}
+
+
+memory_watchdog = MemoryWatchdog()
@@ -0,0 +1,470 @@
+import atexit
+import bisect
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from memory_profiling import end_stage_memory
+from structured_logging import record_rows, record_timing
+
+logger = logging.getLogger(__name__)
+
+# --- SỐ LIỆU ĐO LƯỜNG (định dạng văn bản Prometheus) ---
+# Số liệu được giữ trong bộ nhớ của từng tiến trình worker. Khi chạy nhiều worker gunicorn, mỗi worker định kỳ
+# ghi ảnh chụp số liệu của mình ra tệp <pid>.json trong thư mục dùng chung; lần scrape /metrics gộp tệp của mọi
+# worker (counter/histogram cộng dồn, gauge chỉ cộng các worker còn sống), nên số liệu không nhảy lên xuống
+# theo worker phục vụ scrape. Số liệu của worker đã thoát được gộp vào archive.json để counter không bị giảm.
+# Các giá trị đọc bằng callback (bộ nhớ, tệp tạm...) được đọc tại worker phục vụ scrape.
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# Thư mục dùng chung cho số liệu của các worker (để trống = mỗi worker chỉ báo số liệu của mình)
+DEFAULT_MULTIPROCESS_DIR = os.environ.get('METRICS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'upsse_metrics'))
+# Chu kỳ (giây) mỗi worker ghi ảnh chụp số liệu ra thư mục dùng chung
+DEFAULT_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+_ARCHIVE_FILE = 'archive.json'
+_LOCK_FILE = '.lock'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Mức tăng bộ nhớ của một job/bước xử lý (bytes): 1 MB ... 2 GB
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 200, 400, 800, 1200, 2048))
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = ''
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric '{self.name}' cần các nhãn {self.label_names}, nhận được {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def snapshot(self):
+        """Các giá trị hiện tại dạng [[nhãn], giá trị] (không gồm giá trị callback), để ghi ra tệp JSON."""
+        with self._lock:
+            return [[list(key), self._copy_value(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy_value(value):
+        return value
+
+    @staticmethod
+    def _merge_value(total, value):
+        return value if total is None else total + value
+
+    def merge(self, snapshots):
+        """Gộp các ảnh chụp (của nhiều tiến trình) thành {tuple nhãn: giá trị}."""
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                values[key] = self._merge_value(values.get(key), value)
+        return values
+
+    def render(self, values=None):
+        """values: giá trị đã gộp từ nhiều tiến trình; mặc định là giá trị của tiến trình hiện tại."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            lines.extend(self._render_samples(dict(self._values) if values is None else values))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        super().__init__(name, documentation, label_names)
+        # callback() -> {tuple nhãn: giá trị}, dùng cho bộ đếm được lưu ngoài tiến trình (ví dụ số lần tái tạo worker)
+        self._callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, values):
+        if self._callback:
+            try:
+                values.update(self._callback())
+            except Exception:
+                pass
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), callback=None):
+        super().__init__(name, documentation, label_names)
+        # callback() -> {tuple nhãn: giá trị}, dùng cho các giá trị chỉ đọc khi scrape (bộ nhớ, tệp tạm...)
+        self._callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _render_samples(self, values):
+        if self._callback:
+            try:
+                values.update(self._callback())
+            except Exception:
+                pass
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(values.items()) if value is not None]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._values[key] = state
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state['counts'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @staticmethod
+    def _copy_value(value):
+        return {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+
+    @staticmethod
+    def _merge_value(total, value):
+        if total is None:
+            return Histogram._copy_value(value)
+        total['counts'] = [a + b for a, b in zip(total['counts'], value['counts'])]
+        total['sum'] += value['sum']
+        total['count'] += value['count']
+        return total
+
+    def _render_samples(self, values):
+        lines = []
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', '+Inf'))} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state['count']}")
+        return lines
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    """Ghi tệp qua tệp tạm rồi đổi tên: tiến trình khác không bao giờ đọc phải tệp ghi dở."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def clear_multiprocess_dir(directory=DEFAULT_MULTIPROCESS_DIR):
+    """Xóa số liệu của lần chạy trước (gọi một lần từ master gunicorn khi khởi động)."""
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._directory = None
+        self._pid = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    # --- GỘP SỐ LIỆU NHIỀU WORKER ---
+    def enable_multiprocess(self, directory=DEFAULT_MULTIPROCESS_DIR, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        """
+        Gọi trong mỗi worker sau khi fork (post_fork): bắt đầu ghi ảnh chụp định kỳ ra directory
+        và gộp số liệu của mọi worker khi render.
+        """
+        if not directory or self._pid == os.getpid():
+            return
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logger.warning("Không tạo được thư mục số liệu dùng chung %s: %s", directory, e)
+            return
+        self._directory = directory
+        self._pid = os.getpid()
+        with self._directory_lock():
+            # Tệp cùng pid còn sót lại là của một worker đã thoát (pid được dùng lại): gộp vào archive trước
+            self._archive_dead({self._pid})
+        self.flush()
+
+        def _flush_loop():
+            while True:
+                time.sleep(flush_seconds)
+                self.flush()
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    @property
+    def multiprocess(self):
+        return self._directory is not None and self._pid == os.getpid()
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    @contextmanager
+    def _directory_lock(self):
+        with open(self._path(_LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def flush(self):
+        """Ghi ảnh chụp số liệu của worker hiện tại ra <pid>.json."""
+        if not self.multiprocess:
+            return
+        try:
+            _write_json(self._path(f'{self._pid}.json'), {'pid': self._pid, 'metrics': self._snapshot()})
+        except OSError as e:
+            logger.warning("Không ghi được số liệu của worker %s: %s", self._pid, e)
+
+    def _archive_dead(self, dead_pids=None):
+        """
+        Gộp counter/histogram của các worker đã thoát (hoặc của dead_pids) vào archive.json rồi xóa tệp của chúng.
+        Gauge của worker đã thoát bị bỏ. Phải gọi khi đang giữ khóa thư mục.
+        """
+        dead = []
+        for name in os.listdir(self._directory):
+            if not name.endswith('.json') or name == _ARCHIVE_FILE:
+                continue
+            pid = int(name[:-5]) if name[:-5].isdigit() else None
+            if pid is None or (pid in dead_pids if dead_pids is not None else not _pid_alive(pid)):
+                dead.append(name)
+        if not dead:
+            return
+        with self._lock:
+            metrics = {metric.name: metric for metric in self._metrics}
+        archive = (_read_json(self._path(_ARCHIVE_FILE)) or {}).get('metrics', {})
+        for name in dead:
+            data = _read_json(self._path(name)) or {}
+            for metric_name, snapshot in data.get('metrics', {}).items():
+                metric = metrics.get(metric_name)
+                if metric is None or isinstance(metric, Gauge):
+                    continue
+                merged = metric.merge([archive.get(metric_name, []), snapshot])
+                archive[metric_name] = [[list(key), value] for key, value in merged.items()]
+        _write_json(self._path(_ARCHIVE_FILE), {'metrics': archive})
+        for name in dead:
+            try:
+                os.unlink(self._path(name))
+            except OSError:
+                pass
+
+    def _merged_values(self):
+        """{tên metric: giá trị đã gộp} từ tệp của mọi worker (kể cả ảnh chụp mới nhất của worker hiện tại)."""
+        self.flush()
+        snapshots = {}
+        with self._directory_lock():
+            self._archive_dead()
+            for name in os.listdir(self._directory):
+                if name.endswith('.json'):
+                    data = _read_json(self._path(name)) or {}
+                    for metric_name, snapshot in data.get('metrics', {}).items():
+                        snapshots.setdefault(metric_name, []).append(snapshot)
+        with self._lock:
+            metrics = list(self._metrics)
+        return {metric.name: metric.merge(snapshots.get(metric.name, [])) for metric in metrics}
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        merged = None
+        if self.multiprocess:
+            try:
+                merged = self._merged_values()
+            except OSError as e:
+                logger.warning("Không gộp được số liệu của các worker, chỉ báo số liệu của worker hiện tại: %s", e)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(merged.get(metric.name) if merged is not None else None))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_DURATION = registry.register(Histogram(
+    'upsse_stage_duration_seconds', 'Thời gian từng bước xử lý theo luồng nghiệp vụ.', ('flow', 'stage')))
+STAGE_ERRORS = registry.register(Counter(
+    'upsse_stage_errors_total', 'Số lần một bước xử lý phát sinh lỗi.', ('flow', 'stage')))
+STAGE_IN_FLIGHT = registry.register(Gauge(
+    'upsse_stage_in_flight', 'Số bước xử lý đang chạy.', ('flow', 'stage')))
+REQUEST_DURATION = registry.register(Histogram(
+    'upsse_http_request_duration_seconds', 'Thời gian xử lý request HTTP.', ('endpoint', 'method')))
+REQUESTS_TOTAL = registry.register(Counter(
+    'upsse_http_requests_total', 'Số request HTTP theo mã trạng thái.', ('endpoint', 'method', 'status')))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    'upsse_http_requests_in_flight', 'Số request HTTP đang xử lý.', ('endpoint',)))
+ROWS_PROCESSED = registry.register(Counter(
+    'upsse_rows_processed_total', 'Số dòng dữ liệu đã xử lý theo luồng nghiệp vụ.', ('flow', 'kind')))
+JOB_RSS_GROWTH = registry.register(Histogram(
+    'upsse_job_rss_growth_bytes', 'Mức tăng RSS (đỉnh so với lúc bắt đầu) của mỗi job.', ('flow',), MEMORY_BUCKETS))
+JOB_RSS_RETAINED = registry.register(Histogram(
+    'upsse_job_rss_retained_bytes', 'RSS còn giữ lại sau khi job kết thúc (so với lúc bắt đầu).', ('flow',), MEMORY_BUCKETS))
+JOB_TRACED_PEAK = registry.register(Histogram(
+    'upsse_job_traced_peak_bytes', 'Đỉnh bộ nhớ Python (tracemalloc) của mỗi job, chỉ có khi bật MEMORY_TRACEMALLOC.',
+    ('flow',), MEMORY_BUCKETS))
+STAGE_RSS_GROWTH = registry.register(Histogram(
+    'upsse_stage_rss_growth_bytes', 'Mức tăng RSS (đỉnh) trong từng bước xử lý.', ('flow', 'stage'), MEMORY_BUCKETS))
+JOB_MEMORY_OVER_THRESHOLD = registry.register(Counter(
+    'upsse_job_memory_over_threshold_total', 'Số job làm RSS tăng vượt MEMORY_JOB_THRESHOLD_MB.', ('flow',)))
+
+
+@contextmanager
+def stage_timer(flow, stage):
+    """Đo thời gian một bước xử lý (histogram + gauge đang chạy + bộ đếm lỗi)."""
+    STAGE_IN_FLIGHT.inc(flow=flow, stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(flow=flow, stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.observe(elapsed, flow=flow, stage=stage)
+        record_timing(f"{flow}.{stage}", elapsed)
+        end_stage_memory(flow, stage)
+        STAGE_IN_FLIGHT.dec(flow=flow, stage=stage)
+
+
+class StageTimer:
+    """
+    Đo liên tiếp các bước trong một hàm dài mà không phải lồng thêm khối with:
+    mỗi lần mark(stage) ghi lại thời gian kể từ lần mark trước.
+    """
+
+    def __init__(self, flow):
+        self.flow = flow
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        STAGE_DURATION.observe(now - self._last, flow=self.flow, stage=stage)
+        record_timing(f"{self.flow}.{stage}", now - self._last)
+        end_stage_memory(self.flow, stage)
+        self._last = now
+        return now
+
+
+def count_rows(flow, kind, amount):
+    if amount:
+        ROWS_PROCESSED.inc(amount, flow=flow, kind=kind)
+        record_rows(f"{flow}.{kind}", amount)
+
+
+def observe_job_memory(flow, report, over_threshold=False):
+    """Ghi số đo bộ nhớ của một job (báo cáo của memory_profiling.JobMemory) vào các histogram."""
+    mb = 1024 * 1024
+    if report.get('rss_growth_mb') is not None:
+        JOB_RSS_GROWTH.observe(report['rss_growth_mb'] * mb, flow=flow)
+    if report.get('rss_retained_mb') is not None:
+        JOB_RSS_RETAINED.observe(max(0, report['rss_retained_mb']) * mb, flow=flow)
+    if report.get('traced_peak_mb') is not None:
+        JOB_TRACED_PEAK.observe(report['traced_peak_mb'] * mb, flow=flow)
+    for name, values in report.get('stages_mb', {}).items():
+        stage_flow, _, stage = name.partition('.')
+        if values.get('peak_growth_mb') is not None:
+            STAGE_RSS_GROWTH.observe(values['peak_growth_mb'] * mb, flow=stage_flow, stage=stage)
+    if over_threshold:
+        JOB_MEMORY_OVER_THRESHOLD.inc(flow=flow)
+
+
+def observe_stage_timings(timings_ms):
+    """Ghi thời gian các bước đã đo ở tiến trình khác (tiến trình xử lý của job_pool), dạng {'flow.stage': ms}."""
+    for name, milliseconds in timings_ms.items():
+        flow, _, stage = name.partition('.')
+        STAGE_DURATION.observe(milliseconds / 1000, flow=flow, stage=stage)
@@ -1,8 +1,15 @@
 import io
+import logging
 import re
 from datetime import datetime
 import pandas as pd # Thêm import pandas để xử lý ngày tháng tốt hơn
 from openpyxl import load_workbook, Workbook
+from metrics import StageTimer, count_rows
+from structured_logging import bind_log_context
+from memory_profiling import memory_tracked
+from tracing import traced, current_span
+
+logger = logging.getLogger(__name__)
 
 # --- CÁC HÀM TIỆN ÍCH ---
 def _pos_to_float(value):
@@ -209,13 +216,14 @@ def _pos_add_summary_row(original_source_rows, product_name, details, product_ta
 # --- HÀM TẠO FILE UPPSSE ---
 def _pos_generate_upsse_rows(source_data_rows, static_data_pos, selected_chxd, is_new_price_period=False):
     """Tạo các dòng dữ liệu cho file UpSSE từ dữ liệu POS."""
+    timer = StageTimer('pos')
     chxd_details = static_data_pos["chxd_detail_map"].get(selected_chxd)
     if not chxd_details: raise ValueError(f"Không tìm thấy thông tin chi tiết cho CHXD: '{selected_chxd}'")
     details = {**static_data_pos, **chxd_details}
     
     petroleum_products = static_data_pos.get("petroleum_products", [])
     if not petroleum_products:
-        print("WARNING: Không tìm thấy mặt hàng nào được đánh dấu là 'Xăng dầu' trong file MaHH.xlsx.")
+        logger.warning("Không tìm thấy mặt hàng nào được đánh dấu là 'Xăng dầu' trong file MaHH.xlsx.")
 
     no_invoice_rows = {p: [] for p in petroleum_products}
 
@@ -270,12 +278,16 @@ def _pos_generate_upsse_rows(source_data_rows, static_data_pos, selected_chxd, i
                 all_tmt_rows.append(tmt_summary)
 
     final_rows.extend(all_tmt_rows)
+    timer.mark('row_generation')
+    count_rows('pos', 'input', len(source_data_rows))
+    count_rows('pos', 'output', len(final_rows))
     return final_rows
 
 # --- HÀM TẠO FILE EXCEL ---
 def _pos_create_excel_buffer(processed_rows):
     """Tạo một đối tượng BytesIO chứa file Excel từ các dòng dữ liệu đã xử lý."""
     if not processed_rows: return None
+    timer = StageTimer('pos')
     output_wb = Workbook()
     output_ws = output_wb.active
     headers = ["Mã khách", "Tên khách hàng", "Ngày", "Số hóa đơn", "Ký hiệu", "Diễn giải", "Mã hàng", "Tên mặt hàng", "Đvt", "Mã kho", "Mã vị trí", "Mã lô", "Số lượng", "Giá bán", "Tiền hàng", "Mã nt", "Tỷ giá", "Mã thuế", "Tk nợ", "Tk doanh thu", "Tk giá vốn", "Tk thuế có", "Cục thuế", "Vụ việc", "Bộ phận", "Lsx", "Sản phẩm", "Hợp đồng", "Phí", "Khế ước", "Nhân viên bán", "Tên KH(thuế)", "Địa chỉ (thuế)", "Mã số Thuế", "Nhóm Hàng", "Ghi chú", "Tiền thuế"]
@@ -294,20 +306,81 @@ def _pos_create_excel_buffer(processed_rows):
     output_buffer = io.BytesIO()
     output_wb.save(output_buffer)
     output_buffer.seek(0)
+    timer.mark('workbook_save')
     return output_buffer
 
+# --- ĐỌC HÓA ĐƠN TỪ BẢNG KÊ POS (ĐỐI SOÁT BA CHIỀU) ---
+@traced('reconcile.parse_pos')
+def _parse_pos_invoices(file_content_bytes, selected_chxd_symbol):
+    """
+    Đọc các dòng hóa đơn của bảng kê POS (từ dòng 5) cho đối soát ba chiều, trong một lượt đọc:
+    ký hiệu hóa đơn (cột B) được xác thực như khi tạo UpSSE, mỗi dòng trả về số hóa đơn, ngày, khách hàng,
+    mặt hàng, số lượng và thành tiền (tiền hàng + tiền thuế).
+    """
+    if selected_chxd_symbol is None:
+        raise ValueError("Ký hiệu hóa đơn của CHXD chưa được cung cấp để xác thực.")
+    if len(selected_chxd_symbol) < 6:
+        raise ValueError(f"Ký hiệu hóa đơn trong file cấu hình Data_HDDT.xlsx ('{selected_chxd_symbol}') quá ngắn để xác thực.")
+    expected_invoice_symbol_suffix = selected_chxd_symbol[-6:].upper()
+
+    try:
+        bkhd_wb = load_workbook(io.BytesIO(file_content_bytes), data_only=True, read_only=True, keep_vba=False, keep_links=False)
+    except Exception as e:
+        raise ValueError(f"Lỗi khi đọc file Bảng kê POS: {e}")
+    invoices = []
+    found_matching_symbol_in_pos_file = False
+    try:
+        for row_index, row in enumerate(bkhd_wb.active.iter_rows(min_row=5, max_col=16, values_only=True), start=5):
+            if not row or row[0] is None or len(row) < 15:
+                continue
+            invoice_symbol = _pos_clean_string(row[1])
+            if not found_matching_symbol_in_pos_file and len(invoice_symbol) >= 6 \
+                    and invoice_symbol[-6:].upper() == expected_invoice_symbol_suffix:
+                found_matching_symbol_in_pos_file = True
+            invoice_number = _pos_clean_string(row[2])
+            if not invoice_number:
+                continue
+            invoice_date = _pos_parse_date(row[3])
+            invoices.append({
+                'invoice_number': invoice_number,
+                'invoice_symbol': invoice_symbol,
+                'invoice_date': invoice_date.strftime('%d/%m/%Y') if invoice_date else 'N/A',
+                'customer_name': _pos_clean_string(row[5]),
+                'mst_khach_hang': _pos_clean_string(row[7]),
+                'item_name': _pos_clean_string(row[8]),
+                'quantity': _pos_to_float(row[10]),
+                'total_amount': _pos_to_float(row[13]) + _pos_to_float(row[14]),
+                'source_row': row_index,
+            })
+    except Exception as e:
+        raise ValueError(f"Lỗi khi đọc file Bảng kê POS: {e}")
+    finally:
+        bkhd_wb.close()
+
+    if not found_matching_symbol_in_pos_file:
+        raise ValueError("Bảng kê POS không phải của cửa hàng bạn chọn hoặc không tìm thấy ký hiệu hóa đơn hợp lệ.")
+    if not invoices:
+        raise ValueError("Không tìm thấy hóa đơn nào trong file Bảng kê POS.")
+    current_span().set_attribute('pos_invoices', len(invoices))
+    return invoices
+
 # --- HÀM ĐIỀU PHỐI CHÍNH ---
+@traced('pos.process_report')
+@memory_tracked('pos')
 def process_pos_report(file_content_bytes, selected_chxd, price_periods, new_price_invoice_number, static_data_pos, selected_chxd_symbol, **kwargs):
     """
     Xử lý bảng kê POS để tạo file UpSSE.
     Bao gồm xác thực CHXD dựa trên ký hiệu hóa đơn trong bảng kê POS và mã cửa hàng ở ô B5.
     """
+    bind_log_context(store=selected_chxd, report_type='POS')
     try:
         if static_data_pos is None:
             raise ValueError("Dữ liệu cấu hình tĩnh cho POS chưa được tải. Vui lòng kiểm tra cấu hình ứng dụng.")
 
+        timer = StageTimer('pos')
         bkhd_wb = load_workbook(io.BytesIO(file_content_bytes), data_only=True)
         bkhd_ws = bkhd_wb.active
+        timer.mark('workbook_load')
         
         if selected_chxd_symbol is None:
             raise ValueError("Ký hiệu hóa đơn của CHXD chưa được cung cấp để xác thực.")
@@ -338,8 +411,11 @@ def process_pos_report(file_content_bytes, selected_chxd, price_periods, new_pri
         
         if f5_norm and len(f5_norm) >= 6 and f5_norm[-6:] != b5_bkhd:
             raise ValueError(f"Lỗi dữ liệu: Mã cửa hàng không khớp.\n- Mã trong Bảng kê POS (ô B5): '{b5_bkhd}'\n- Mã trong file cấu hình (6 ký tự cuối cột K): '{f5_norm[-6:]}'")
+        timer.mark('validation')
         
         all_source_rows = list(bkhd_ws.iter_rows(min_row=5, values_only=True))
+        timer.mark('row_read')
+        current_span().set_attributes(store=selected_chxd, price_periods=price_periods, source_rows=len(all_source_rows))
         if price_periods == '1':
             processed_rows = _pos_generate_upsse_rows(all_source_rows, static_data_pos, selected_chxd, is_new_price_period=False)
             if not processed_rows: raise ValueError("Không có dữ liệu hợp lệ để xử lý trong file POS tải lên.")
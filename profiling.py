@@ -0,0 +1,147 @@
+import cProfile
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+DEFAULT_PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'upsse_profiles'))
+DEFAULT_MAX_PROFILES = int(os.environ.get('PROFILE_MAX_COUNT', 50))
+DEFAULT_MAX_AGE_SECONDS = int(os.environ.get('PROFILE_MAX_AGE_SECONDS', 7 * 24 * 3600))
+DEFAULT_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5)) / 1000.0
+
+_PROFILE_NAME_PATTERN = re.compile(r'^(\d{8}T\d{6})_([a-z0-9_]+)_([0-9a-f]{12})\.(pstats|folded)$')
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _StackSampler:
+    """
+    Lấy mẫu ngăn xếp của một luồng theo chu kỳ để tạo tệp collapsed-stack
+    (mỗi dòng 'hàm_gốc;...;hàm_lá số_mẫu', dùng trực tiếp cho flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, thread_id, interval, root_code=None):
+        self.thread_id = thread_id
+        # Chỉ giữ phần ngăn xếp từ hàm được đo trở xuống (bỏ các khung của WSGI/Flask phía trên)
+        self.root_code = root_code
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                if frame.f_code is self.root_code:
+                    break
+                frame = frame.f_back
+            else:
+                if self.root_code is not None:
+                    continue
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class RequestProfiler:
+    """
+    Chạy một hàm dưới cProfile (thống kê chính xác theo hàm, lưu .pstats) đồng thời lấy mẫu
+    ngăn xếp (lưu .folded cho flame graph). Mỗi lần chỉ một request được đo để không làm chậm
+    cả worker; tệp cũ bị xóa theo số lượng và tuổi tối đa.
+    """
+
+    def __init__(self, profile_dir=DEFAULT_PROFILE_DIR, max_profiles=DEFAULT_MAX_PROFILES,
+                 max_age_seconds=DEFAULT_MAX_AGE_SECONDS, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.max_age_seconds = max_age_seconds
+        self.sample_interval = sample_interval
+        self._active = threading.Lock()
+
+    def run(self, label, func, *args, **kwargs):
+        """
+        Gọi func(*args, **kwargs) có đo đạc.
+        Trả về (kết quả, mã profile); mã là None nếu đang có request khác được đo.
+        """
+        if not self._active.acquire(blocking=False):
+            return func(*args, **kwargs), None
+        try:
+            profiler = cProfile.Profile()
+            sampler = _StackSampler(threading.get_ident(), self.sample_interval, getattr(func, '__code__', None))
+            sampler.start()
+            try:
+                result = profiler.runcall(func, *args, **kwargs)
+            finally:
+                sampler.stop()
+            profile_id = self._save(label, profiler, sampler.samples)
+        finally:
+            self._active.release()
+        self.enforce_retention()
+        return result, profile_id
+
+    def _save(self, label, profiler, samples):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        safe_label = re.sub(r'[^a-z0-9_]+', '_', label.lower()).strip('_') or 'request'
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}_{safe_label}_{uuid.uuid4().hex[:12]}"
+        profiler.dump_stats(os.path.join(self.profile_dir, f"{profile_id}.pstats"))
+        with open(os.path.join(self.profile_dir, f"{profile_id}.folded"), 'w', encoding='utf-8') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return profile_id
+
+    def list_profiles(self):
+        """Danh sách profile đã lưu (mới nhất trước): mã, tên tệp và dung lượng."""
+        profiles = {}
+        try:
+            names = os.listdir(self.profile_dir)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            match = _PROFILE_NAME_PATTERN.match(name)
+            if not match:
+                continue
+            profile_id = name.rsplit('.', 1)[0]
+            entry = profiles.setdefault(profile_id, {'id': profile_id, 'label': match.group(2), 'files': {}})
+            try:
+                entry['files'][match.group(4)] = os.path.getsize(os.path.join(self.profile_dir, name))
+            except OSError:
+                continue
+        return sorted(profiles.values(), key=lambda p: p['id'], reverse=True)
+
+    def path_for(self, filename):
+        """Đường dẫn tệp profile theo tên, None nếu tên không hợp lệ hoặc tệp không tồn tại."""
+        if not _PROFILE_NAME_PATTERN.match(filename or ''):
+            return None
+        path = os.path.join(self.profile_dir, filename)
+        return path if os.path.isfile(path) else None
+
+    def enforce_retention(self):
+        """Xóa profile quá tuổi tối đa và giữ lại tối đa max_profiles profile mới nhất."""
+        cutoff = time.time() - self.max_age_seconds
+        for index, profile in enumerate(self.list_profiles()):
+            for ext in profile['files']:
+                path = os.path.join(self.profile_dir, f"{profile['id']}.{ext}")
+                try:
+                    if index >= self.max_profiles or os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,199 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+
+# --- GỢI Ý GHÉP CẶP CHO FKEY THIẾU/THỪA ---
+# Dòng Log Bơm không có hóa đơn (FKEY thiếu) và hóa đơn không có dòng Log Bơm (FKEY thừa) thường là cùng một giao dịch
+# bị gõ sai FKEY hoặc sai mặt hàng. Mỗi dòng chưa khớp được gợi ý các dòng phía bên kia gần nhất về số lượng,
+# thành tiền, mặt hàng và ngày. Để không phải so sánh mọi cặp, mỗi phía được chia ngăn theo mặt hàng và sắp xếp
+# theo số lượng; chỉ các dòng nằm trong khoảng dung sai số lượng (tìm bằng tìm kiếm nhị phân) mới được chấm điểm.
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# Dung sai số lượng (tương đối) để coi hai dòng là ứng viên của nhau
+DEFAULT_QUANTITY_TOLERANCE = float(os.environ.get('RECONCILE_CANDIDATE_QUANTITY_TOLERANCE', 0.02))
+# Dung sai thành tiền (tương đối): đủ rộng cho hóa đơn đã trừ chiết khấu theo lít
+DEFAULT_AMOUNT_TOLERANCE = float(os.environ.get('RECONCILE_CANDIDATE_AMOUNT_TOLERANCE', 0.05))
+# Hai dòng cách nhau quá số ngày này không được gợi ý
+DEFAULT_DAY_WINDOW = int(os.environ.get('RECONCILE_CANDIDATE_DAY_WINDOW', 1))
+# Số ứng viên tối đa gợi ý cho mỗi dòng
+DEFAULT_CANDIDATE_LIMIT = int(os.environ.get('RECONCILE_CANDIDATE_LIMIT', 3))
+# Số dòng tối đa được chấm điểm cho mỗi dòng Log Bơm (giới hạn khi rất nhiều dòng cùng số lượng)
+DEFAULT_SCAN_LIMIT = int(os.environ.get('RECONCILE_CANDIDATE_SCAN_LIMIT', 200))
+
+# Trọng số điểm gợi ý (tổng = 1)
+_WEIGHTS = {'quantity': 0.35, 'amount': 0.3, 'day': 0.15, 'item': 0.2}
+# Cộng thêm khi hai dòng cùng FKEY (chỉ khác mặt hàng)
+_SAME_FKEY_BONUS = 0.2
+
+
+def _day_ordinal(day_str, cache):
+    """Ngày dd/mm/yyyy thành số ngày (để tính khoảng cách); ngày không xác định trả về None."""
+    try:
+        return cache[day_str]
+    except KeyError:
+        pass
+    try:
+        ordinal = datetime.strptime(day_str, '%d/%m/%Y').toordinal()
+    except (TypeError, ValueError):
+        ordinal = None
+    cache[day_str] = ordinal
+    return ordinal
+
+
+class _UnmatchedSide:
+    """Các khóa (fkey, mặt hàng) chưa khớp của một phía: thông tin hiển thị và các cột số lượng/thành tiền/ngày."""
+
+    def __init__(self, aggregated_side, positions, days, day_cache):
+        self.aggregated_side = aggregated_side
+        self.positions = positions.tolist()
+        self.days = list(days)
+        self.fkeys = aggregated_side.fkeys_at(positions)
+        self.items = [aggregated_side.record(position)['item_name'] for position in self.positions]
+        self.quantity = aggregated_side.quantity[positions]
+        self.total_amount = aggregated_side.total_amount[positions]
+        self.day_ordinals = [_day_ordinal(day, day_cache) for day in self.days]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def describe(self, index):
+        record = self.aggregated_side.record(self.positions[index])
+        described = {
+            'fkey': self.fkeys[index],
+            'item_name': self.items[index],
+            'date': self.days[index],
+            'quantity': self.quantity[index].item(),
+            'amount': self.total_amount[index].item(),
+        }
+        if 'invoice_number' in record:
+            described['invoice_number'] = record.get('invoice_number', '')
+            described['customer_name'] = record.get('customer_name', '')
+        return described
+
+
+def _closeness(difference, scale):
+    """1 khi bằng nhau, giảm tuyến tính về 0 khi chênh lệch đạt ngưỡng scale."""
+    if scale <= 0:
+        return 1.0 if difference == 0 else 0.0
+    return max(0.0, 1.0 - abs(difference) / scale)
+
+
+class CandidateMatcher:
+    """Chấm điểm và chọn các cặp ứng viên giữa dòng Log Bơm chưa khớp và hóa đơn HĐĐT chưa khớp."""
+
+    def __init__(self, quantity_tolerance=DEFAULT_QUANTITY_TOLERANCE, amount_tolerance=DEFAULT_AMOUNT_TOLERANCE,
+                 day_window=DEFAULT_DAY_WINDOW, limit=DEFAULT_CANDIDATE_LIMIT, scan_limit=DEFAULT_SCAN_LIMIT):
+        self.quantity_tolerance = quantity_tolerance
+        self.amount_tolerance = amount_tolerance
+        self.day_window = day_window
+        self.limit = limit
+        self.scan_limit = scan_limit
+
+    def _score(self, log, log_index, hddt, hddt_index, same_item):
+        """Điểm 0..1 của một cặp, hoặc None nếu cặp vượt dung sai số lượng/thành tiền/ngày."""
+        log_quantity = log.quantity[log_index].item()
+        hddt_quantity = hddt.quantity[hddt_index].item()
+        log_amount = log.total_amount[log_index].item()
+        hddt_amount = hddt.total_amount[hddt_index].item()
+        quantity_scale = self.quantity_tolerance * max(abs(log_quantity), abs(hddt_quantity))
+        amount_scale = self.amount_tolerance * max(abs(log_amount), abs(hddt_amount))
+        if abs(log_quantity - hddt_quantity) > quantity_scale or abs(log_amount - hddt_amount) > amount_scale:
+            return None
+
+        log_day, hddt_day = log.day_ordinals[log_index], hddt.day_ordinals[hddt_index]
+        if log_day is not None and hddt_day is not None:
+            day_distance = abs(log_day - hddt_day)
+            if day_distance > self.day_window:
+                return None
+            day_score = _closeness(day_distance, self.day_window + 1)
+        else:
+            day_score = 0.0
+
+        score = (_WEIGHTS['quantity'] * _closeness(log_quantity - hddt_quantity, quantity_scale)
+                 + _WEIGHTS['amount'] * _closeness(log_amount - hddt_amount, amount_scale)
+                 + _WEIGHTS['day'] * day_score
+                 + (_WEIGHTS['item'] if same_item else 0.0))
+        if log.fkeys[log_index] == hddt.fkeys[hddt_index]:
+            score += _SAME_FKEY_BONUS
+        return round(min(score, 1.0), 4)
+
+    def _scored_pairs(self, log, hddt):
+        """
+        Điểm của mọi cặp trong dung sai, dạng {(chỉ số Log Bơm, chỉ số HĐĐT): điểm}. Cùng mặt hàng: tìm khoảng số lượng trong ngăn
+        mặt hàng đã sắp xếp; khác mặt hàng: chỉ xét các dòng cùng FKEY (sai mặt hàng trên hóa đơn).
+        """
+        pairs = {}
+        hddt_bins = defaultdict(list)
+        for index, item_name in enumerate(hddt.items):
+            hddt_bins[item_name].append(index)
+        log_bins = defaultdict(list)
+        for index, item_name in enumerate(log.items):
+            log_bins[item_name].append(index)
+
+        for item_name, log_indexes in log_bins.items():
+            hddt_indexes = hddt_bins.get(item_name)
+            if not hddt_indexes:
+                continue
+            hddt_indexes = np.asarray(hddt_indexes)
+            order = np.argsort(hddt.quantity[hddt_indexes], kind='stable')
+            sorted_indexes = hddt_indexes[order]
+            sorted_quantity = hddt.quantity[sorted_indexes]
+            log_indexes = np.asarray(log_indexes)
+            log_quantity = np.abs(log.quantity[log_indexes])
+            # Khoảng q ± t*q/(1-t) chứa mọi dòng có chênh lệch số lượng <= t * max(hai số lượng)
+            spread = self.quantity_tolerance * log_quantity / max(1.0 - self.quantity_tolerance, 1e-9)
+            lower = np.searchsorted(sorted_quantity, log.quantity[log_indexes] - spread, side='left')
+            upper = np.searchsorted(sorted_quantity, log.quantity[log_indexes] + spread, side='right')
+            for log_index, start, stop in zip(log_indexes.tolist(), lower.tolist(), upper.tolist()):
+                for hddt_index in sorted_indexes[start:min(stop, start + self.scan_limit)].tolist():
+                    score = self._score(log, log_index, hddt, hddt_index, same_item=True)
+                    if score is not None:
+                        pairs[(log_index, hddt_index)] = score
+
+        hddt_by_fkey = defaultdict(list)
+        for index, fkey in enumerate(hddt.fkeys):
+            hddt_by_fkey[fkey].append(index)
+        for log_index, fkey in enumerate(log.fkeys):
+            for hddt_index in hddt_by_fkey.get(fkey, ()):
+                if log.items[log_index] != hddt.items[hddt_index]:
+                    score = self._score(log, log_index, hddt, hddt_index, same_item=False)
+                    if score is not None:
+                        pairs[(log_index, hddt_index)] = score
+        return pairs
+
+    def _top(self, scored):
+        """Các ứng viên điểm cao nhất (hòa điểm: theo thứ tự khóa)."""
+        return sorted(scored, key=lambda pair: (-pair[0], pair[1]))[:self.limit]
+
+    def match(self, log, hddt):
+        pairs = self._scored_pairs(log, hddt) if len(log) and len(hddt) else {}
+        by_log = defaultdict(list)
+        by_hddt = defaultdict(list)
+        for (log_index, hddt_index), score in pairs.items():
+            by_log[log_index].append((score, hddt_index))
+            by_hddt[hddt_index].append((score, log_index))
+
+        def entries(side, other, grouped):
+            result = []
+            for index in range(len(side)):
+                entry = side.describe(index)
+                entry['candidates'] = [dict(other.describe(other_index), score=score)
+                                       for score, other_index in self._top(grouped.get(index, ()))]
+                result.append(entry)
+            return result
+
+        return {'missing': entries(log, hddt, by_log), 'extra': entries(hddt, log, by_hddt)}
+
+
+def suggest_candidates(join, log_days, hddt_days, matcher=None):
+    """
+    Gợi ý ghép cặp cho kết quả ghép join (reconcile_join.JoinResult).
+    log_days/hddt_days: ngày dd/mm/yyyy của từng khóa trong join.log_only/join.hddt_only (cùng thứ tự).
+    Trả về {'missing': [...], 'extra': [...]}: mỗi dòng chưa khớp kèm danh sách 'candidates' (điểm giảm dần).
+    """
+    day_cache = {}
+    log = _UnmatchedSide(join.log_side, join.log_only, log_days, day_cache)
+    hddt = _UnmatchedSide(join.hddt_side, join.hddt_only, hddt_days, day_cache)
+    return (matcher or CandidateMatcher()).match(log, hddt)
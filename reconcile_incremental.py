@@ -0,0 +1,266 @@
+import hashlib
+import time
+
+from reconcile_join import AMOUNT_TOLERANCE, QUANTITY_TOLERANCE
+from reconciliation_history import reconciliation_history
+
+# --- ĐỐI SOÁT TĂNG DẦN THEO CHXD/NGÀY ---
+# Cửa hàng đối soát cùng một ngày nhiều lần trong lúc hóa đơn vẫn đang được xuất. Trạng thái đã đối soát
+# của mỗi (CHXD, ngày) được giữ trong cơ sở dữ liệu lịch sử (reconciliation_history):
+#   reconcile_rows: mã băm nội dung của từng dòng Log Bơm/HĐĐT đã nhận (kèm số lần xuất hiện);
+#   reconcile_keys: tổng theo khóa (fkey, mặt hàng) của hai phía và trạng thái đối soát hiện tại.
+# Lần tải lên sau chỉ xử lý các dòng có mã băm mới hoặc đã biến mất (dòng bị sửa = xóa dòng cũ + thêm dòng mới),
+# cập nhật lại các khóa bị ảnh hưởng và báo cáo phần thay đổi.
+# Chênh lệch thành tiền bằng đúng chiết khấu theo lít của khách hàng (như 'discount_match' của đối soát đầy đủ)
+# có trạng thái riêng 'discount' và được coi là đã khớp.
+
+_KEY_SEPARATOR = '\x1f'
+# Các trường tạo nên nội dung một dòng (source_row/source_file không tính: dòng chỉ đổi vị trí vẫn là dòng cũ)
+_HASH_FIELDS = {
+    'pos': ('fkey', 'item_name', 'quantity', 'total_amount', 'transaction_date'),
+    'hddt': ('fkey', 'item_name', 'quantity', 'total_amount', 'invoice_number', 'invoice_date_raw', 'mst_khach_hang',
+             'customer_name', 'invoice_symbol_hddt'),
+}
+# Số FKEY mỗi câu truy vấn IN (giới hạn tham số của SQLite)
+_QUERY_CHUNK = 500
+# Trạng thái coi là đã khớp: khớp hoàn toàn, hoặc chỉ chênh lệch thành tiền đúng bằng chiết khấu
+_MATCHED_STATUSES = ('matched', 'discount')
+
+
+def row_hash(record, side):
+    """Mã băm nội dung một dòng dữ liệu đã phân tích."""
+    content = _KEY_SEPARATOR.join(str(record.get(field, '')) for field in _HASH_FIELDS[side])
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def expected_discount(key_row, discount_data):
+    """Tổng chiết khấu dự kiến của khóa: chiết khấu mỗi đơn vị theo (MST, mặt hàng) * số lượng trên HĐĐT."""
+    discount_amount_per_unit = discount_data.get(key_row['mst'] or '', {}).get(key_row['item_name'], 0.0)
+    return round(discount_amount_per_unit * key_row['hddt_quantity'])
+
+
+def key_status(key_row, discount_data=None):
+    """
+    Trạng thái của một khóa theo cùng quy tắc với đối soát đầy đủ (reconcile_join); chênh lệch chỉ ở thành tiền
+    và đúng bằng chiết khấu dự kiến (sai số < 1 VNĐ) là 'discount'.
+    """
+    if key_row['pos_rows'] and key_row['hddt_rows']:
+        if abs(key_row['pos_quantity'] - key_row['hddt_quantity']) > QUANTITY_TOLERANCE:
+            return 'mismatch'
+        actual_difference = key_row['pos_amount'] - key_row['hddt_amount']
+        if abs(actual_difference) > AMOUNT_TOLERANCE:
+            if discount_data and abs(round(actual_difference) - expected_discount(key_row, discount_data)) < 1:
+                return 'discount'
+            return 'mismatch'
+        return 'matched'
+    if key_row['pos_rows']:
+        return 'missing'
+    if key_row['hddt_rows']:
+        return 'extra'
+    return None
+
+
+def _group_rows(records, side):
+    """{mã băm: [số lần xuất hiện, dòng đầu tiên]} của một phía trong lần tải lên này."""
+    grouped = {}
+    for record in records:
+        digest = row_hash(record, side)
+        entry = grouped.get(digest)
+        if entry is None:
+            grouped[digest] = [1, record]
+        else:
+            entry[0] += 1
+    return grouped
+
+
+class IncrementalReconciler:
+    """Áp dụng một lần tải lên vào trạng thái đối soát đã lưu của (CHXD, ngày) và trả về phần thay đổi."""
+
+    def __init__(self, history=reconciliation_history):
+        self.history = history
+
+    def apply(self, store, day, log_records, hddt_records, discount_data=None):
+        """
+        store: tên CHXD; day: ngày YYYY-MM-DD; log_records/hddt_records: toàn bộ dòng Log Bơm và hóa đơn POS
+        của lần tải lên (file của ngày tại thời điểm tải); discount_data: chiết khấu theo {MST: {mặt hàng: số tiền}}.
+        Trả về thống kê dòng, các thay đổi trạng thái ('new_matches', 'resolved', 'broken', 'removed'),
+        tổng số khóa theo trạng thái và tổng theo mặt hàng.
+        """
+        with self.history.transaction() as connection:
+            stored = {'pos': {}, 'hddt': {}}
+            for row in connection.execute(
+                    'SELECT side, row_hash, row_count, fkey, item_name, quantity, total_amount FROM reconcile_rows '
+                    'WHERE store = ? AND day = ?', (store, day)):
+                stored[row['side']][row['row_hash']] = row
+            first_upload = not stored['pos'] and not stored['hddt']
+
+            # --- DÒNG MỚI / ĐÃ BIẾN MẤT ---
+            changes = {} # khóa -> {'pos': [số dòng, số lượng, thành tiền], 'hddt': [...], 'invoice': dòng HĐĐT mới}
+            row_upserts, row_deletes, row_stats = [], [], {}
+            for side, records in (('pos', log_records), ('hddt', hddt_records)):
+                previous = stored[side]
+                stats = {'total': len(records), 'new': 0, 'removed': 0, 'unchanged': 0}
+                for digest, (count, record) in _group_rows(records, side).items():
+                    old = previous.pop(digest, None)
+                    old_count = old['row_count'] if old is not None else 0
+                    stats['unchanged'] += min(count, old_count)
+                    if count == old_count:
+                        continue
+                    stats['new'] += max(count - old_count, 0)
+                    stats['removed'] += max(old_count - count, 0)
+                    self._add_change(changes, side, record['fkey'], record['item_name'], count - old_count,
+                                     record['quantity'], record['total_amount'], record if side == 'hddt' else None)
+                    row_upserts.append((store, day, side, digest, count, record['fkey'], record['item_name'],
+                                        record['quantity'], record['total_amount']))
+                for digest, old in previous.items():
+                    stats['removed'] += old['row_count']
+                    self._add_change(changes, side, old['fkey'], old['item_name'], -old['row_count'],
+                                     old['quantity'], old['total_amount'], None)
+                    row_deletes.append((store, day, side, digest))
+                row_stats['log_bom' if side == 'pos' else 'hddt'] = stats
+
+            # --- CẬP NHẬT CÁC KHÓA BỊ ẢNH HƯỞNG ---
+            current_keys = self._load_keys(connection, store, day, changes)
+            deltas = {'new_matches': [], 'resolved': [], 'broken': [], 'removed': []}
+            key_upserts, key_deletes = [], []
+            updated_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+            for (fkey, item_name), change in changes.items():
+                old_row = current_keys.get((fkey, item_name))
+                key_row = dict(old_row) if old_row is not None else {
+                    'fkey': fkey, 'item_name': item_name, 'status': None, 'pos_rows': 0, 'pos_quantity': 0.0,
+                    'pos_amount': 0.0, 'hddt_rows': 0, 'hddt_quantity': 0.0, 'hddt_amount': 0.0,
+                    'invoice_number': None, 'mst': None, 'customer_name': None}
+                for side in ('pos', 'hddt'):
+                    rows, quantity, amount = change[side]
+                    key_row[f'{side}_rows'] += rows
+                    # Làm tròn để cộng/trừ nhiều lần không tích lũy sai số dấu phẩy động
+                    key_row[f'{side}_quantity'] = round(key_row[f'{side}_quantity'] + quantity, 6)
+                    key_row[f'{side}_amount'] = round(key_row[f'{side}_amount'] + amount, 6)
+                invoice = change['invoice']
+                if invoice is not None:
+                    key_row.update(invoice_number=invoice.get('invoice_number'), mst=invoice.get('mst_khach_hang'),
+                                   customer_name=invoice.get('customer_name'))
+
+                previous_status = old_row['status'] if old_row is not None else None
+                status = key_status(key_row, discount_data)
+                key_row['status'] = status
+                if status is None:
+                    key_deletes.append((store, day, fkey, item_name))
+                else:
+                    key_upserts.append((store, day, fkey, item_name, status, key_row['pos_rows'], key_row['pos_quantity'],
+                                        key_row['pos_amount'], key_row['hddt_rows'], key_row['hddt_quantity'],
+                                        key_row['hddt_amount'], key_row['invoice_number'], key_row['mst'],
+                                        key_row['customer_name'], updated_at))
+                delta_kind = self._delta_kind(previous_status, status)
+                if delta_kind:
+                    deltas[delta_kind].append(self._delta_entry(key_row, previous_status, discount_data))
+
+            connection.executemany('DELETE FROM reconcile_rows WHERE store = ? AND day = ? AND side = ? AND row_hash = ?',
+                                   row_deletes)
+            connection.executemany('INSERT OR REPLACE INTO reconcile_rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row_upserts)
+            connection.executemany('DELETE FROM reconcile_keys WHERE store = ? AND day = ? AND fkey = ? AND item_name = ?',
+                                   key_deletes)
+            connection.executemany('INSERT OR REPLACE INTO reconcile_keys VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   key_upserts)
+            totals = self._totals(connection, store, day)
+
+        for entries in deltas.values():
+            entries.sort(key=lambda entry: (entry['fkey'], entry['item_name']))
+        return {'first_upload': first_upload, 'rows': row_stats, 'deltas': deltas, **totals}
+
+    @staticmethod
+    def _add_change(changes, side, fkey, item_name, rows, quantity, amount, invoice):
+        change = changes.get((fkey, item_name))
+        if change is None:
+            change = changes[(fkey, item_name)] = {'pos': [0, 0.0, 0.0], 'hddt': [0, 0.0, 0.0], 'invoice': None}
+        change[side][0] += rows
+        change[side][1] += rows * quantity
+        change[side][2] += rows * amount
+        if invoice is not None and rows > 0:
+            change['invoice'] = invoice
+
+    @staticmethod
+    def _load_keys(connection, store, day, changes):
+        """Trạng thái đã lưu của các khóa bị ảnh hưởng (truy vấn theo lô FKEY trên khóa chính)."""
+        fkeys = sorted({fkey for fkey, _ in changes})
+        keys = {}
+        for start in range(0, len(fkeys), _QUERY_CHUNK):
+            chunk = fkeys[start:start + _QUERY_CHUNK]
+            rows = connection.execute(
+                f"SELECT * FROM reconcile_keys WHERE store = ? AND day = ? AND fkey IN ({', '.join('?' * len(chunk))})",
+                (store, day, *chunk))
+            for row in rows:
+                if (row['fkey'], row['item_name']) in changes:
+                    keys[(row['fkey'], row['item_name'])] = row
+        return keys
+
+    @staticmethod
+    def _delta_kind(previous_status, status):
+        """
+        new_matches: khóa mới và khớp ngay; resolved: khóa có vấn đề nay đã khớp;
+        broken: khóa mới có vấn đề, khóa đang khớp nay có vấn đề, hoặc đổi sang vấn đề khác;
+        removed: khóa không còn dòng nào ở cả hai phía. Đổi giữa 'matched' và 'discount' không phải thay đổi.
+        """
+        if previous_status == status:
+            return None
+        if status is None:
+            return 'removed'
+        if status in _MATCHED_STATUSES:
+            if previous_status in _MATCHED_STATUSES:
+                return None
+            return 'new_matches' if previous_status is None else 'resolved'
+        return 'broken'
+
+    @staticmethod
+    def _delta_entry(key_row, previous_status, discount_data):
+        entry = {
+            'fkey': key_row['fkey'],
+            'item_name': key_row['item_name'],
+            'status': key_row['status'],
+            'previous_status': previous_status,
+            'invoice_number': key_row['invoice_number'] or '',
+            'mst_khach_hang': key_row['mst'] or '',
+            'customer_name': key_row['customer_name'] or '',
+            'pos_quantity': key_row['pos_quantity'],
+            'hddt_quantity': key_row['hddt_quantity'],
+            'pos_amount': key_row['pos_amount'],
+            'hddt_amount': key_row['hddt_amount'],
+        }
+        if key_row['pos_rows'] and key_row['hddt_rows'] \
+                and abs(key_row['pos_amount'] - key_row['hddt_amount']) > AMOUNT_TOLERANCE:
+            entry['actual_difference_amount_raw'] = key_row['pos_amount'] - key_row['hddt_amount']
+            entry['expected_discount_amount'] = expected_discount(key_row, discount_data or {})
+            entry['discount_match'] = key_row['status'] == 'discount'
+        return entry
+
+    @staticmethod
+    def _totals(connection, store, day):
+        """Tổng sau cập nhật: số dòng, số khóa theo trạng thái và tổng theo mặt hàng (dạng item_summary)."""
+        status_counts = {'matched': 0, 'discount': 0, 'mismatch': 0, 'missing': 0, 'extra': 0}
+        items = {}
+        pos_count = hddt_count = 0
+        for row in connection.execute(
+                'SELECT status, item_name, COUNT(*) AS keys, SUM(pos_rows) AS pos_rows, SUM(hddt_rows) AS hddt_rows, '
+                'SUM(pos_quantity) AS pos_quantity, SUM(hddt_quantity) AS hddt_quantity, SUM(pos_amount) AS pos_amount, '
+                'SUM(hddt_amount) AS hddt_amount FROM reconcile_keys WHERE store = ? AND day = ? '
+                'GROUP BY status, item_name', (store, day)):
+            status_counts[row['status']] += row['keys']
+            pos_count += row['pos_rows']
+            hddt_count += row['hddt_rows']
+            item = items.setdefault(row['item_name'], {'quantity': {'pos': 0.0, 'hddt': 0.0},
+                                                       'amount': {'pos': 0.0, 'hddt': 0.0}})
+            item['quantity']['pos'] += row['pos_quantity']
+            item['quantity']['hddt'] += row['hddt_quantity']
+            item['amount']['pos'] += row['pos_amount']
+            item['amount']['hddt'] += row['hddt_amount']
+        return {'pos_count': pos_count, 'hddt_count': hddt_count, 'status_counts': status_counts, 'items': items}
+
+    def reset(self, store, day):
+        """Xóa trạng thái đã lưu của (CHXD, ngày): lần tải lên sau được đối soát lại từ đầu."""
+        with self.history.transaction() as connection:
+            removed = connection.execute('DELETE FROM reconcile_keys WHERE store = ? AND day = ?', (store, day)).rowcount
+            connection.execute('DELETE FROM reconcile_rows WHERE store = ? AND day = ?', (store, day))
+        return removed
+
+
+incremental_reconciler = IncrementalReconciler()
@@ -0,0 +1,111 @@
+from operator import itemgetter
+
+import numpy as np
+
+# --- GHÉP NỐI DỮ LIỆU ĐỐI SOÁT THEO KHÓA (FKEY, MẶT HÀNG) ---
+# Một FKEY có thể xuất hiện nhiều lần: hóa đơn nhiều dòng hàng, hoặc nhiều lần bơm cùng ghi một mã H.Đơn.
+# Các dòng trùng khóa được cộng dồn số lượng/thành tiền; mỗi phía được lưu dạng cột (numpy) đã sắp xếp theo khóa,
+# hai phía được ghép bằng tìm kiếm nhị phân trên mảng đã sắp xếp (sort-merge) thay cho dict Python.
+
+# Ký tự phân tách FKEY và tên mặt hàng trong khóa ghép (nhỏ hơn mọi ký tự in được: thứ tự khóa ghép
+# trùng với thứ tự (fkey, mặt hàng))
+_KEY_SEPARATOR = '\x1f'
+
+# Ngưỡng coi là chênh lệch: số lượng > 0.001, thành tiền > 1 VNĐ
+QUANTITY_TOLERANCE = 0.001
+AMOUNT_TOLERANCE = 1
+
+
+class AggregatedSide:
+    """
+    Dữ liệu một phía đối soát (Log Bơm hoặc HĐĐT) gộp theo khóa (fkey, mặt hàng).
+    keys: mảng khóa ghép đã sắp xếp, không trùng; quantity/total_amount: tổng theo khóa;
+    line_count: số dòng gốc của khóa; first_index: vị trí dòng gốc đầu tiên (lấy thông tin hiển thị).
+    """
+
+    def __init__(self, records):
+        self.records = records
+        size = len(records)
+        # Trích từng cột bằng itemgetter (nhanh hơn duyệt dict trong vòng lặp Python)
+        composite_keys = np.array(list(map(_KEY_SEPARATOR.join, zip(map(itemgetter('fkey'), records),
+                                                                    map(itemgetter('item_name'), records)))), dtype=str)
+        # np.unique sắp xếp ổn định khi cần return_index: first_index là dòng xuất hiện đầu tiên của mỗi khóa
+        self.keys, self.first_index, inverse, self.line_count = np.unique(
+            composite_keys, return_index=True, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        self.quantity = np.bincount(inverse, weights=np.fromiter(
+            map(itemgetter('quantity'), records), dtype=float, count=size), minlength=len(self.keys))
+        self.total_amount = np.bincount(inverse, weights=np.fromiter(
+            map(itemgetter('total_amount'), records), dtype=float, count=size), minlength=len(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def record(self, position):
+        """Dòng gốc đầu tiên của khóa tại vị trí position."""
+        return self.records[self.first_index[position]]
+
+    def fkeys_at(self, positions):
+        """FKEY của từng vị trí cho trước (có thể trùng nếu một FKEY có nhiều mặt hàng)."""
+        return [str(key).split(_KEY_SEPARATOR, 1)[0] for key in self.keys[positions]]
+
+    def fkeys(self, positions):
+        """Danh sách FKEY (không trùng, theo thứ tự khóa) của các vị trí cho trước."""
+        return list(dict.fromkeys(self.fkeys_at(positions)))
+
+
+class JoinResult:
+    """
+    Kết quả ghép hai phía. common_log/common_hddt: vị trí các khóa có ở cả hai phía (theo thứ tự khóa);
+    log_only/hddt_only: vị trí khóa chỉ có ở một phía; quantity_diff/amount_diff: chênh lệch Log Bơm - HĐĐT
+    của các khóa chung; quantity_mismatch/amount_mismatch: mặt nạ chênh lệch vượt ngưỡng.
+    """
+
+    def __init__(self, log_side, hddt_side, common_log, common_hddt, log_only, hddt_only):
+        self.log_side = log_side
+        self.hddt_side = hddt_side
+        self.common_log = common_log
+        self.common_hddt = common_hddt
+        self.log_only = log_only
+        self.hddt_only = hddt_only
+        self.quantity_diff = log_side.quantity[common_log] - hddt_side.quantity[common_hddt]
+        self.amount_diff = log_side.total_amount[common_log] - hddt_side.total_amount[common_hddt]
+        self.quantity_mismatch = np.abs(self.quantity_diff) > QUANTITY_TOLERANCE
+        self.amount_mismatch = np.abs(self.amount_diff) > AMOUNT_TOLERANCE
+
+    def missing_fkeys(self):
+        """FKEY có dòng trong Log Bơm nhưng không có dòng tương ứng (cùng mặt hàng) trong HĐĐT."""
+        return self.log_side.fkeys(self.log_only)
+
+    def extra_fkeys(self):
+        """FKEY có dòng trong HĐĐT nhưng không có dòng tương ứng (cùng mặt hàng) trong Log Bơm."""
+        return self.hddt_side.fkeys(self.hddt_only)
+
+    def mismatches(self):
+        """
+        Các khóa chung có chênh lệch số lượng hoặc thành tiền, theo thứ tự khóa:
+        (vị trí Log Bơm, vị trí HĐĐT, chênh lệch thành tiền, lệch số lượng?, lệch thành tiền?).
+        """
+        flagged = np.flatnonzero(self.quantity_mismatch | self.amount_mismatch)
+        return zip(self.common_log[flagged].tolist(), self.common_hddt[flagged].tolist(),
+                   self.amount_diff[flagged].tolist(), self.quantity_mismatch[flagged].tolist(),
+                   self.amount_mismatch[flagged].tolist())
+
+
+def sort_merge_join(log_records, hddt_records):
+    """Gộp từng phía theo (fkey, mặt hàng) rồi ghép hai mảng khóa đã sắp xếp."""
+    log_side = AggregatedSide(log_records)
+    hddt_side = AggregatedSide(hddt_records)
+
+    # Vị trí chèn của từng khóa Log Bơm trong mảng khóa HĐĐT; khớp nếu khóa tại vị trí đó bằng nhau
+    positions = np.searchsorted(hddt_side.keys, log_side.keys)
+    clipped = np.minimum(positions, max(len(hddt_side) - 1, 0))
+    found = (positions < len(hddt_side)) & (hddt_side.keys[clipped] == log_side.keys) if len(hddt_side) \
+        else np.zeros(len(log_side), dtype=bool)
+
+    common_log = np.flatnonzero(found)
+    common_hddt = positions[found]
+    hddt_matched = np.zeros(len(hddt_side), dtype=bool)
+    hddt_matched[common_hddt] = True
+    return JoinResult(log_side, hddt_side, common_log, common_hddt,
+                      log_only=np.flatnonzero(~found), hddt_only=np.flatnonzero(~hddt_matched))
@@ -0,0 +1,137 @@
+from reconcile_join import AMOUNT_TOLERANCE, QUANTITY_TOLERANCE
+
+# --- ĐỐI SOÁT BA CHIỀU: LOG BƠM - BẢNG KÊ POS - HĐĐT ---
+# Log Bơm và HĐĐT nối với nhau qua FKEY; bảng kê POS (nguồn tạo file UpSSE) không có FKEY nên nối với HĐĐT
+# qua (6 ký tự cuối ký hiệu, số hóa đơn). HĐĐT là cầu nối: mỗi hóa đơn HĐĐT (gộp mọi dòng, kể cả khi các dòng
+# mang nhiều FKEY) kéo theo các dòng Log Bơm của các FKEY đó và dòng POS cùng số hóa đơn. Tên mặt hàng khác nhau giữa các nguồn (POS dùng tên hàng của UpSSE), nên số lượng và
+# thành tiền được so sánh theo tổng của cả giao dịch/hóa đơn, không theo từng mặt hàng.
+
+SOURCES = ('log', 'pos', 'hddt')
+# Các cặp nguồn được so sánh, theo thứ tự hiển thị trong ma trận
+PAIRS = (('log', 'hddt'), ('pos', 'hddt'), ('log', 'pos'))
+
+
+def invoice_key(invoice_symbol, invoice_number):
+    """Khóa hóa đơn dùng chung cho POS và HĐĐT: 6 ký tự cuối ký hiệu + số hóa đơn bỏ số 0 đứng đầu."""
+    number = str(invoice_number or '').strip().lstrip('0') or '0'
+    return (str(invoice_symbol or '').strip()[-6:].upper(), number)
+
+
+def _aggregate(records, key_of):
+    """Gộp các dòng cùng khóa: {khóa: [số lượng, thành tiền, số dòng, dòng đầu tiên]} (giữ thứ tự xuất hiện)."""
+    groups = {}
+    for record in records:
+        key = key_of(record)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [record['quantity'], record['total_amount'], 1, record]
+        else:
+            group[0] += record['quantity']
+            group[1] += record['total_amount']
+            group[2] += 1
+    return groups
+
+
+def _combine(groups):
+    """Gộp nhiều nhóm của _aggregate thành một (None nếu không có nhóm nào)."""
+    if not groups:
+        return None
+    return [sum(group[0] for group in groups), sum(group[1] for group in groups), sum(group[2] for group in groups),
+            groups[0][3]]
+
+
+def _new_pair_counts(left, right):
+    return {'ok': 0, 'quantity_mismatch': 0, 'amount_mismatch': 0, f'only_{left}': 0, f'only_{right}': 0}
+
+
+def _compare(row, left, right):
+    """Vấn đề của một cặp nguồn trên một dòng: [] nếu khớp, None nếu cả hai nguồn đều không có dòng."""
+    left_quantity, right_quantity = row[f'{left}_quantity'], row[f'{right}_quantity']
+    if left_quantity is None and right_quantity is None:
+        return None
+    if right_quantity is None:
+        return [f'only_{left}']
+    if left_quantity is None:
+        return [f'only_{right}']
+    issues = []
+    if abs(left_quantity - right_quantity) > QUANTITY_TOLERANCE:
+        issues.append('quantity_mismatch')
+    if abs(row[f'{left}_amount'] - row[f'{right}_amount']) > AMOUNT_TOLERANCE:
+        issues.append('amount_mismatch')
+    return issues
+
+
+def three_way_join(log_records, pos_records, hddt_records):
+    """
+    Ghép ba nguồn trong một lượt qua dữ liệu đã phân tích. Trả về:
+    rows: mỗi hóa đơn/giao dịch một dòng với số lượng/thành tiền của từng nguồn (None nếu nguồn không có), 'fkeys'
+    (các FKEY của hóa đơn) và 'issues';
+    matrix: số dòng theo từng cặp nguồn và loại vấn đề; presence: số dòng theo tổ hợp nguồn có mặt.
+    """
+    log_groups = _aggregate(log_records, lambda record: record['fkey'])
+    pos_groups = _aggregate(pos_records, lambda record: invoice_key(record['invoice_symbol'], record['invoice_number']))
+    hddt_groups = _aggregate(hddt_records, lambda record: invoice_key(record['invoice_symbol_hddt'], record['invoice_number']))
+    # Các FKEY trên từng hóa đơn HĐĐT (theo thứ tự xuất hiện)
+    invoice_fkeys = {}
+    for record in hddt_records:
+        fkeys = invoice_fkeys.setdefault(invoice_key(record['invoice_symbol_hddt'], record['invoice_number']), [])
+        if record['fkey'] not in fkeys:
+            fkeys.append(record['fkey'])
+
+    rows = []
+
+    def add_row(fkeys, log_group, pos_group, hddt_group):
+        # Thông tin hiển thị ưu tiên HĐĐT (có đủ số hóa đơn, khách hàng), rồi POS, rồi Log Bơm
+        hddt = hddt_group[3] if hddt_group else None
+        pos = pos_group[3] if pos_group else None
+        log = log_group[3] if log_group else None
+        row = {
+            'fkey': ', '.join(fkeys),
+            'fkeys': fkeys,
+            'invoice_number': (hddt or pos or {}).get('invoice_number', ''),
+            'invoice_symbol': hddt['invoice_symbol_hddt'] if hddt else (pos or {}).get('invoice_symbol', ''),
+            'date': log['transaction_date'] if log else (pos or {}).get('invoice_date', 'N/A'),
+            'customer_name': (hddt or pos or {}).get('customer_name', ''),
+            'mst_khach_hang': (hddt or pos or {}).get('mst_khach_hang', ''),
+            'item_name': (hddt or log or pos)['item_name'],
+        }
+        for source, group in (('log', log_group), ('pos', pos_group), ('hddt', hddt_group)):
+            row[f'{source}_quantity'] = group[0] if group else None
+            row[f'{source}_amount'] = group[1] if group else None
+            row[f'{source}_lines'] = group[2] if group else 0
+        rows.append(row)
+
+    # Một lượt qua HĐĐT: mỗi hóa đơn kéo theo Log Bơm (tổng các FKEY của hóa đơn) và POS (cùng số hóa đơn);
+    # FKEY đã gắn với một hóa đơn không được tính lại cho hóa đơn khác
+    used_fkeys = set()
+    for key, hddt_group in hddt_groups.items():
+        fkeys = invoice_fkeys[key]
+        log_group = _combine([log_groups[fkey] for fkey in fkeys if fkey in log_groups and fkey not in used_fkeys])
+        used_fkeys.update(fkeys)
+        add_row(fkeys, log_group, pos_groups.get(key), hddt_group)
+    # Phần còn lại chỉ có ở Log Bơm (chưa xuất hóa đơn) hoặc chỉ có ở POS (không có trên HĐĐT)
+    for fkey, log_group in log_groups.items():
+        if fkey not in used_fkeys:
+            add_row([fkey], log_group, None, None)
+    for key, pos_group in pos_groups.items():
+        if key not in hddt_groups:
+            add_row([], None, pos_group, None)
+
+    matrix = {f'{left}_vs_{right}': _new_pair_counts(left, right) for left, right in PAIRS}
+    presence = {}
+    for row in rows:
+        issues = []
+        for left, right in PAIRS:
+            pair_issues = _compare(row, left, right)
+            if pair_issues is None:
+                continue
+            counts = matrix[f'{left}_vs_{right}']
+            if not pair_issues:
+                counts['ok'] += 1
+            for issue in pair_issues:
+                counts[issue] += 1
+                issues.append(f'{left}_vs_{right}:{issue}')
+        row['issues'] = issues
+        present = '+'.join(source for source in SOURCES if row[f'{source}_quantity'] is not None)
+        presence[present] = presence.get(present, 0) + 1
+    return rows, matrix, presence
@@ -0,0 +1,361 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+# Cơ sở dữ liệu SQLite lưu lịch sử đối soát (dùng chung giữa các worker gunicorn); để trống = tắt lưu lịch sử.
+# Mặc định nằm trong thư mục tạm: trên Cloud Run đó là tmpfs trong RAM, mất khi instance khởi động lại.
+# Khi triển khai phải trỏ tới ổ đĩa bền vững (persistent disk trên Render, volume gắn vào container...).
+_TEMP_HISTORY_DB = os.path.join(tempfile.gettempdir(), 'upsse_reconciliation_history.sqlite3')
+DEFAULT_HISTORY_DB = os.environ.get('RECONCILIATION_HISTORY_DB', _TEMP_HISTORY_DB)
+# Số dòng tối đa trả về cho một truy vấn
+DEFAULT_QUERY_LIMIT = int(os.environ.get('RECONCILIATION_HISTORY_QUERY_LIMIT', 1000))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    store TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    date_from TEXT,
+    date_to TEXT,
+    pos_count INTEGER,
+    hddt_count INTEGER,
+    is_match INTEGER,
+    missing_count INTEGER,
+    extra_count INTEGER,
+    quantity_mismatch_count INTEGER,
+    amount_mismatch_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    run_id TEXT NOT NULL,
+    store TEXT NOT NULL,
+    invoice_date TEXT,
+    fkey TEXT NOT NULL,
+    item_name TEXT,
+    invoice_number TEXT,
+    mst TEXT,
+    customer_name TEXT,
+    status TEXT NOT NULL,
+    pos_quantity REAL,
+    hddt_quantity REAL,
+    pos_amount REAL,
+    hddt_amount REAL
+);
+CREATE TABLE IF NOT EXISTS mismatches (
+    run_id TEXT NOT NULL,
+    store TEXT NOT NULL,
+    invoice_date TEXT,
+    fkey TEXT NOT NULL,
+    item_name TEXT,
+    invoice_number TEXT,
+    mst TEXT,
+    customer_name TEXT,
+    kind TEXT NOT NULL,
+    quantity REAL,
+    pos_amount REAL,
+    hddt_amount REAL,
+    difference REAL,
+    expected_discount REAL,
+    discount_match INTEGER
+);
+CREATE TABLE IF NOT EXISTS item_summaries (
+    run_id TEXT NOT NULL,
+    store TEXT NOT NULL,
+    summary_date TEXT,
+    item_name TEXT NOT NULL,
+    pos_quantity REAL,
+    hddt_quantity REAL,
+    pos_amount REAL,
+    hddt_amount REAL
+);
+CREATE TABLE IF NOT EXISTS reconcile_rows (
+    store TEXT NOT NULL,
+    day TEXT NOT NULL,
+    side TEXT NOT NULL,
+    row_hash TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    fkey TEXT NOT NULL,
+    item_name TEXT,
+    quantity REAL,
+    total_amount REAL,
+    PRIMARY KEY (store, day, side, row_hash)
+);
+CREATE TABLE IF NOT EXISTS reconcile_keys (
+    store TEXT NOT NULL,
+    day TEXT NOT NULL,
+    fkey TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    pos_rows INTEGER NOT NULL,
+    pos_quantity REAL,
+    pos_amount REAL,
+    hddt_rows INTEGER NOT NULL,
+    hddt_quantity REAL,
+    hddt_amount REAL,
+    invoice_number TEXT,
+    mst TEXT,
+    customer_name TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (store, day, fkey, item_name)
+);
+CREATE INDEX IF NOT EXISTS idx_runs_store_date ON runs (store, date_from);
+CREATE INDEX IF NOT EXISTS idx_invoices_store_date ON invoices (store, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_fkey ON invoices (fkey, status);
+CREATE INDEX IF NOT EXISTS idx_invoices_mst_date ON invoices (mst, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices (invoice_number);
+CREATE INDEX IF NOT EXISTS idx_invoices_run ON invoices (run_id);
+CREATE INDEX IF NOT EXISTS idx_mismatches_mst_date ON mismatches (mst, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_mismatches_store_date ON mismatches (store, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_mismatches_fkey ON mismatches (fkey);
+CREATE INDEX IF NOT EXISTS idx_mismatches_number ON mismatches (invoice_number);
+CREATE INDEX IF NOT EXISTS idx_mismatches_run ON mismatches (run_id);
+CREATE INDEX IF NOT EXISTS idx_item_summaries_store_date ON item_summaries (store, summary_date, item_name);
+CREATE INDEX IF NOT EXISTS idx_item_summaries_run ON item_summaries (run_id);
+"""
+
+# Bộ lọc truy vấn: tên tham số -> (cột, toán tử). Ngày dạng YYYY-MM-DD.
+_INVOICE_FILTERS = {
+    'store': ('store', '='), 'fkey': ('fkey', '='), 'mst': ('mst', '='), 'invoice_number': ('invoice_number', '='),
+    'status': ('status', '='), 'item_name': ('item_name', '='), 'run_id': ('run_id', '='),
+    'date_from': ('invoice_date', '>='), 'date_to': ('invoice_date', '<='),
+}
+_MISMATCH_FILTERS = {
+    'store': ('store', '='), 'fkey': ('fkey', '='), 'mst': ('mst', '='), 'invoice_number': ('invoice_number', '='),
+    'kind': ('kind', '='), 'discount_match': ('discount_match', '='), 'item_name': ('item_name', '='),
+    'run_id': ('run_id', '='), 'date_from': ('invoice_date', '>='), 'date_to': ('invoice_date', '<='),
+}
+_RUN_FILTERS = {
+    'store': ('store', '='), 'date_from': ('date_to', '>='), 'date_to': ('date_from', '<='),
+}
+
+
+def _iso_date(day_str):
+    """dd/mm/yyyy -> YYYY-MM-DD (None nếu không xác định được ngày)."""
+    try:
+        return datetime.strptime(day_str, '%d/%m/%Y').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def quarter_range(quarter):
+    """'2025-Q3' -> ('2025-07-01', '2025-09-30')."""
+    try:
+        year, number = str(quarter).upper().split('-Q')
+        year, number = int(year), int(number)
+        if not 1 <= number <= 4:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"Quý '{quarter}' không hợp lệ, cần dạng YYYY-Qn (ví dụ 2025-Q3).")
+    last_day = {1: '03-31', 2: '06-30', 3: '09-30', 4: '12-31'}[number]
+    return f"{year}-{(number - 1) * 3 + 1:02d}-01", f"{year}-{last_day}"
+
+
+class ReconciliationHistory:
+    """
+    Lịch sử đối soát trong SQLite: mỗi lần đối soát (run) lưu trạng thái từng hóa đơn, các chênh lệch
+    và bảng tổng hợp mặt hàng, đánh chỉ mục theo CHXD, ngày, FKEY, MST và số hóa đơn để truy vấn lại
+    mà không phải tải lên/đọc lại các file gốc.
+    """
+
+    def __init__(self, db_path=DEFAULT_HISTORY_DB, query_limit=DEFAULT_QUERY_LIMIT):
+        self.db_path = db_path
+        self.query_limit = query_limit
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.db_path)
+
+    @property
+    def ephemeral(self):
+        """Cơ sở dữ liệu nằm trong thư mục tạm (không bền vững qua các lần khởi động lại)."""
+        if not self.enabled:
+            return False
+        temp_dir = os.path.realpath(tempfile.gettempdir())
+        return os.path.commonpath([os.path.realpath(self.db_path), temp_dir]) == temp_dir
+
+    def warn_if_ephemeral(self):
+        """Cảnh báo khi khởi động nếu lịch sử đối soát đang lưu trong thư mục tạm."""
+        if self.ephemeral:
+            logger.warning("Lịch sử đối soát đang lưu tại %s (thư mục tạm, trên Cloud Run là RAM): dữ liệu mất khi "
+                           "khởi động lại. Đặt RECONCILIATION_HISTORY_DB trỏ tới ổ đĩa bền vững, hoặc để trống để tắt.",
+                           self.db_path)
+
+    def _connection(self):
+        # Mỗi luồng một kết nối; kết nối không dùng lại sau khi fork (gunicorn preload)
+        if not self.enabled:
+            raise ValueError("Lịch sử đối soát đang tắt (RECONCILIATION_HISTORY_DB để trống).")
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        # WAL: các worker đọc song song trong khi một worker đang ghi
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with self._schema_lock:
+            if self._schema_pid != os.getpid():
+                connection.executescript(_SCHEMA)
+                self._schema_pid = os.getpid()
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    # --- GHI ---
+    def record(self, run_id, store, reconciliation_data, invoice_rows=()):
+        """
+        Lưu một lần đối soát. invoice_rows: trạng thái từng hóa đơn (history_sink của perform_reconciliation).
+        Lỗi ghi lịch sử chỉ được ghi log, không làm hỏng kết quả đối soát trả về cho người dùng.
+        """
+        if not self.enabled:
+            return False
+        started = time.perf_counter()
+        try:
+            self._record(run_id, store, reconciliation_data, invoice_rows)
+        except Exception as e:
+            logger.warning("Không lưu được lịch sử đối soát: %s", e)
+            return False
+        logger.debug("Đã lưu lịch sử đối soát.", extra={'run_id': run_id, 'invoices': len(invoice_rows),
+                                                        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)})
+        return True
+
+    def _record(self, run_id, store, reconciliation_data, invoice_rows):
+        summary = reconciliation_data.get('summary', {})
+        mismatches = reconciliation_data.get('detailed_mismatches', {})
+        invoices = [(run_id, store, _iso_date(row['invoice_date']), row['fkey'], row['item_name'], row['invoice_number'],
+                     row['mst_khach_hang'], row['customer_name'], row['status'], row['pos_quantity'],
+                     row['hddt_quantity'], row['pos_amount'], row['hddt_amount']) for row in invoice_rows]
+        mismatch_rows = []
+        for kind, key in (('quantity', 'quantities'), ('amount', 'amounts')):
+            for mismatch in mismatches.get(key, []):
+                discount_match = mismatch.get('discount_match')
+                mismatch_rows.append((
+                    run_id, store, _iso_date(mismatch.get('invoice_date')), mismatch['fkey'], mismatch.get('item_name'),
+                    mismatch.get('invoice_number'), mismatch.get('mst_khach_hang'), mismatch.get('customer_name'), kind,
+                    mismatch.get('quantity'), mismatch.get('pos_amount'), mismatch.get('hddt_amount'),
+                    mismatch.get('actual_difference_amount_raw'), mismatch.get('expected_discount_amount'),
+                    None if discount_match is None else int(bool(discount_match))))
+        # Bảng tổng hợp mặt hàng theo ngày, tính từ trạng thái từng hóa đơn (đủ cả hai phía: khớp, lệch, thiếu, thừa)
+        item_totals = {}
+        for row in invoices:
+            totals = item_totals.setdefault((row[2], row[4]), [0.0, 0.0, 0.0, 0.0])
+            for index, value in enumerate(row[9:13]):
+                if value is not None:
+                    totals[index] += value
+        item_rows = [(run_id, store, day, item_name, *totals) for (day, item_name), totals in item_totals.items()]
+        dates = sorted(row[2] for row in invoices if row[2]) or sorted(row[2] for row in mismatch_rows if row[2])
+
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, store, time.strftime('%Y-%m-%dT%H:%M:%S'), dates[0] if dates else None,
+                 dates[-1] if dates else None, summary.get('pos_count'), summary.get('hddt_count'),
+                 int(bool(summary.get('is_match'))), len(summary.get('missing_fkeys', [])),
+                 len(summary.get('extra_fkeys', [])), len(mismatches.get('quantities', [])),
+                 len(mismatches.get('amounts', []))))
+            connection.executemany('INSERT INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', invoices)
+            connection.executemany('INSERT INTO mismatches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   mismatch_rows)
+            connection.executemany('INSERT INTO item_summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', item_rows)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Giao dịch ghi BEGIN IMMEDIATE: các worker cập nhật cùng một dữ liệu (ví dụ trạng thái đối soát tăng dần
+        của một CHXD/ngày) lần lượt, không đọc-rồi-ghi chồng lên nhau.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    # --- TRUY VẤN ---
+    def _select(self, table, filters, allowed, order_by, limit=None):
+        clauses, values = [], []
+        for name, value in filters.items():
+            if value is None or value == '':
+                continue
+            if name not in allowed:
+                raise ValueError(f"Tham số lọc '{name}' không được hỗ trợ.")
+            column, operator = allowed[name]
+            clauses.append(f"{column} {operator} ?")
+            values.append(value)
+        # LIMIT âm trong SQLite là không giới hạn: luôn giữ trong khoảng 1..query_limit
+        limit = max(1, min(int(limit or self.query_limit), self.query_limit))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._connection().execute(
+            f"SELECT * FROM {table}{where} ORDER BY {order_by} LIMIT ?", (*values, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def runs(self, limit=None, **filters):
+        return self._select('runs', filters, _RUN_FILTERS, 'created_at DESC', limit)
+
+    def invoices(self, limit=None, **filters):
+        return self._select('invoices', filters, _INVOICE_FILTERS, 'invoice_date, fkey, item_name', limit)
+
+    def mismatches(self, limit=None, **filters):
+        return self._select('mismatches', filters, _MISMATCH_FILTERS, 'invoice_date, fkey, item_name', limit)
+
+    def fkey_history(self, fkey):
+        """Mọi lần FKEY xuất hiện trong lịch sử đối soát, kèm cờ 'đã từng thiếu trên HĐĐT'."""
+        rows = self._connection().execute(
+            "SELECT i.*, r.created_at FROM invoices i JOIN runs r ON r.id = i.run_id "
+            "WHERE i.fkey = ? ORDER BY r.created_at, i.item_name LIMIT ?", (fkey, self.query_limit)).fetchall()
+        occurrences = [dict(row) for row in rows]
+        return {
+            'fkey': fkey,
+            'ever_missing': any(row['status'] == 'missing' for row in occurrences),
+            'ever_extra': any(row['status'] == 'extra' for row in occurrences),
+            'ever_mismatch': any(row['status'] == 'mismatch' for row in occurrences),
+            'occurrences': occurrences,
+        }
+
+    def item_totals(self, store=None, date_from=None, date_to=None):
+        """
+        Tổng số lượng/thành tiền theo mặt hàng (Log Bơm và HĐĐT) trong khoảng ngày.
+        Một ngày được đối soát nhiều lần (đối soát lại, hoặc nằm trong cả lần một ngày và lần cả tháng)
+        chỉ tính theo lần đối soát mới nhất của ngày đó.
+        """
+        clauses, values = ['s.summary_date IS NOT NULL'], []
+        if store:
+            clauses.append('s.store = ?')
+            values.append(store)
+        if date_from:
+            clauses.append('s.summary_date >= ?')
+            values.append(date_from)
+        if date_to:
+            clauses.append('s.summary_date <= ?')
+            values.append(date_to)
+        rows = self._connection().execute(
+            "WITH latest AS ("
+            " SELECT store, summary_date, run_id FROM ("
+            "  SELECT s.store, s.summary_date, s.run_id, ROW_NUMBER() OVER ("
+            "   PARTITION BY s.store, s.summary_date ORDER BY r.created_at DESC, r.rowid DESC) AS position"
+            f"  FROM (SELECT DISTINCT store, summary_date, run_id FROM item_summaries s WHERE {' AND '.join(clauses)}) s"
+            "  JOIN runs r ON r.id = s.run_id)"
+            " WHERE position = 1)"
+            " SELECT s.item_name, ROUND(SUM(s.pos_quantity), 3) AS pos_quantity, ROUND(SUM(s.hddt_quantity), 3) AS hddt_quantity,"
+            " ROUND(SUM(s.pos_amount), 2) AS pos_amount, ROUND(SUM(s.hddt_amount), 2) AS hddt_amount"
+            " FROM item_summaries s JOIN latest l ON l.store = s.store AND l.summary_date = s.summary_date AND l.run_id = s.run_id"
+            " GROUP BY s.item_name ORDER BY s.item_name", values).fetchall()
+        return [dict(row) for row in rows]
+
+
+reconciliation_history = ReconciliationHistory()
@@ -0,0 +1,49 @@
+import os
+import re
+import time
+import uuid
+import pickle
+
+from artifact_manager import artifact_manager
+
+# --- LƯU KẾT QUẢ ĐỐI SOÁT PHÍA MÁY CHỦ ---
+# Kết quả đối soát được lưu thành tệp tạm (dùng chung giữa các worker gunicorn) theo mã định danh,
+# để các chức năng xuất (báo cáo chiết khấu, JSON...) dùng lại mà trình duyệt không phải gửi lại toàn bộ dữ liệu.
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+_PREFIX = 'reconcile'
+_SUFFIX = '.pkl'
+
+
+class ReconciliationStore:
+    def __init__(self, manager=artifact_manager, ttl_seconds=None):
+        self.manager = manager
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else manager.ttl_seconds
+
+    def save(self, reconciliation_data):
+        """Lưu kết quả đối soát, trả về mã định danh."""
+        reconciliation_id = uuid.uuid4().hex
+        payload = pickle.dumps(reconciliation_data, protocol=pickle.HIGHEST_PROTOCOL)
+        self.manager.write_bytes(payload, _PREFIX, _SUFFIX, ttl_seconds=self.ttl_seconds, artifact_id=reconciliation_id)
+        return reconciliation_id
+
+    def get(self, reconciliation_id):
+        """Lấy kết quả đối soát theo mã. Trả về None nếu mã không hợp lệ, không tồn tại hoặc đã hết hạn."""
+        if not reconciliation_id or not _ID_PATTERN.match(str(reconciliation_id)):
+            return None
+        path = self.manager.path_for(_PREFIX, reconciliation_id, _SUFFIX)
+        try:
+            # Kiểm tra hạn theo thời điểm ghi tệp vì tệp có thể do worker khác tạo ra
+            if os.path.getmtime(path) + self.ttl_seconds < time.time():
+                self.manager.release(path)
+                return None
+            return pickle.loads(self.manager.read_bytes(path))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def delete(self, reconciliation_id):
+        if reconciliation_id and _ID_PATTERN.match(str(reconciliation_id)):
+            self.manager.release(self.manager.path_for(_PREFIX, reconciliation_id, _SUFFIX))
+
+
+reconciliation_store = ReconciliationStore()
@@ -0,0 +1,366 @@
+"""
+Kiểm thử hồi quy theo kết quả mẫu (golden): chạy các bảng kê cố định trong golden/fixtures qua
+process_hddt_report, process_pos_report, perform_reconciliation, đối soát ba chiều và đối soát tăng dần (hai lần
+tải lên trên cơ sở dữ liệu lịch sử tạm), so sánh từng ô với tệp UpSSE mẫu hoặc kết quả JSON mẫu (golden/expected)
+và kiểm tra ngân sách thời gian/bộ nhớ của từng bảng kê.
+Mọi tối ưu (engine mới, writer mới...) phải qua được bộ này: kết quả không đổi và không chậm/tốn bộ nhớ hơn ngân sách.
+
+Cách dùng:
+    python regression.py                      # chạy toàn bộ
+    python regression.py hddt_month_end ...   # chỉ chạy các bảng kê chỉ định
+    python regression.py --update-golden      # ghi lại kết quả mẫu từ phiên bản mã hiện tại (chỉ khi thay đổi là cố ý)
+    python regression.py --regenerate-fixtures
+                                              # dựng lại tệp đầu vào từ synthetic_data.py (kéo theo --update-golden)
+Tùy chọn: --repeat N (số lần đo thời gian, lấy trung vị), --budget-scale 1.5 (nới ngân sách trên máy chậm hơn), --json.
+Mã thoát 1 nếu có bảng kê cho kết quả khác mẫu hoặc vượt ngân sách.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+
+from openpyxl import load_workbook
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(APP_DIR, 'golden')
+FIXTURE_DIR = os.path.join(GOLDEN_DIR, 'fixtures')
+EXPECTED_DIR = os.path.join(GOLDEN_DIR, 'expected')
+DEFAULT_BUDGET_SCALE = float(os.environ.get('REGRESSION_BUDGET_SCALE', 1.0))
+# Sai số cho phép khi so sánh số thực (tổng cộng dồn theo thứ tự khác nhau cho kết quả lệch ở chữ số cuối)
+NUMBER_TOLERANCE = 1e-6
+MAX_REPORTED_DIFFERENCES = 10
+
+_MONTH_END = datetime(2025, 7, 31)
+
+# Bảng kê cố định: loại xử lý, cửa hàng, tham số và ngân sách (giây: trung vị thời gian xử lý; mb: đỉnh bộ nhớ
+# Python cấp phát theo tracemalloc). Ngân sách đặt khoảng 2-3 lần số đo trên máy phát triển.
+# 'generate' chỉ dùng cho --regenerate-fixtures: tham số truyền cho synthetic_data.
+FIXTURES = {
+    'hddt_small': {
+        'kind': 'hddt', 'store': 'Bến xe phía Bắc', 'params': {'price_periods': '1', 'invoice_number': ''},
+        'generate': {'rows': 40, 'seed': 11}, 'budget': {'seconds': 0.15, 'mb': 5},
+    },
+    'hddt_month_end': {
+        'kind': 'hddt', 'store': 'Tam Điệp', 'params': {'price_periods': '1', 'invoice_number': ''},
+        'generate': {'rows': 1500, 'seed': 12}, 'budget': {'seconds': 2.5, 'mb': 50},
+    },
+    'hddt_two_periods': {
+        'kind': 'hddt', 'store': 'Nguyễn Huệ', 'params': {'price_periods': '2', 'invoice_number': '0000150'},
+        'generate': {'rows': 300, 'seed': 13}, 'budget': {'seconds': 0.4, 'mb': 10},
+    },
+    'pos_small': {
+        'kind': 'pos', 'store': 'Bến xe phía Bắc', 'params': {'price_periods': '1', 'invoice_number': ''},
+        'generate': {'rows': 40, 'seed': 21}, 'budget': {'seconds': 0.15, 'mb': 5},
+    },
+    'pos_month_end': {
+        'kind': 'pos', 'store': 'Hoa Lư', 'params': {'price_periods': '1', 'invoice_number': ''},
+        'generate': {'rows': 1500, 'seed': 22}, 'budget': {'seconds': 2.0, 'mb': 45},
+    },
+    'pos_two_periods': {
+        'kind': 'pos', 'store': 'Phủ Lý', 'params': {'price_periods': '2', 'invoice_number': '0000150'},
+        'generate': {'rows': 300, 'seed': 23}, 'budget': {'seconds': 0.4, 'mb': 10},
+    },
+    'reconcile_small': {
+        'kind': 'reconcile', 'store': 'Bến xe phía Bắc', 'params': {},
+        'generate': {'rows': 40, 'seed': 31}, 'budget': {'seconds': 0.15, 'mb': 5},
+    },
+    'reconcile_month_end': {
+        'kind': 'reconcile', 'store': 'Tràng An', 'params': {},
+        'generate': {'rows': 1500, 'seed': 32, 'missing': 5, 'extra': 3, 'amount_diff': 40}, 'budget': {'seconds': 1.5, 'mb': 10},
+    },
+    # Log bơm/POS/HĐĐT cùng FKEY và số hóa đơn: hóa đơn gộp nhiều FKEY, thiếu trên POS, lệch số lượng, chỉ có trên POS
+    'reconcile_three_way': {
+        'kind': 'three_way', 'store': 'Nguyễn Huệ', 'params': {},
+        'generate': {'rows': 300, 'seed': 41, 'missing': 3, 'pos_missing': 2, 'pos_quantity_diff': 2,
+                     'split_invoices': 5, 'pos_extra': 1},
+        'budget': {'seconds': 0.4, 'mb': 5},
+    },
+    # Hai lần tải lên cùng CHXD/ngày: thay đổi new_matches/resolved/broken/removed và trạng thái discount
+    'reconcile_incremental': {
+        'kind': 'incremental', 'store': 'Phủ Lý', 'params': {},
+        'generate': {'rows': 40, 'seed': 42}, 'budget': {'seconds': 0.15, 'mb': 5},
+    },
+}
+
+# Tệp đầu vào theo loại bảng kê; các loại đối soát được so sánh với kết quả JSON mẫu
+_INPUT_ROLES = {
+    'reconcile': ('log_bom', 'hddt'),
+    'three_way': ('log_bom', 'pos', 'hddt'),
+    'incremental': ('log_bom', 'hddt', 'log_bom_update', 'hddt_update'),
+}
+
+
+def _fixture_inputs(name):
+    roles = _INPUT_ROLES.get(FIXTURES[name]['kind'], ('file',))
+    return {role: os.path.join(FIXTURE_DIR, f'{name}_{role}.xlsx') for role in roles}
+
+
+def regenerate_fixtures(web_app, names):
+    """Dựng lại tệp đầu vào từ synthetic_data.py (chỉ khi cần bổ sung/thay đổi bảng kê cố định)."""
+    from synthetic_data import hddt_report, incremental_uploads, pos_report, reconciliation_pair, three_way_triplet
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for name in names:
+        fixture = FIXTURES[name]
+        symbol = web_app._find_chxd_symbol(fixture['store'], web_app.get_chxd_list())
+        options = dict(fixture['generate'])
+        rows = options.pop('rows')
+        if fixture['kind'] == 'hddt':
+            contents = {'file': hddt_report(rows, _MONTH_END, symbol, **options)}
+        elif fixture['kind'] == 'pos':
+            contents = {'file': pos_report(rows, _MONTH_END, symbol, **options)}
+        elif fixture['kind'] == 'three_way':
+            contents = dict(zip(('log_bom', 'pos', 'hddt'),
+                                three_way_triplet(rows, _MONTH_END, fixture['store'], symbol, **options)))
+        elif fixture['kind'] == 'incremental':
+            (log_bom_bytes, hddt_bytes), (log_bom_update, hddt_update) = incremental_uploads(
+                rows, _MONTH_END, fixture['store'], symbol, **options)
+            contents = {'log_bom': log_bom_bytes, 'hddt': hddt_bytes,
+                        'log_bom_update': log_bom_update, 'hddt_update': hddt_update}
+        else:
+            log_bom_bytes, hddt_bytes = reconciliation_pair(rows, _MONTH_END, fixture['store'], symbol, **options)
+            contents = {'log_bom': log_bom_bytes, 'hddt': hddt_bytes}
+        for role, path in _fixture_inputs(name).items():
+            with open(path, 'wb') as f:
+                f.write(contents[role])
+
+
+# --- CHẠY VÀ CHUẨN HÓA KẾT QUẢ ---
+def _run_incremental_fixture(web_app, fixture, symbol, inputs, discount_data):
+    """Hai lần tải lên liên tiếp trên cơ sở dữ liệu lịch sử tạm (mỗi lần chạy bắt đầu từ trạng thái trống)."""
+    from reconcile_incremental import IncrementalReconciler
+    from reconciliation_history import ReconciliationHistory
+
+    with tempfile.TemporaryDirectory(prefix='regression_history_') as directory:
+        reconciler = IncrementalReconciler(ReconciliationHistory(os.path.join(directory, 'history.sqlite3')))
+        return {
+            step: web_app.perform_incremental_reconciliation(inputs[log_role], inputs[hddt_role], fixture['store'], symbol,
+                                                            discount_data, reconciler=reconciler)
+            for step, log_role, hddt_role in (('first', 'log_bom', 'hddt'), ('second', 'log_bom_update', 'hddt_update'))
+        }
+
+
+def run_fixture(web_app, name):
+    """Chạy một bảng kê qua handler tương ứng. Trả về {tên tệp kết quả: bytes} hoặc dict kết quả đối soát."""
+    fixture = FIXTURES[name]
+    inputs = {role: open(path, 'rb').read() for role, path in _fixture_inputs(name).items()}
+    config = web_app._global_static_config_data
+    symbol = web_app._find_chxd_symbol(fixture['store'], web_app.get_chxd_list())
+    params = fixture['params']
+    if fixture['kind'] == 'reconcile':
+        return web_app.perform_reconciliation(inputs['log_bom'], inputs['hddt'], fixture['store'], symbol,
+                                              config.get('discount_data', {}))
+    if fixture['kind'] == 'three_way':
+        return web_app.perform_three_way_reconciliation(inputs['log_bom'], inputs['pos'], inputs['hddt'],
+                                                        fixture['store'], symbol)
+    if fixture['kind'] == 'incremental':
+        return _run_incremental_fixture(web_app, fixture, symbol, inputs, config.get('discount_data', {}))
+    # Ứng dụng gọi các handler qua job_pool (run_job): ở đây gọi trực tiếp hàm của handler
+    from hddt_handler import process_hddt_report
+    from pos_handler import process_pos_report
+    if fixture['kind'] == 'hddt':
+        result = process_hddt_report(
+            file_content_bytes=inputs['file'], selected_chxd=fixture['store'], price_periods=params['price_periods'],
+            new_price_invoice_number=params['invoice_number'], confirmed_date_str=params.get('confirmed_date'),
+            static_data_hddt=config['hddt_config'], selected_chxd_symbol=symbol)
+    else:
+        result = process_pos_report(
+            file_content_bytes=inputs['file'], selected_chxd=fixture['store'], price_periods=params['price_periods'],
+            new_price_invoice_number=params['invoice_number'], static_data_pos=config['pos_config'],
+            selected_chxd_symbol=symbol)
+    if isinstance(result, io.BytesIO):
+        return {f'{name}.xlsx': result.getvalue()}
+    if isinstance(result, dict) and ('old' in result or 'new' in result):
+        return {f'{name}_{period}.xlsx': result[period].getvalue() for period in ('old', 'new') if result.get(period)}
+    raise ValueError(f"Hàm xử lý trả về kết quả không hợp lệ: {type(result).__name__}")
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _normalize_json(value):
+    return json.loads(json.dumps(value, ensure_ascii=False, default=_json_default))
+
+
+def _values_equal(expected, actual):
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)) \
+            and not isinstance(expected, bool) and not isinstance(actual, bool):
+        return math.isclose(expected, actual, rel_tol=NUMBER_TOLERANCE, abs_tol=NUMBER_TOLERANCE)
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        return expected.keys() == actual.keys() and all(_values_equal(expected[k], actual[k]) for k in expected)
+    if isinstance(expected, list) and isinstance(actual, list):
+        return len(expected) == len(actual) and all(_values_equal(e, a) for e, a in zip(expected, actual))
+    return expected == actual
+
+
+def compare_workbooks(expected_bytes, actual_bytes):
+    """So sánh từng ô (giá trị) trên mọi sheet, trả về danh sách mô tả các ô khác nhau (tối đa MAX_REPORTED_DIFFERENCES)."""
+    expected_wb = load_workbook(io.BytesIO(expected_bytes), data_only=True)
+    actual_wb = load_workbook(io.BytesIO(actual_bytes), data_only=True)
+    differences = []
+    if expected_wb.sheetnames != actual_wb.sheetnames:
+        differences.append(f"sheet {expected_wb.sheetnames} -> {actual_wb.sheetnames}")
+    for sheet_name in expected_wb.sheetnames:
+        if sheet_name not in actual_wb.sheetnames:
+            continue
+        expected_ws, actual_ws = expected_wb[sheet_name], actual_wb[sheet_name]
+        max_row = max(expected_ws.max_row, actual_ws.max_row)
+        max_col = max(expected_ws.max_column, actual_ws.max_column)
+        if (expected_ws.max_row, expected_ws.max_column) != (actual_ws.max_row, actual_ws.max_column):
+            differences.append(f"{sheet_name}: kích thước {expected_ws.max_row}x{expected_ws.max_column} "
+                               f"-> {actual_ws.max_row}x{actual_ws.max_column}")
+        for row in range(1, max_row + 1):
+            for col in range(1, max_col + 1):
+                expected_cell = expected_ws.cell(row=row, column=col)
+                actual_value = actual_ws.cell(row=row, column=col).value
+                if not _values_equal(expected_cell.value, actual_value):
+                    differences.append(f"{sheet_name}!{expected_cell.coordinate}: {expected_cell.value!r} -> {actual_value!r}")
+                    if len(differences) >= MAX_REPORTED_DIFFERENCES:
+                        return differences
+    return differences
+
+
+def compare_reconciliation(expected, actual, path='', differences=None):
+    """So sánh đệ quy kết quả đối soát (dict/list), trả về đường dẫn các giá trị khác nhau."""
+    differences = [] if differences is None else differences
+    if len(differences) >= MAX_REPORTED_DIFFERENCES:
+        return differences
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in sorted(set(expected) | set(actual)):
+            if key not in expected or key not in actual:
+                differences.append(f"{path}.{key}: chỉ có ở {'kết quả mới' if key in actual else 'mẫu'}")
+            else:
+                compare_reconciliation(expected[key], actual[key], f"{path}.{key}", differences)
+    elif isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            differences.append(f"{path}: số phần tử {len(expected)} -> {len(actual)}")
+        for index, (e, a) in enumerate(zip(expected, actual)):
+            compare_reconciliation(e, a, f"{path}[{index}]", differences)
+    elif not _values_equal(expected, actual):
+        differences.append(f"{path}: {expected!r} -> {actual!r}")
+    return differences[:MAX_REPORTED_DIFFERENCES]
+
+
+# --- ĐO THỜI GIAN, BỘ NHỚ VÀ SO SÁNH VỚI MẪU ---
+def check_fixture(web_app, name, repeat=3, update_golden=False, budget_scale=DEFAULT_BUDGET_SCALE):
+    fixture = FIXTURES[name]
+    report = {'fixture': name, 'kind': fixture['kind'], 'status': 'ok', 'differences': [],
+              'seconds': None, 'peak_mb': None,
+              'budget_seconds': round(fixture['budget']['seconds'] * budget_scale, 3),
+              'budget_mb': round(fixture['budget']['mb'] * budget_scale, 1)}
+    try:
+        # Lần chạy đầu (làm nóng cache, import) kèm tracemalloc để đo đỉnh bộ nhớ; tracemalloc làm chậm
+        # nên thời gian được đo ở các lần chạy sau
+        tracemalloc.start()
+        try:
+            output = run_fixture(web_app, name)
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        durations = []
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            run_fixture(web_app, name)
+            durations.append(time.perf_counter() - started)
+    except Exception as e:
+        report.update(status='ERROR', differences=[f"{type(e).__name__}: {e}"])
+        return report
+    report['seconds'] = round(statistics.median(durations), 3)
+    report['peak_mb'] = round(peak_bytes / (1024 * 1024), 1)
+
+    os.makedirs(EXPECTED_DIR, exist_ok=True)
+    if fixture['kind'] in _INPUT_ROLES:
+        expected_path = os.path.join(EXPECTED_DIR, f'{name}.json')
+        actual = _normalize_json(output)
+        if update_golden or not os.path.exists(expected_path):
+            with open(expected_path, 'w', encoding='utf-8') as f:
+                json.dump(actual, f, ensure_ascii=False, indent=1, sort_keys=True)
+            report['status'] = 'golden'
+        else:
+            with open(expected_path, encoding='utf-8') as f:
+                report['differences'] = compare_reconciliation(json.load(f), actual)
+    else:
+        expected_files = sorted(f for f in os.listdir(EXPECTED_DIR)
+                                if f in (f'{name}.xlsx', f'{name}_old.xlsx', f'{name}_new.xlsx'))
+        if update_golden or not expected_files:
+            for filename in expected_files:
+                os.remove(os.path.join(EXPECTED_DIR, filename))
+            for filename, content in output.items():
+                with open(os.path.join(EXPECTED_DIR, filename), 'wb') as f:
+                    f.write(content)
+            report['status'] = 'golden'
+        elif expected_files != sorted(output):
+            report['differences'] = [f"tệp kết quả {expected_files} -> {sorted(output)}"]
+        else:
+            for filename in expected_files:
+                with open(os.path.join(EXPECTED_DIR, filename), 'rb') as f:
+                    report['differences'] += [f"{filename} {d}" for d in compare_workbooks(f.read(), output[filename])]
+
+    if report['differences']:
+        report['status'] = 'DIFF'
+    elif report['status'] == 'ok' and (report['seconds'] > report['budget_seconds'] or report['peak_mb'] > report['budget_mb']):
+        report['status'] = 'BUDGET'
+    return report
+
+
+def _format_report(reports):
+    lines = [f"{'bảng kê':<22} {'loại':<12} {'giây':>7} {'ngân sách':>10} {'MB':>7} {'ngân sách':>10}  kết quả"]
+    for r in reports:
+        seconds = f"{r['seconds']:.3f}" if r['seconds'] is not None else '-'
+        peak = f"{r['peak_mb']:.1f}" if r['peak_mb'] is not None else '-'
+        lines.append(f"{r['fixture']:<22} {r['kind']:<12} {seconds:>7} {r['budget_seconds']:>10} {peak:>7} "
+                     f"{r['budget_mb']:>10}  {r['status']}")
+        for difference in r['differences']:
+            lines.append(f"    {difference}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm thử hồi quy theo kết quả mẫu và ngân sách thời gian/bộ nhớ.")
+    parser.add_argument('fixtures', nargs='*', help="Tên bảng kê (mặc định: tất cả)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget-scale', type=float, default=DEFAULT_BUDGET_SCALE)
+    parser.add_argument('--update-golden', action='store_true')
+    parser.add_argument('--regenerate-fixtures', action='store_true')
+    parser.add_argument('--json', action='store_true', help="In báo cáo dạng JSON")
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.fixtures if name not in FIXTURES]
+    if unknown:
+        parser.error(f"Không có bảng kê: {', '.join(unknown)}. Có: {', '.join(FIXTURES)}")
+    names = args.fixtures or list(FIXTURES)
+
+    # Cấu hình tĩnh (Data_HDDT.xlsx, MaHH.xlsx...) được nạp theo đường dẫn tương đối với thư mục ứng dụng
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    import app as web_app
+    from job_pool import job_pool
+    # tracemalloc chỉ thấy tiến trình hiện tại: chạy mọi job (phân tích file đối soát...) ngay tại chỗ để ngân sách
+    # bộ nhớ tính cả phần phân tích, vốn là phần cấp phát lớn nhất
+    job_pool.size = 0
+
+    if args.regenerate_fixtures:
+        regenerate_fixtures(web_app, names)
+    missing = [name for name in names if not all(os.path.exists(p) for p in _fixture_inputs(name).values())]
+    if missing:
+        print(f"Thiếu tệp đầu vào cho: {', '.join(missing)} (chạy với --regenerate-fixtures).")
+        return 1
+
+    reports = [check_fixture(web_app, name, args.repeat, args.update_golden or args.regenerate_fixtures,
+                             args.budget_scale) for name in names]
+    print(json.dumps(reports, ensure_ascii=False, indent=2) if args.json else _format_report(reports))
+    return 1 if any(r['status'] not in ('ok', 'golden') for r in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
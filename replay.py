@@ -0,0 +1,174 @@
+"""
+Chạy lại các bảng kê đã lưu bởi capture.py (đã ẩn danh) qua các handler hiện tại,
+so sánh thời gian xử lý và kết quả với lần chạy mốc (baseline.json trong từng thư mục capture).
+
+Cách dùng:
+    python replay.py                      # replay toàn bộ CAPTURE_DIR
+    python replay.py <thư mục capture>... # replay các capture chỉ định
+    python replay.py --update-baseline    # ghi lại mốc từ phiên bản mã hiện tại
+Tùy chọn: --repeat N (số lần chạy, lấy trung vị), --tolerance 0.2 (ngưỡng chậm hơn mốc, 20%).
+Mã thoát 1 nếu có kết quả khác mốc hoặc chậm hơn ngưỡng.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import date, datetime
+
+from openpyxl import load_workbook
+
+BASELINE_FILENAME = 'baseline.json'
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _workbook_rows(buffer):
+    buffer.seek(0)
+    wb = load_workbook(buffer, read_only=True, data_only=True)
+    rows = [[_json_default(v) if isinstance(v, (datetime, date)) else v for v in row]
+            for row in wb.active.iter_rows(values_only=True)]
+    wb.close()
+    return rows
+
+
+def canonical_output(result):
+    """Dạng chuẩn hóa (so sánh được) của kết quả handler: nội dung ô của workbook hoặc dict kết quả đối soát."""
+    if isinstance(result, io.BytesIO):
+        return {'workbook': _workbook_rows(result)}
+    if isinstance(result, dict) and ('old' in result or 'new' in result):
+        return {period: _workbook_rows(result[period]) for period in ('old', 'new') if result.get(period)}
+    if isinstance(result, dict):
+        return {key: value for key, value in result.items() if key != 'reconciliation_id'}
+    return {'value': result}
+
+
+def _digest(output):
+    return hashlib.sha256(json.dumps(output, sort_keys=True, ensure_ascii=False, default=_json_default)
+                          .encode('utf-8')).hexdigest()
+
+
+def describe_difference(expected, actual):
+    """Mô tả ngắn gọn chỗ khác nhau đầu tiên giữa kết quả mốc và kết quả hiện tại."""
+    for key in sorted(set(expected) | set(actual)):
+        if key not in expected or key not in actual:
+            return f"khóa '{key}' chỉ có ở {'kết quả mới' if key in actual else 'mốc'}"
+        old, new = expected[key], actual[key]
+        if json.dumps(old, sort_keys=True, default=_json_default) == json.dumps(new, sort_keys=True, default=_json_default):
+            continue
+        if isinstance(old, list) and isinstance(new, list):
+            if len(old) != len(new):
+                return f"'{key}': số dòng {len(old)} -> {len(new)}"
+            for index, (old_row, new_row) in enumerate(zip(old, new)):
+                if old_row != new_row:
+                    return f"'{key}' dòng {index + 1}: {old_row} -> {new_row}"
+        return f"'{key}' khác mốc"
+    return 'khác mốc'
+
+
+class Replayer:
+    """Chạy một capture qua handler tương ứng, dùng cấu hình tĩnh đã nạp của ứng dụng."""
+
+    def __init__(self, web_app):
+        self.web_app = web_app
+
+    def run_once(self, capture_dir, meta):
+        inputs = {role: open(os.path.join(capture_dir, info['file']), 'rb').read() for role, info in meta['inputs'].items()}
+        params = meta['params']
+        started = time.perf_counter()
+        try:
+            if meta['kind'] == 'upsse':
+                result, _ = self.web_app._convert_upsse(
+                    inputs['file'], params['selected_chxd'], params['price_periods'], params['invoice_number'],
+                    params['confirmed_date'], report_type=params.get('report_type'))
+            elif meta['kind'] == 'reconcile':
+                discount_data = self.web_app._global_static_config_data.get('discount_data', {})
+                result = self.web_app.perform_reconciliation(
+                    inputs['log_bom'], inputs['hddt'], params['selected_chxd'], params['selected_chxd_symbol'], discount_data)
+            else:
+                raise ValueError(f"Loại capture không hỗ trợ: {meta['kind']}")
+            output = canonical_output(result)
+        except Exception as e:
+            output = {'error': f"{type(e).__name__}: {e}"}
+        return time.perf_counter() - started, output
+
+    def replay(self, capture_dir, repeat=1, update_baseline=False, tolerance=0.2):
+        with open(os.path.join(capture_dir, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        durations = []
+        output = None
+        for _ in range(max(1, repeat)):
+            seconds, output = self.run_once(capture_dir, meta)
+            durations.append(seconds)
+        duration_ms = round(statistics.median(durations) * 1000, 2)
+
+        baseline_path = os.path.join(capture_dir, BASELINE_FILENAME)
+        report = {'capture_id': meta['capture_id'], 'kind': meta['kind'], 'duration_ms': duration_ms,
+                  'production_ms': meta['production']['duration_ms'], 'baseline_ms': None,
+                  'output': 'new', 'slower': False, 'detail': output.get('error', '')}
+        if os.path.exists(baseline_path) and not update_baseline:
+            with open(baseline_path, encoding='utf-8') as f:
+                baseline = json.load(f)
+            report['baseline_ms'] = baseline['duration_ms']
+            if baseline['digest'] == _digest(output):
+                report['output'] = 'same'
+            else:
+                report['output'] = 'DIFF'
+                report['detail'] = describe_difference(baseline['output'], json.loads(json.dumps(output, default=_json_default)))
+            report['slower'] = duration_ms > baseline['duration_ms'] * (1 + tolerance)
+        else:
+            with open(baseline_path, 'w', encoding='utf-8') as f:
+                json.dump({'duration_ms': duration_ms, 'digest': _digest(output), 'output': output,
+                           'recorded_at': datetime.now().isoformat(timespec='seconds')},
+                          f, ensure_ascii=False, default=_json_default)
+        return report
+
+
+def _format_report(reports):
+    lines = [f"{'capture':<45} {'loại':<10} {'prod ms':>10} {'mốc ms':>10} {'hiện tại':>10} {'Δ%':>7}  kết quả"]
+    for r in reports:
+        delta = f"{(r['duration_ms'] / r['baseline_ms'] - 1) * 100:+.0f}" if r['baseline_ms'] else '-'
+        flag = ' CHẬM' if r['slower'] else ''
+        baseline = f"{r['baseline_ms']:.1f}" if r['baseline_ms'] else '-'
+        lines.append(f"{r['capture_id']:<45} {r['kind']:<10} {r['production_ms']:>10.1f} {baseline:>10} "
+                     f"{r['duration_ms']:>10.1f} {delta:>7}  {r['output']}{flag} {r['detail']}".rstrip())
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay bảng kê đã lưu (ẩn danh) và so sánh với mốc.")
+    parser.add_argument('captures', nargs='*', help="Thư mục capture (mặc định: toàn bộ CAPTURE_DIR)")
+    parser.add_argument('--capture-dir', help="Thư mục chứa các capture")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--json', action='store_true', help="In báo cáo dạng JSON")
+    args = parser.parse_args(argv)
+
+    # Cấu hình tĩnh (Data_HDDT.xlsx, MaHH.xlsx...) được nạp theo đường dẫn tương đối với thư mục ứng dụng
+    capture_paths = [os.path.abspath(path) for path in args.captures]
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import app as web_app
+    from capture import capture_manager
+
+    if not capture_paths:
+        capture_paths = capture_manager.list_captures(args.capture_dir)
+    if not capture_paths:
+        print("Không có capture nào để replay.")
+        return 0
+
+    replayer = Replayer(web_app)
+    reports = [replayer.replay(path, args.repeat, args.update_baseline, args.tolerance) for path in capture_paths]
+    print(json.dumps(reports, ensure_ascii=False, indent=2) if args.json else _format_report(reports))
+    return 1 if any(r['output'] == 'DIFF' or r['slower'] for r in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import io
+import re
+from datetime import datetime
+from openpyxl import load_workbook
+import pandas as pd
+
+# --- CÁC HÀM XÁC ĐỊNH NGÀY BÁO CÁO VÀ ĐẶT TÊN TỆP ĐẦU RA ---
+# Dùng chung cho app.py và các tiến trình xử lý hàng loạt (batch_handler.py).
+
+def _to_float_naming(value):
+    """Chuyển đổi giá trị sang float, xử lý các trường hợp lỗi."""
+    if value is None:
+        return 0.0
+    try:
+        return float(str(value).replace(',', '').strip())
+    except (ValueError, TypeError):
+        return 0.0
+
+def _sanitize_filename_piece(s: str) -> str:
+    """Làm sạch chuỗi để đưa vào tên file an toàn."""
+    if not s:
+        return "Untitled"
+    s = s.strip()
+    return re.sub(r'[\\/:*?"<>|\r\n]+', '_', s)
+
+def _parse_date_like_hddt(cell_val):
+    """Phân tích ngày tháng từ bảng kê hóa đơn HDDT."""
+    if cell_val is None:
+        return None
+    if isinstance(cell_val, datetime):
+        return cell_val.date()
+    if isinstance(cell_val, (int, float)):
+        try:
+            return pd.to_datetime(float(cell_val), unit='D', origin='1899-12-30').date()
+        except Exception:
+            return None
+    if isinstance(cell_val, str):
+        date_str = cell_val.strip()
+        fmts = ['%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d', '%Y-%m-%d', '%d/%m/%y', '%d-%m-%y']
+        for fmt in fmts:
+            try:
+                return datetime.strptime(date_str, fmt).date()
+            except ValueError:
+                continue
+    return None
+
+def _parse_date_like_pos(cell_val):
+    """Phân tích ngày tháng từ bảng kê hóa đơn POS."""
+    if cell_val is None:
+        return None
+    if isinstance(cell_val, datetime):
+        return cell_val.date()
+    if isinstance(cell_val, (int, float)):
+        try:
+            return pd.to_datetime(float(cell_val), unit='D', origin='1899-12-30').date()
+        except Exception:
+            return None
+    if isinstance(cell_val, str):
+        date_str = cell_val.strip()
+        fmts = [
+            '%Y-%m-%d %H:%M:%S', '%Y-%m-%d',
+            '%d-%m-%Y %H:%M:%S', '%d-%m-%Y',
+            '%d/%m/%Y %H:%M:%S', '%d/%m/%Y'
+        ]
+        for fmt in fmts:
+            try:
+                return datetime.strptime(date_str, fmt).date()
+            except ValueError:
+                continue
+    return None
+
+def _extract_report_date_for_filename(file_bytes: bytes, report_type: str, confirmed_date_str: str | None) -> datetime.date:
+    """Xác định ngày báo cáo để phục vụ đặt tên tệp tin đầu ra."""
+    try:
+        if report_type == 'HDDT':
+            if confirmed_date_str:
+                try:
+                    return datetime.strptime(confirmed_date_str, '%Y-%m-%d').date()
+                except Exception:
+                    pass
+            wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
+            ws = wb.active
+            unique_dates = set()
+            for row in ws.iter_rows(min_row=11, values_only=True):
+                qty = _to_float_naming(row[9] if len(row) > 9 else None)
+                if qty > 0:
+                    dt = _parse_date_like_hddt(row[21] if len(row) > 21 else None)
+                    if dt:
+                        unique_dates.add(dt)
+            wb.close()
+            if unique_dates:
+                return min(unique_dates)
+        elif report_type == 'POS':
+            wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
+            ws = wb.active
+            unique_dates = set()
+            for row in ws.iter_rows(min_row=5, values_only=True):
+                dt = _parse_date_like_pos(row[3] if len(row) > 3 else None)
+                if dt:
+                    unique_dates.add(dt)
+            wb.close()
+            if unique_dates:
+                return min(unique_dates)
+    except Exception:
+        pass
+    return datetime.today().date()
+
+def _make_base_filename(store_name: str, file_date: datetime.date) -> str:
+    store = _sanitize_filename_piece(store_name)
+    date_part = f"{file_date.day:02d}.{file_date.month:02d}.{file_date.year}"
+    return f"{store}.{date_part}"
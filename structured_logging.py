@@ -0,0 +1,224 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+DEFAULT_LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Số cảnh báo cùng loại (theo từng dòng dữ liệu) được ghi trong một request, phần còn lại chỉ được đếm
+DEFAULT_ROW_WARNING_LIMIT = int(os.environ.get('LOG_ROW_WARNING_LIMIT', 5))
+# Ngoài request (luồng nền, tiến trình batch) giới hạn được tính theo cửa sổ thời gian
+DEFAULT_ROW_WARNING_WINDOW_SECONDS = int(os.environ.get('LOG_ROW_WARNING_WINDOW_SECONDS', 60))
+
+# Ngữ cảnh gắn vào mọi dòng log: request_id, store, report_type, endpoint...
+_log_context = contextvars.ContextVar('upsse_log_context', default={})
+# Số liệu tích lũy của request hiện tại (số dòng, thời gian từng bước, số cảnh báo bị lược bớt)
+_request_stats = contextvars.ContextVar('upsse_request_stats', default=None)
+
+_RESERVED_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Mỗi bản ghi log là một dòng JSON: thời gian, mức, logger, thông điệp, ngữ cảnh và các trường bổ sung."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        for key, value in vars(record).items():
+            if key not in _RESERVED_RECORD_ATTRS and key != 'context':
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Đưa bản ghi vào hàng đợi, luồng ghi riêng mới thực sự ghi ra stdout để request không bị chặn
+    bởi thao tác ghi đồng bộ. Ngữ cảnh được chụp lại ngay lúc ghi log (luồng ghi không thấy contextvars).
+    """
+
+    def __init__(self, log_queue, target_handler):
+        super().__init__(log_queue)
+        self._target_handler = target_handler
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # Luồng ghi không tồn tại sau khi fork (gunicorn preload), mỗi tiến trình tự khởi động lại
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._listener_lock:
+            if self._listener_pid == pid:
+                return
+            self._listener = logging.handlers.QueueListener(self.queue, self._target_handler, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = pid
+
+    def prepare(self, record):
+        # Định dạng sẵn thông điệp và traceback; phần JSON do formatter của luồng ghi đảm nhận
+        record = copy.copy(record)
+        record.context = dict(_log_context.get())
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exception = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        super().enqueue(record)
+
+    def stop(self):
+        """Ghi nốt các bản ghi còn trong hàng đợi (gọi khi tiến trình kết thúc)."""
+        with self._listener_lock:
+            if self._listener is not None and self._listener_pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._listener_pid = None
+
+
+_configured_handler = None
+
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, stream=None):
+    """Cài đặt log JSON có bộ đệm cho logger gốc (gọi một lần khi khởi tạo ứng dụng)."""
+    global _configured_handler
+    if _configured_handler is not None:
+        return _configured_handler
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter())
+    handler = _ContextQueueHandler(queue.SimpleQueue(), target)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.stop)
+    _configured_handler = handler
+    return handler
+
+
+def bind_log_context(**fields):
+    """Bổ sung trường ngữ cảnh (ví dụ store, report_type) cho các dòng log tiếp theo trong request hiện tại."""
+    context = dict(_log_context.get())
+    context.update({key: value for key, value in fields.items() if value is not None})
+    _log_context.set(context)
+
+
+def begin_log_context(request_id=None, **fields):
+    """
+    Mở ngữ cảnh log cho một request/công việc (dùng cho hook before_request/teardown_request).
+    Trả về token để truyền cho end_log_context().
+    """
+    context_token = _log_context.set({'request_id': request_id or uuid.uuid4().hex[:16],
+                                      **{key: value for key, value in fields.items() if value is not None}})
+    stats_token = _request_stats.set({'rows': {}, 'timings_ms': {}, 'suppressed': {}, 'warnings': {}, 'memory': {}})
+    return context_token, stats_token
+
+
+def end_log_context(tokens):
+    context_token, stats_token = tokens
+    _request_stats.reset(stats_token)
+    _log_context.reset(context_token)
+
+
+@contextmanager
+def log_context(request_id=None, **fields):
+    """Mở ngữ cảnh log cho một khối lệnh; kết thúc khối thì khôi phục ngữ cảnh cũ."""
+    tokens = begin_log_context(request_id, **fields)
+    try:
+        yield current_request_id()
+    finally:
+        end_log_context(tokens)
+
+
+def current_request_id():
+    return _log_context.get().get('request_id')
+
+
+def log_context_fields():
+    """Bản sao ngữ cảnh log hiện tại, để tiến trình/luồng khác ghi log cùng ngữ cảnh."""
+    return dict(_log_context.get())
+
+
+def request_stats():
+    """Số liệu tích lũy của request hiện tại (số dòng, thời gian từng bước, cảnh báo bị lược), None nếu ngoài request."""
+    stats = _request_stats.get()
+    if stats is None:
+        return None
+    summary = {'rows': dict(stats['rows']), 'timings_ms': dict(stats['timings_ms']),
+               'suppressed_warnings': dict(stats['suppressed'])}
+    if stats['memory']:
+        summary['memory'] = dict(stats['memory'])
+    return summary
+
+
+def record_rows(name, amount):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats['rows'][name] = stats['rows'].get(name, 0) + amount
+
+
+def record_timing(name, seconds):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats['timings_ms'][name] = round(stats['timings_ms'].get(name, 0) + seconds * 1000, 2)
+
+
+def record_memory(name, report):
+    """Số đo bộ nhớ của một job (xem memory_profiling.py), tóm tắt vào dòng log kết thúc request."""
+    stats = _request_stats.get()
+    if stats is not None:
+        stats['memory'][name] = {key: report.get(key) for key in ('rss_growth_mb', 'rss_retained_mb', 'traced_peak_mb')}
+
+
+_window_lock = threading.Lock()
+_window_counts = {}
+
+
+def _allow_row_warning(key, limit, window_seconds):
+    stats = _request_stats.get()
+    if stats is not None:
+        count = stats['warnings'].get(key, 0) + 1
+        stats['warnings'][key] = count
+        if count > limit:
+            stats['suppressed'][key] = stats['suppressed'].get(key, 0) + 1
+            return False
+        return True
+    now = time.monotonic()
+    with _window_lock:
+        started, count = _window_counts.get(key, (now, 0))
+        if now - started >= window_seconds:
+            started, count = now, 0
+        _window_counts[key] = (started, count + 1)
+        return count < limit
+
+
+def warn_row(logger, key, message, *args, limit=DEFAULT_ROW_WARNING_LIMIT,
+             window_seconds=DEFAULT_ROW_WARNING_WINDOW_SECONDS, **fields):
+    """
+    Cảnh báo phát sinh trong vòng lặp theo từng dòng dữ liệu: chỉ ghi `limit` lần đầu cho mỗi `key`
+    trong một request (hoặc trong một cửa sổ thời gian nếu ngoài request), các lần sau chỉ được đếm
+    và tổng hợp vào dòng log kết thúc request.
+    """
+    if _allow_row_warning(key, limit, window_seconds):
+        logger.warning(message, *args, extra={'warning_key': key, **fields})
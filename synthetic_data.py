@@ -0,0 +1,253 @@
+"""
+Sinh bảng kê giả lập (HĐĐT, POS, Log bơm) đúng bố cục các handler đọc, dùng cho kiểm thử tải
+và bộ kiểm thử hồi quy. Dữ liệu hoàn toàn ngẫu nhiên theo seed, không chứa thông tin khách hàng thật.
+"""
+import io
+import random
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+
+# Tên mặt hàng theo MaHH.xlsx (UpSSE) và theo tên trên HĐĐT/Log bơm (đối soát)
+UPSSE_PRODUCTS = ['Xăng E5 RON92 Mức 2', 'Xăng RON95 Mức 3', 'Dầu Điêzen 0,05S Mức 2', 'Dầu Điêzen 0,001S Mức 5']
+RECONCILE_PRODUCTS = ['Xăng E5 RON 92-II', 'Xăng RON 95-III', 'Dầu DO 0,05S-II', 'Dầu DO 0,001S-V']
+UNIT_PRICES = [20000, 21000, 19000, 19500]
+ANONYMOUS_CUSTOMER = 'Người mua không lấy hóa đơn'
+# Tỷ lệ hóa đơn bán lẻ không lấy hóa đơn (gộp thành dòng tổng trong UpSSE)
+ANONYMOUS_RATIO = 0.6
+# MST có trong ChietKhau.xlsx để một phần hóa đơn đi qua nhánh tính chiết khấu
+DISCOUNT_TAX_CODE = '0108021553'
+
+
+def _to_bytes(wb):
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def _random_sale(rng):
+    product = rng.randrange(len(UNIT_PRICES))
+    quantity = round(rng.uniform(1, 60), 2)
+    return product, quantity, round(quantity * UNIT_PRICES[product])
+
+
+def hddt_report(rows=50, day=datetime(2025, 7, 15), symbol='1K26TBX', seed=1):
+    """Bảng kê HĐĐT cho chức năng UpSSE: tiêu đề ở dòng 9, dữ liệu từ dòng 11, một ngày duy nhất (mẫu số 1 + ký hiệu 6 ký tự)."""
+    rng = random.Random(seed)
+    wb = Workbook()
+    ws = wb.active
+    for _ in range(8):
+        ws.append(['Bảng kê hóa đơn'])
+    header = [''] * 25
+    header[20] = 'Số công văn (Số tham chiếu)'
+    ws.append(header)
+    ws.append([''])
+    for i in range(rows):
+        product, quantity, total = _random_sale(rng)
+        tax = round(total / 1.1 * 0.1)
+        anonymous = rng.random() < ANONYMOUS_RATIO
+        row = [''] * 22
+        row[0] = i + 1
+        row[2] = '' if anonymous else f'KH{i:05d}'
+        row[4] = ANONYMOUS_CUSTOMER if anonymous else f'Công ty giả lập {i}'
+        row[5] = '' if anonymous else f'Địa chỉ giả lập {i}'
+        row[6] = '' if anonymous else f'0100{i:06d}'
+        row[7] = UPSSE_PRODUCTS[product]
+        row[9] = quantity
+        row[10] = UNIT_PRICES[product]
+        row[11] = 'Lít'
+        row[14] = total - tax
+        row[15] = '10%'
+        row[16] = tax
+        row[17] = total
+        row[18] = '1'
+        row[19] = symbol[-6:]
+        row[20] = f'{i + 1:07d}'
+        row[21] = day.strftime('%d/%m/%Y')
+        ws.append(row)
+    return _to_bytes(wb)
+
+
+def pos_report(rows=50, day=datetime(2025, 7, 15), symbol='1K26TBX', seed=2):
+    """Bảng kê POS: ô B5 là 6 ký tự cuối ký hiệu hóa đơn của cửa hàng, dữ liệu từ dòng 5."""
+    rng = random.Random(seed)
+    store_code = symbol[-6:]
+    wb = Workbook()
+    ws = wb.active
+    for _ in range(3):
+        ws.append(['Bảng kê POS'])
+    ws.append(['STT', 'Seri', 'Số HĐ'])
+    for i in range(rows):
+        product, quantity, total = _random_sale(rng)
+        tax = round(total / 1.08 * 0.08)
+        anonymous = rng.random() < ANONYMOUS_RATIO
+        ws.append([
+            i + 1, store_code, f'{i + 1:07d}', (day + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'),
+            '' if anonymous else f'KH{i:05d}',
+            ANONYMOUS_CUSTOMER if anonymous else f'Công ty giả lập {i}',
+            '' if anonymous else f'Địa chỉ giả lập {i}',
+            '' if anonymous else f'0100{i:06d}',
+            UPSSE_PRODUCTS[product], 'Lít', quantity, UNIT_PRICES[product], '', total - tax, tax, 8
+        ])
+    return _to_bytes(wb)
+
+
+def _log_bom_bytes(sales, store):
+    """Log bơm: tên CHXD ở dòng 2, dữ liệu từ dòng 10; sales: [(fkey, mặt hàng, số lượng, thành tiền, thời điểm)]."""
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Log bơm'])
+    ws.append([f'CHXD {store}'])
+    for _ in range(7):
+        ws.append(['Tiêu đề'])
+    for fkey, item, quantity, total, moment in sales:
+        row = [''] * 15
+        row[1] = moment
+        row[3] = item
+        row[4] = quantity
+        row[6] = total
+        row[7] = 'Bán lẻ'
+        row[14] = fkey
+        ws.append(row)
+    return _to_bytes(wb)
+
+
+def _reconcile_hddt_row(customer, tax_code, item, quantity, amount, symbol, invoice_number, moment, fkey):
+    """Một dòng Bảng kê HĐĐT cho đối soát (dữ liệu từ dòng 11)."""
+    row = [''] * 25
+    row[3] = customer
+    row[5] = tax_code
+    row[6] = item
+    row[8] = quantity
+    row[9] = 1
+    row[16] = amount
+    row[18] = symbol
+    row[19] = invoice_number
+    row[20] = moment.strftime('%d/%m/%Y')
+    row[24] = fkey
+    return row
+
+
+def _reconcile_hddt_bytes(rows):
+    wb = Workbook()
+    ws = wb.active
+    for _ in range(10):
+        ws.append(['Tiêu đề'])
+    for row in rows:
+        ws.append(row)
+    return _to_bytes(wb)
+
+
+def reconciliation_pair(rows=50, day=datetime(2025, 7, 15), store='Bến xe phía Bắc', symbol='1K26TBX', seed=3,
+                        missing=2, extra=2, amount_diff=3, days=1):
+    """
+    Cặp tệp (Log bơm, Bảng kê HĐĐT) cho đối soát.
+    missing: số giao dịch có trên Log bơm nhưng thiếu hóa đơn; extra: số hóa đơn không có trên Log bơm;
+    amount_diff: số hóa đơn có thành tiền lệch (giảm giá theo lít) so với Log bơm.
+    days > 1 trải giao dịch đều trên nhiều ngày liên tiếp.
+    """
+    rng = random.Random(seed)
+    minutes_per_row = max(1, int(days * 24 * 60 / max(rows, 1)))
+    sales = []
+    for i in range(rows):
+        product, quantity, total = _random_sale(rng)
+        sales.append((f'POS{seed}{i:07d}', RECONCILE_PRODUCTS[product], quantity, total,
+                      day + timedelta(minutes=minutes_per_row * i)))
+
+    hddt_rows = [
+        _reconcile_hddt_row(f'Khách giả lập {index}', DISCOUNT_TAX_CODE if index % 5 == 0 else f'0100{index:06d}', item,
+                            quantity, total - (round(quantity * 200) if index < amount_diff else 0), symbol,
+                            f'{index + 1:07d}', moment, fkey)
+        for index, (fkey, item, quantity, total, moment) in enumerate(sales[missing:])]
+    for j in range(extra):
+        row = _reconcile_hddt_row('Khách lạ', '', RECONCILE_PRODUCTS[0], 10, 200000, symbol, f'9{j:06d}', day,
+                                  f'POSX{seed}{j:05d}')
+        row[9] = ''
+        hddt_rows.append(row)
+    return _log_bom_bytes(sales, store), _reconcile_hddt_bytes(hddt_rows)
+
+
+def three_way_triplet(rows=60, day=datetime(2025, 7, 15), store='Bến xe phía Bắc', symbol='1K26TBX', seed=5,
+                      missing=2, pos_missing=2, pos_quantity_diff=2, split_invoices=3, pos_extra=1):
+    """
+    Bộ ba tệp (Log bơm, Bảng kê POS, Bảng kê HĐĐT) dùng chung FKEY và số hóa đơn, cho đối soát ba chiều.
+    missing: giao dịch trên Log bơm chưa xuất hóa đơn; split_invoices: hóa đơn gộp hai giao dịch (hai dòng HĐĐT
+    mang hai FKEY); pos_missing: hóa đơn cuối có trên HĐĐT nhưng không có trên POS; pos_quantity_diff: hóa đơn
+    (sau các hóa đơn gộp) có số lượng trên POS lệch 1 lít; pos_extra: hóa đơn chỉ có trên POS.
+    """
+    rng = random.Random(seed)
+    sales = []
+    for i in range(rows):
+        product, quantity, total = _random_sale(rng)
+        sales.append((product, f'POS{seed}{i:07d}', quantity, total, day + timedelta(minutes=i)))
+
+    # Mỗi hóa đơn là danh sách chỉ số giao dịch; các giao dịch 'missing' đầu tiên chưa có hóa đơn
+    invoices = []
+    index = missing
+    while index < rows:
+        size = 2 if len(invoices) < split_invoices and index + 1 < rows else 1
+        invoices.append(list(range(index, index + size)))
+        index += size
+
+    store_code = symbol[-6:]
+    hddt_rows, pos_rows = [], []
+    for number, sale_indexes in enumerate(invoices, start=1):
+        invoice_number = f'{number:07d}'
+        for line, sale_index in enumerate(sale_indexes):
+            product, fkey, quantity, total, moment = sales[sale_index]
+            hddt_rows.append(_reconcile_hddt_row(f'Khách giả lập {number}', f'0100{number:06d}', RECONCILE_PRODUCTS[product],
+                                                 quantity, total, symbol, invoice_number, moment, fkey))
+            if number > len(invoices) - pos_missing:
+                continue
+            pos_quantity = quantity + 1 if line == 0 and split_invoices < number <= split_invoices + pos_quantity_diff \
+                else quantity
+            tax = round(total / 1.1 * 0.1)
+            pos_rows.append((store_code, invoice_number, moment, f'Khách giả lập {number}', f'0100{number:06d}',
+                             UPSSE_PRODUCTS[product], pos_quantity, UNIT_PRICES[product], total - tax, tax))
+    for j in range(pos_extra):
+        quantity = 10
+        pos_rows.append((store_code, f'9{j:06d}', day, 'Khách lạ', '', UPSSE_PRODUCTS[0], quantity, UNIT_PRICES[0],
+                         quantity * UNIT_PRICES[0], 0))
+
+    wb = Workbook()
+    ws = wb.active
+    for _ in range(3):
+        ws.append(['Bảng kê POS'])
+    ws.append(['STT', 'Seri', 'Số HĐ'])
+    for i, (seri, invoice_number, moment, customer, tax_code, item, quantity, price, amount, tax) in enumerate(pos_rows):
+        ws.append([i + 1, seri, invoice_number, moment.strftime('%Y-%m-%d %H:%M:%S'), '', customer, '', tax_code,
+                   item, 'Lít', quantity, price, '', amount, tax, 10])
+    log_sales = [(fkey, RECONCILE_PRODUCTS[product], quantity, total, moment) for product, fkey, quantity, total, moment in sales]
+    return _log_bom_bytes(log_sales, store), _to_bytes(wb), _reconcile_hddt_bytes(hddt_rows)
+
+
+def incremental_uploads(rows=40, day=datetime(2025, 7, 15), store='Bến xe phía Bắc', symbol='1K26TBX', seed=6):
+    """
+    Hai lần tải lên (Log bơm, Bảng kê HĐĐT) của cùng một ngày cho đối soát tăng dần.
+    Lần 1: hai giao dịch cuối chưa có hóa đơn; hóa đơn thứ 2 (khách có trong ChietKhau.xlsx) được trừ 200 đ/lít
+    (trạng thái discount), hóa đơn thứ 4 bị trừ sai (mismatch).
+    Lần 2: thêm hai giao dịch mới đã có hóa đơn (new_matches), xuất hóa đơn cho hai giao dịch còn thiếu và sửa
+    hóa đơn thứ 4 (resolved), sửa thành tiền hóa đơn thứ 3 (broken), hủy giao dịch thứ 6 cùng hóa đơn (removed).
+    """
+    rng = random.Random(seed)
+    sales = []
+    for i in range(rows + 2):
+        product, quantity, total = _random_sale(rng)
+        sales.append((f'POS{seed}{i:07d}', RECONCILE_PRODUCTS[product], quantity, total,
+                      day + timedelta(minutes=10 * i)))
+
+    def invoice(index, amount=None):
+        fkey, item, quantity, total, moment = sales[index]
+        tax_code = DISCOUNT_TAX_CODE if index == 1 else f'0100{index:06d}'
+        return _reconcile_hddt_row(f'Khách giả lập {index}', tax_code, item, quantity, total if amount is None else amount,
+                                   symbol, f'{index + 1:07d}', moment, fkey)
+
+    def discounted(index, per_litre=200):
+        return sales[index][3] - round(sales[index][2] * per_litre)
+
+    first_hddt = [invoice(i, discounted(i) if i in (1, 3) else None) for i in range(rows - 2)]
+    second_hddt = [invoice(i, discounted(1) if i == 1 else sales[2][3] + 5000 if i == 2 else None)
+                   for i in range(rows + 2) if i != 5]
+    second_sales = [sale for i, sale in enumerate(sales) if i != 5]
+    return [(_log_bom_bytes(sales[:rows], store), _reconcile_hddt_bytes(first_hddt)),
+            (_log_bom_bytes(second_sales, store), _reconcile_hddt_bytes(second_hddt))]
@@ -0,0 +1,239 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+from structured_logging import current_request_id
+
+# --- CẤU HÌNH MẶC ĐỊNH (có thể ghi đè bằng biến môi trường) ---
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+DEFAULT_TRACE_DIR = os.environ.get('TRACE_DIR', os.path.join(tempfile.gettempdir(), 'upsse_traces'))
+DEFAULT_TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_MB', 10)) * 1024 * 1024
+DEFAULT_TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', 3))
+
+_current_span = contextvars.ContextVar('upsse_current_span', default=None)
+
+
+class Span:
+    """
+    Một đoạn thời gian xử lý có tên, thuộc tính và liên kết cha/con.
+    trace_id trùng với request_id của log để đối chiếu log và waterfall của cùng một request.
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start_time', 'status', 'error',
+                 '_started', 'duration_ms')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else (current_request_id() or uuid.uuid4().hex[:16])
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration_ms = None
+        self.status = 'ok'
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start_time,
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'error': self.error,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'attributes': self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Span giả khi tắt tracing, để mã được đo không cần kiểm tra cờ bật/tắt."""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class JsonLinesExporter:
+    """
+    Ghi mỗi span đã kết thúc thành một dòng JSON, xoay vòng tệp theo dung lượng.
+    Mỗi tiến trình ghi tệp riêng (spans-<pid>.jsonl) để các worker gunicorn không xoay vòng chồng lên nhau.
+    """
+
+    def __init__(self, trace_dir=DEFAULT_TRACE_DIR, max_bytes=DEFAULT_TRACE_MAX_BYTES,
+                 backup_count=DEFAULT_TRACE_BACKUP_COUNT):
+        self.trace_dir = trace_dir
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handler = None
+        self._handler_pid = None
+        self._lock = threading.Lock()
+
+    def _get_handler(self):
+        pid = os.getpid()
+        if self._handler_pid != pid:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(self.trace_dir, f'spans-{pid}.jsonl'), maxBytes=self.max_bytes,
+                backupCount=self.backup_count, encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._handler, self._handler_pid = handler, pid
+        return self._handler
+
+    def export(self, span):
+        record = logging.makeLogRecord({'msg': json.dumps(span.to_dict(), ensure_ascii=False, default=str)})
+        with self._lock:
+            self._get_handler().handle(record)
+
+
+exporter = JsonLinesExporter()
+
+
+def open_span(name, **attributes):
+    """
+    Mở span và đặt làm span hiện tại, trả về handle cho close_span().
+    Dùng khi điểm bắt đầu/kết thúc nằm ở hai hook khác nhau (before_request/teardown_request).
+    """
+    if not TRACING_ENABLED:
+        return None
+    span = Span(name, _current_span.get(), attributes)
+    return span, _current_span.set(span)
+
+
+def close_span(handle, error=None):
+    """Kết thúc span đã mở bằng open_span() và ghi ra tệp."""
+    if handle is None:
+        return
+    span, token = handle
+    if error is not None:
+        span.status = 'error'
+        span.error = f"{type(error).__name__}: {error}"
+    _current_span.reset(token)
+    span.finish()
+    try:
+        exporter.export(span)
+    except Exception:
+        pass
+
+
+@contextmanager
+def start_span(name, **attributes):
+    """Mở một span con của span hiện tại (hoặc span gốc nếu chưa có)."""
+    handle = open_span(name, **attributes)
+    if handle is None:
+        yield _NOOP_SPAN
+        return
+    error = None
+    try:
+        yield handle[0]
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        close_span(handle, error)
+
+
+def current_span():
+    """Span đang mở trong ngữ cảnh hiện tại (span giả nếu không có), dùng để gắn thêm thuộc tính."""
+    return _current_span.get() or _NOOP_SPAN
+
+
+def traced(name=None):
+    """Decorator: chạy hàm trong một span mang tên `name` (mặc định là module.tên_hàm)."""
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__name__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- ĐỌC LẠI SPAN ĐỂ VẼ WATERFALL (chạy offline: python tracing.py <tệp.jsonl> [--trace <trace_id>]) ---
+def load_traces(paths):
+    """Đọc các tệp JSONL và nhóm span theo trace_id."""
+    traces = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    span = json.loads(line)
+                    traces.setdefault(span['trace_id'], []).append(span)
+    return traces
+
+
+def format_waterfall(spans, width=50):
+    """Dựng waterfall dạng văn bản cho các span của một trace (thụt lề theo quan hệ cha/con)."""
+    if not spans:
+        return ''
+    trace_start = min(s['start'] for s in spans)
+    trace_end = max(s['start'] + (s['duration_ms'] or 0) / 1000 for s in spans)
+    total = max(trace_end - trace_start, 1e-9)
+    children = {}
+    for span in sorted(spans, key=lambda s: s['start']):
+        children.setdefault(span['parent_id'], []).append(span)
+    known_ids = {s['span_id'] for s in spans}
+    roots = [s for s in spans if s['parent_id'] not in known_ids]
+
+    lines = []
+
+    def _walk(span, depth):
+        offset = int((span['start'] - trace_start) / total * width)
+        length = max(1, int((span['duration_ms'] or 0) / 1000 / total * width))
+        bar = ' ' * offset + '█' * min(length, width - offset)
+        marker = ' !' if span['status'] != 'ok' else ''
+        lines.append(f"{'  ' * depth + span['name']:<50} {span['duration_ms']:>10.1f} ms |{bar:<{width}}|{marker}")
+        for child in children.get(span['span_id'], []):
+            _walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda s: s['start']):
+        _walk(root, 0)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Cách dùng: python tracing.py <spans.jsonl> [...] [--trace <trace_id>]")
+        sys.exit(1)
+    args = sys.argv[1:]
+    wanted = None
+    if '--trace' in args:
+        index = args.index('--trace')
+        wanted = args[index + 1]
+        args = args[:index] + args[index + 2:]
+    for trace_id, spans in load_traces(args).items():
+        if wanted and trace_id != wanted:
+            continue
+        print(f"Trace {trace_id} ({len(spans)} span)")
+        print(format_waterfall(spans))
+        print()